@@ -0,0 +1,290 @@
+"""
+Benchmark of the recorder and of the web server.
+
+A pseudo-terminal pair stands in for the micro-controller's serial port:
+synthetic frames are written to the master side at a given sample rate,
+limited to what the given baud rate could carry, while the recorder reads
+the slave side. At the same time, client threads load the HTTP endpoints
+(live status, and whole, paged and decimated reads of records of several
+lengths and formats) of a server running in this process.
+
+Reported: sustained ingest rate, lost frames, p50/p99 latency of every
+endpoint and peak RSS of the process.
+
+Everything happens in a temporary data folder:
+    python bench.py [--rate 1000] [--baud 921600] [--duration 10] [--clients 4] ...
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import pty
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tty
+import urllib.request
+
+import numpy as np
+
+# Bits sent on the wire per byte (start bit, 8 data bits, stop bit).
+BITS_PER_BYTE = 10
+
+
+def make_frame(i, channels, framing):
+    """
+    Synthetic exoskeleton sample: joint angles, velocities and currents like signals.
+    :return: bytes
+    """
+    t = i * 0.01
+    values = [round(30.0 * math.sin(2 * math.pi * 0.8 * t + k), 3) for k in range(channels)]
+    values[0] = i
+    if framing == 'msgpack':
+        import framing as framing_module
+        return framing_module.encode_msgpack_frame(values)
+    return (','.join(str(v) for v in values) + '\n').encode()
+
+
+class SerialFeeder(threading.Thread):
+    """
+    Writes frames to the master side of a pty at a fixed sample rate.
+    """
+    def __init__(self, fd, rate, baud, channels, framing, duration):
+        super(SerialFeeder, self).__init__(daemon=True)
+        self.fd = fd
+        self.rate = rate
+        self.byte_rate = baud / BITS_PER_BYTE
+        self.channels = channels
+        self.framing = framing
+        self.duration = duration
+        self.frames = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def run(self):
+        start = time.perf_counter()
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.duration:
+                break
+
+            # Frames due by now, unless the link could not have carried them.
+            due = int(elapsed * self.rate) - self.frames
+            budget = elapsed * self.byte_rate - self.bytes
+            chunk = []
+            size = 0
+            for i in range(self.frames, self.frames + due):
+                frame = make_frame(i, self.channels, self.framing)
+                if size + len(frame) > budget:
+                    break
+                chunk.append(frame)
+                size += len(frame)
+
+            if chunk:
+                data = b''.join(chunk)
+                view = memoryview(data)
+                while view:
+                    n = os.write(self.fd, view)
+                    view = view[n:]
+                self.frames += len(chunk)
+                self.bytes += len(data)
+
+            time.sleep(0.002)
+        self.elapsed = time.perf_counter() - start
+
+
+class LoadClient(threading.Thread):
+    """
+    Requests random endpoints in a loop and records their latency.
+    """
+    def __init__(self, base_url, endpoints, stop_event):
+        super(LoadClient, self).__init__(daemon=True)
+        self.base_url = base_url
+        self.endpoints = endpoints
+        self.stop_event = stop_event
+        self.latencies = {name: [] for name in endpoints}
+        self.errors = 0
+
+    def run(self):
+        names = list(self.endpoints)
+        while not self.stop_event.is_set():
+            name = random.choice(names)
+            t0 = time.perf_counter()
+            try:
+                with urllib.request.urlopen(self.base_url + self.endpoints[name], timeout=60) as r:
+                    r.read()
+            except Exception:
+                self.errors += 1
+                continue
+            self.latencies[name].append(time.perf_counter() - t0)
+
+
+# Extensions of the records read back, by format.
+RECORD_EXTENSIONS = {'bin': '.rec', 'csv': '.csv', 'csv.gz': '.csv.gz'}
+
+
+def make_records(folder, lengths, channels, formats=('bin',)):
+    """
+    Write records of several lengths and formats to read back during the benchmark.
+
+    CSV records are written like the recorder writes them, compressed ones
+    as gzip members, so reads go through the row index or the member index.
+    :param formats: 'bin', 'csv' and/or 'csv.gz'
+    :return: list of (length, format, record name)
+    """
+    import recformat
+    import utils
+
+    folder.mkdir(parents=True, exist_ok=True)
+    made = []
+    for n in lengths:
+        t = np.arange(n)[:, None] * 0.01
+        data = 30.0 * np.sin(2 * np.pi * 0.8 * t + np.arange(channels)[None, :])
+        for fmt in formats:
+            name = 'rec_{}{}'.format(n, RECORD_EXTENSIONS[fmt])
+            if fmt == 'bin':
+                with recformat.BinaryRecordFile(folder / name) as out:
+                    out.write(data)
+            else:
+                out = utils.GzipMemberFile(folder / name) if fmt == 'csv.gz' else open(folder / name, 'wb')
+                with out:
+                    out.write(','.join('V{}'.format(k) for k in range(channels)).encode() + b'\n')
+                    for i in range(0, n, utils.FLUSH_BYTES // (8 * channels)):
+                        out.write(utils.encode_csv(data[i:i + utils.FLUSH_BYTES // (8 * channels)].round(3)))
+                        out.flush()
+            made.append((n, fmt, name))
+    return made
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000.0 if values else float('nan')
+
+
+def run(args):
+    # The web server uses the temporary folder, set before main is imported.
+    workdir = tempfile.mkdtemp(prefix='exo_bench_')
+    os.environ['EXO_DATA_DIR'] = workdir
+    os.environ.pop('EXO_RECORDER_SOCKET', None)
+    try:
+        return benchmark(args)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def benchmark(args):
+    """
+    Run the benchmark and print the report.
+    :return: exit code
+    """
+    import main
+    from werkzeug.serving import make_server
+
+    main.setup(start_catalog=False)
+
+    lengths = [int(n) for n in args.records.split(',') if n]
+    formats = [f for f in args.record_formats.split(',') if f]
+    made = make_records(main.WORKINGDIR / 'EXPDATA' / 'sub_bench' / 'sess_bench', lengths, args.channels, formats)
+
+    # One log line per request would slow the server down.
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = make_server('127.0.0.1', 0, main.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+    master, slave = pty.openpty()
+    tty.setraw(slave)
+    port = os.ttyname(slave)
+
+    def post(path, body):
+        req = urllib.request.Request(base_url + path, data=json.dumps(body).encode(),
+                                     headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(req) as r:
+            return json.loads(r.read())
+
+    started = post('/record/start', {'port': port, 'baud': args.baud, 'patient': 'bench', 'session': 'bench',
+                                     'record': 'live', 'framing': args.framing, 'format': args.format})
+    if started.get('status') != 'RECORDING':
+        print("Could not start the recorder: {}".format(started))
+        return 1
+
+    endpoints = {'record/status': '/record/status?points=980'}
+    for n, fmt, name in made:
+        query = '?subject=sub_bench&session=sess_bench&record={}'.format(name)
+        endpoints['data/record {} {} rows'.format(fmt, n)] = '/data/record' + query
+        endpoints['data/record {} {} rows, page'.format(fmt, n)] = '/data/record' + query + \
+            '&start={}&limit=1000'.format(n // 2)
+        endpoints['data/record {} {} rows, 1000 points'.format(fmt, n)] = '/data/record' + query + '&points=1000'
+
+    feeder = SerialFeeder(master, args.rate, args.baud, args.channels, args.framing, args.duration)
+    stop_event = threading.Event()
+    clients = [LoadClient(base_url, endpoints, stop_event) for _ in range(args.clients)]
+
+    for c in clients:
+        c.start()
+    feeder.start()
+    feeder.join()
+    stop_event.set()
+    for c in clients:
+        c.join()
+
+    # Let the recorder catch up with what is left in the pty.
+    time.sleep(1.0)
+    status = main.RECORDERS.status(main.utils.RecorderManager.DEFAULT_ID)
+    post('/record/stop', {})
+    server.shutdown()
+    os.close(master)
+
+    # The CSV decoder drops the first line, which is usually cut in half.
+    sent = feeder.frames - (1 if args.framing == 'csv' else 0)
+    received = status['frames']['frames']
+    lost = sent - received
+
+    lines = ['Recorder: {} framing, {} output, {} channels, {} Hz offered at {} baud'.format(
+                 args.framing, args.format, args.channels, args.rate, args.baud),
+             '  sent {} frames ({} bytes) in {:.1f} s, {:.0f} frames/s'.format(
+                 feeder.frames, feeder.bytes, feeder.elapsed, feeder.frames / feeder.elapsed),
+             '  ingested {} frames, {:.0f} frames/s, {:.0f} bytes/s'.format(
+                 received, received / feeder.elapsed, status['bytes'] / feeder.elapsed),
+             '  lost {} frames ({:.3%}), malformed {}, dropped {}'.format(
+                 lost, lost / sent if sent else 0.0, status['frames']['malformed'], status['frames']['dropped']),
+             '',
+             'Endpoints: {} clients, {} errors'.format(len(clients), sum(c.errors for c in clients)),
+             '  {:<48} {:>8} {:>10} {:>10}'.format('endpoint', 'requests', 'p50 ms', 'p99 ms')]
+    for name in endpoints:
+        latencies = [v for c in clients for v in c.latencies[name]]
+        lines.append('  {:<48} {:>8} {:>10.2f} {:>10.2f}'.format(
+            name, len(latencies), percentile(latencies, 50), percentile(latencies, 99)))
+
+    # ru_maxrss is in kilobytes on linux, in bytes on macos.
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    rss_mb = rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+    lines += ['', 'Peak RSS: {:.1f} MB'.format(rss_mb)]
+
+    report = '\n'.join(lines)
+    print(report)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            fp.write(report + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the recorder and the web server.')
+    parser.add_argument('--rate', type=float, default=1000.0, help='samples per second sent by the fake MCU')
+    parser.add_argument('--baud', type=int, default=921600, help='baud rate the link is limited to')
+    parser.add_argument('--channels', type=int, default=8, help='values per frame')
+    parser.add_argument('--framing', choices=('csv', 'msgpack'), default='csv')
+    parser.add_argument('--format', choices=('csv', 'bin'), default='csv', help='recording format')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of streaming')
+    parser.add_argument('--clients', type=int, default=4, help='concurrent HTTP clients')
+    parser.add_argument('--records', default='10000,100000,1000000',
+                        help='comma separated lengths of the records read back')
+    parser.add_argument('--record-formats', default='bin,csv,csv.gz',
+                        help='comma separated formats of the records read back: bin, csv, csv.gz')
+    parser.add_argument('--output', help='also write the report to this file')
+    sys.exit(run(parser.parse_args()))
@@ -0,0 +1,205 @@
+"""
+SQLite index of the experimental data folder (EXPDATA).
+
+Every file and folder below the data folder has a row holding its parent
+folder (relative to the data folder), name, size and modification time. Record
+files also get their number of samples, duration and number of channels, so
+listings can show them without opening the files.
+
+The index is reconciled against the filesystem by a background thread, and a
+record is refreshed as soon as its recording stops. A folder that was never
+scanned is scanned on the spot the first time it is listed.
+"""
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+import records
+import segments
+
+# Time between two reconciliations with the filesystem (seconds).
+RECONCILE_INTERVAL = 60.0
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS entries (
+    parent TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    samples INTEGER,
+    duration REAL,
+    channels INTEGER,
+    PRIMARY KEY (parent, name)
+)
+'''
+
+
+class Catalog(object):
+    """
+    Index of the files and folders below root, stored in an SQLite database.
+    """
+    def __init__(self, root, db_path):
+        self.root = Path(root)
+        self.db_path = Path(db_path)
+        self.lock = threading.Lock()
+        # Database connection, opened on first use.
+        self._db = None
+        # Folders scanned since start up.
+        self.scanned = set()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    @property
+    def db(self):
+        if self._db is None:
+            with self.lock:
+                if self._db is None:
+                    self.db_path.parent.mkdir(parents=True, exist_ok=True)
+                    db = sqlite3.connect(str(self.db_path), check_same_thread=False)
+                    db.row_factory = sqlite3.Row
+                    with db:
+                        db.execute('PRAGMA journal_mode=WAL')
+                        db.execute(_SCHEMA)
+                    self._db = db
+        return self._db
+
+    def _relative(self, path):
+        rel = Path(path).relative_to(self.root).as_posix()
+        return '' if rel == '.' else rel
+
+    def scan_dir(self, parent=''):
+        """
+        Reconcile the entries of one folder with the filesystem.
+        :param parent: folder relative to root, '' for root itself
+        :return: list of sub-folders (relative to root)
+        """
+        folder = self.root / parent if parent else self.root
+
+        try:
+            found = {e.name: e for e in os.scandir(folder)}
+        except (FileNotFoundError, NotADirectoryError):
+            found = {}
+
+        db = self.db
+        with self.lock:
+            known = {row['name']: row for row in db.execute(
+                'SELECT * FROM entries WHERE parent = ?', (parent,))}
+
+        updates = []
+        subdirs = []
+        for name, entry in found.items():
+            try:
+                is_dir = entry.is_dir()
+                if is_dir and segments.is_segmented(entry.path):
+                    # Segmented recordings are listed like record files.
+                    is_dir = False
+                    mtime, size = records.record_signature(entry.path)
+                else:
+                    stat = entry.stat()
+                    mtime, size = stat.st_mtime, stat.st_size
+            except FileNotFoundError:
+                continue
+
+            child = name if not parent else parent + '/' + name
+            if is_dir:
+                subdirs.append(child)
+
+            row = known.get(name)
+            if row is not None and row['is_dir'] == int(is_dir) and \
+                    row['size'] == size and row['mtime'] == mtime:
+                continue
+
+            updates.append(self._entry(parent, name, is_dir, mtime, size, entry.path))
+
+        removed = [name for name in known if name not in found]
+
+        with self.lock, db:
+            db.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)', updates)
+            for name in removed:
+                child = name if not parent else parent + '/' + name
+                db.execute('DELETE FROM entries WHERE parent = ? AND name = ?', (parent, name))
+                db.execute("DELETE FROM entries WHERE parent = ? OR parent LIKE ? ESCAPE '\\'",
+                           (child, child.replace('%', '\\%').replace('_', '\\_') + '/%'))
+            self.scanned.add(parent)
+
+        return subdirs
+
+    def _entry(self, parent, name, is_dir, mtime, size, path):
+        samples = duration = channels = None
+        if not is_dir and not records.is_sidecar(name) and name.startswith('rec_'):
+            try:
+                info = records.record_info(path)
+                samples, duration, channels = info['samples'], info['duration'], info['channels']
+            except Exception:
+                pass
+
+        return (parent, name, int(is_dir), size, mtime, samples, duration, channels)
+
+    def scan(self):
+        """
+        Reconcile the whole tree with the filesystem.
+        :return:
+        """
+        pending = ['']
+        while pending and not self.stop_event.is_set():
+            pending.extend(self.scan_dir(pending.pop()))
+
+    def update_path(self, path):
+        """
+        Refresh the entry of one file (e.g. a record that just finished) and its parent folders.
+        :return:
+        """
+        rel = self._relative(path)
+        parts = rel.split('/')
+        for i in range(len(parts)):
+            self.scan_dir('/'.join(parts[:i]))
+
+    def normalize(self, parent):
+        """
+        Turn a folder given by a client into a key of the index.
+        :return: folder relative to root, '' for root
+        """
+        rel = (self.root / (parent or '')).resolve().relative_to(self.root.resolve()).as_posix()
+        return '' if rel == '.' else rel
+
+    def list(self, parent=''):
+        """
+        List the entries of a folder.
+        :param parent: folder relative to root
+        :return: list of dicts
+        """
+        if parent not in self.scanned:
+            self.scan_dir(parent)
+
+        db = self.db
+        with self.lock:
+            rows = db.execute('SELECT * FROM entries WHERE parent = ? ORDER BY name', (parent,)).fetchall()
+
+        return [{'name': row['name'],
+                 'isDir': bool(row['is_dir']),
+                 'size': row['size'],
+                 'mtime': row['mtime'],
+                 'samples': row['samples'],
+                 'duration': row['duration'],
+                 'channels': row['channels']} for row in rows]
+
+    def start(self, interval=RECONCILE_INTERVAL):
+        """
+        Start the background reconciliation thread.
+        :return:
+        """
+        def run():
+            while not self.stop_event.is_set():
+                try:
+                    self.scan()
+                except Exception as e:
+                    print("Catalog scan failed: {}".format(e))
+                self.stop_event.wait(interval)
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
@@ -0,0 +1,301 @@
+"""
+Queries across many records, for comparing channels across sessions and subjects.
+
+A query selects records by subject, session and record name (shell-style
+patterns, e.g. 'sub_*'), a list of channels and an aggregation:
+
+    'summary'      statistics of every record (see stats) and their combination
+    'mean'         mean curve and standard deviation across records
+    'percentiles'  percentile curves across records
+
+Curves are computed over normalized time: every record is averaged into the
+same number of bins, from its first to its last sample, so records of
+different lengths line up (e.g. 0-100% of a walking trial).
+
+Every record is read and reduced on its own, in a pool of processes shared
+by all queries, and only the reductions (a few hundred numbers per record)
+are sent back and merged. The pool is stopped once no query used it for
+POOL_IDLE_TIMEOUT, so idle web servers do not hold its memory.
+"""
+import atexit
+import fnmatch
+import multiprocessing
+import os
+import threading
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+import numpy as np
+
+import records
+import stats
+
+AGGREGATIONS = ('summary', 'mean', 'percentiles')
+
+# Bins of the normalized time curves.
+CURVE_POINTS = 101
+MAX_CURVE_POINTS = 10000
+
+DEFAULT_PERCENTILES = (10, 25, 50, 75, 90)
+
+# Worker processes of the pool, the cores are shared by the web server processes (EXO_WEB_WORKERS).
+POOL_WORKERS = max(1, (os.cpu_count() or 1) // max(1, int(os.environ.get('EXO_WEB_WORKERS', 1))))
+
+# Time after which a pool no query uses is stopped (seconds).
+POOL_IDLE_TIMEOUT = 60.0
+
+_pool = None
+# Queries using the pool, and the timer stopping it once there are none.
+_pool_users = 0
+_idle_timer = None
+_pool_lock = threading.Lock()
+
+
+def _matches(name, patterns):
+    return not patterns or any(fnmatch.fnmatchcase(name, p) for p in patterns)
+
+
+def _list(folder, prefix, patterns, is_dir):
+    try:
+        entries = sorted(os.scandir(folder), key=lambda e: e.name)
+    except FileNotFoundError:
+        return []
+    return [e for e in entries
+            if e.name.startswith(prefix) and not records.is_sidecar(e.name) and _matches(e.name, patterns) and
+            (e.is_dir() if is_dir else records.is_record(e.path))]
+
+
+def collect_records(root, subjects=None, sessions=None, names=None):
+    """
+    Records matching a selection.
+    :param root: EXPDATA folder
+    :param subjects, sessions, names: lists of names or patterns, None or empty for all
+    :return: sorted list of (subject, session, record, path)
+    """
+    selected = []
+    for sub in _list(root, 'sub_', subjects, True):
+        for sess in _list(sub.path, 'sess_', sessions, True):
+            # Segmented recordings are folders.
+            for rec in _list(sess.path, 'rec_', names, False):
+                selected.append((sub.name, sess.name, rec.name, Path(rec.path)))
+    return selected
+
+
+def curve(record_file, channels, points=CURVE_POINTS):
+    """
+    Average the selected channels of a record into bins of normalized time, in one pass.
+    :return: (column names, 2D array with one row per bin, NaN for empty bins), samples
+    """
+    n = records.record_info(record_file)['samples']
+    reader = records.RecordReader(record_file, channels=channels).open()
+
+    sums = counts = None
+    row = 0
+    for chunk in reader:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.shape[0] == 0:
+            continue
+        if sums is None:
+            sums = np.zeros((points, chunk.shape[1]))
+            counts = np.zeros(points)
+        # Rows written after record_info counted them land in the last bin.
+        bins = np.minimum(np.arange(row, row + chunk.shape[0]) * points // max(n, 1), points - 1)
+        row += chunk.shape[0]
+        counts += np.bincount(bins, minlength=points)
+        for j in range(chunk.shape[1]):
+            sums[:, j] += np.bincount(bins, weights=chunk[:, j], minlength=points)
+
+    columns = [str(c) for c in reader.columns]
+    if sums is None:
+        return columns, np.full((points, len(columns)), np.nan), 0
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return columns, sums / counts[:, None], row
+
+
+def reduce_record(path, channels, aggregation, points):
+    """
+    Reduce one record, runs in a worker process.
+    :return: dict
+    """
+    if aggregation == 'summary':
+        result = stats.record_stats(path)
+        if channels:
+            missing = [str(c) for c in channels if str(c) not in result['channels']]
+            if missing:
+                raise KeyError('Unknown channel {}'.format(missing[0]))
+            result = dict(result, channels={str(c): result['channels'][str(c)] for c in channels})
+        return result
+
+    columns, values, samples = curve(path, channels, points)
+    return {'columns': columns, 'curve': values, 'samples': samples}
+
+
+def get_pool():
+    """
+    Pool of worker processes shared by the queries, started on first use.
+
+    Every call must be matched by a call to release_pool once the query is done with it.
+    :return: ProcessPoolExecutor
+    """
+    global _pool, _pool_users, _idle_timer
+    with _pool_lock:
+        if _idle_timer is not None:
+            _idle_timer.cancel()
+            _idle_timer = None
+        if _pool is None:
+            # Forking the threaded web server is unsafe, start the workers from a clean process.
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+            _pool = ProcessPoolExecutor(max_workers=POOL_WORKERS,
+                                        mp_context=multiprocessing.get_context(method))
+        _pool_users += 1
+        return _pool
+
+
+def release_pool():
+    """
+    Tell that a query is done with the pool, which is stopped after POOL_IDLE_TIMEOUT without queries.
+    :return:
+    """
+    global _pool_users, _idle_timer
+    with _pool_lock:
+        _pool_users -= 1
+        if _pool_users == 0 and _pool is not None:
+            _idle_timer = threading.Timer(POOL_IDLE_TIMEOUT, _stop_idle_pool, args=(_pool,))
+            _idle_timer.daemon = True
+            _idle_timer.start()
+
+
+def _stop_idle_pool(pool):
+    global _pool, _idle_timer
+    with _pool_lock:
+        # A query may have started since the timer fired.
+        if _pool is not pool or _pool_users:
+            return
+        _pool = _idle_timer = None
+    pool.shutdown(wait=False)
+
+
+def _reset_pool(pool):
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.shutdown(wait=False)
+
+
+@atexit.register
+def shutdown():
+    global _pool, _idle_timer
+    with _pool_lock:
+        pool, _pool = _pool, None
+        if _idle_timer is not None:
+            _idle_timer.cancel()
+            _idle_timer = None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _merge_curves(reduced, percentiles):
+    """
+    Combine the curves of the records, channels are matched by name.
+    :return: dict of channel name to dict of curves
+    """
+    by_channel = {}
+    for r in reduced:
+        for j, name in enumerate(r['columns']):
+            by_channel.setdefault(name, []).append(r['curve'][:, j])
+
+    channels = {}
+    for name, curves in by_channel.items():
+        stack = np.vstack(curves)
+        with warnings.catch_warnings():
+            # Bins empty in every record (records shorter than the number of bins) stay NaN.
+            warnings.simplefilter('ignore', RuntimeWarning)
+            c = {'records': len(curves),
+                 'mean': np.nanmean(stack, axis=0),
+                 'std': np.nanstd(stack, axis=0)}
+            if percentiles is not None:
+                values = np.nanpercentile(stack, percentiles, axis=0)
+                c['percentiles'] = {'{:g}'.format(q): v for q, v in zip(percentiles, values)}
+        channels[name] = c
+    return channels
+
+
+def _to_list(values):
+    # JSON has no NaN, empty bins become null.
+    return [None if np.isnan(v) else float(v) for v in values]
+
+
+def run_query(root, subjects=None, sessions=None, names=None, channels=None, aggregation='summary',
+              points=CURVE_POINTS, percentiles=DEFAULT_PERCENTILES):
+    """
+    Select records and aggregate them in the worker pool.
+    :return: dict with 'records' (per record results or errors) and 'result' (the aggregation)
+    """
+    if aggregation not in AGGREGATIONS:
+        raise ValueError('Unknown aggregation {}'.format(aggregation))
+    if not 1 <= points <= MAX_CURVE_POINTS:
+        raise ValueError('points must be between 1 and {}'.format(MAX_CURVE_POINTS))
+    percentiles = [float(q) for q in percentiles] if aggregation == 'percentiles' else None
+    if percentiles is not None and not all(0 <= q <= 100 for q in percentiles):
+        raise ValueError('percentiles must be between 0 and 100')
+
+    selected = collect_records(root, subjects, sessions, names)
+
+    results = [None] * len(selected)
+    errors = [None] * len(selected)
+    pool = get_pool()
+    try:
+        try:
+            futures = {pool.submit(reduce_record, str(path), channels, aggregation, points): i
+                       for i, (_, _, _, path) in enumerate(selected)}
+        except BrokenProcessPool:
+            # A worker died (e.g. killed by the OOM killer), start a new pool for the next query.
+            _reset_pool(pool)
+            raise
+
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except BrokenProcessPool:
+                _reset_pool(pool)
+                raise
+            except KeyError as e:
+                # str() of a KeyError quotes the message.
+                errors[i] = e.args[0] if e.args else str(e)
+            except Exception as e:
+                errors[i] = str(e)
+    finally:
+        release_pool()
+
+    per_record = []
+    for (subject, session, name, _), r, error in zip(selected, results, errors):
+        entry = {'subject': subject, 'session': session, 'record': name}
+        if error is not None:
+            entry['error'] = error
+        elif aggregation == 'summary':
+            entry['stats'] = r
+        else:
+            entry['samples'] = r['samples']
+        per_record.append(entry)
+
+    reduced = [r for r in results if r is not None]
+    if aggregation == 'summary':
+        result = stats.rollup(reduced)
+    else:
+        channels_out = {}
+        for name, c in _merge_curves(reduced, percentiles).items():
+            out = {'records': c['records'], 'mean': _to_list(c['mean']), 'std': _to_list(c['std'])}
+            if 'percentiles' in c:
+                out['percentiles'] = {q: _to_list(v) for q, v in c['percentiles'].items()}
+            channels_out[name] = out
+        result = {'points': points,
+                  # Center of every bin, in percent of the record.
+                  'time': ((np.arange(points) + 0.5) * 100.0 / points).round(6).tolist(),
+                  'channels': channels_out}
+
+    return {'records': per_record, 'result': result}
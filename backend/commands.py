@@ -0,0 +1,107 @@
+"""
+Parameter commands sent to the micro-controller over the serial link.
+
+While a recorder runs, it owns the serial port: commands are written to the
+port it holds from the thread sending them, while the recorder thread keeps
+reading (serial ports are full duplex, a write does not wait for a read), and
+the acknowledgements are picked out of the stream by its decoder (see
+framing). Commands are serialized among themselves. Recording goes on
+undisturbed and a command is acknowledged as soon as the reply is read,
+typically within a few milliseconds.
+
+Without a recorder on the port, send_direct opens the port just for the time
+of the command.
+"""
+import itertools
+import threading
+import time
+
+import serial
+
+import framing as framing_module
+
+# Time to wait for an acknowledgement (seconds).
+ACK_TIMEOUT = 0.5
+
+# Maximum time a read blocks while waiting for an acknowledgement on a port opened for a command (seconds).
+READ_TIMEOUT = 0.01
+
+
+def _result(seq, ack, started):
+    return {'seq': seq,
+            'acked': ack is not None,
+            'ok': bool(ack and ack['ok']),
+            'error': 'TIMEOUT' if ack is None else ack['error'],
+            'latency': time.perf_counter() - started}
+
+
+class CommandChannel(object):
+    """
+    Sends commands through a write function and matches the acknowledgements to them.
+    """
+    def __init__(self, write, framing='csv'):
+        # Writes bytes to the serial port.
+        self.write = write
+        self.framing = framing
+        self.seq = itertools.count(1)
+        self.write_lock = threading.Lock()
+        # Commands waiting for their acknowledgement, by sequence number.
+        self.pending = {}
+        self.pending_lock = threading.Lock()
+
+    def send(self, params, timeout=ACK_TIMEOUT):
+        """
+        Send parameters and wait for the acknowledgement.
+        :param params: dict of parameter name to value
+        :return: dict with 'seq', 'acked', 'ok', 'error' and 'latency' (seconds)
+        """
+        with self.pending_lock:
+            seq = next(self.seq)
+            waiter = self.pending[seq] = [threading.Event(), None]
+
+        try:
+            data = framing_module.encode_command(seq, params, self.framing)
+            started = time.perf_counter()
+            with self.write_lock:
+                self.write(data)
+            waiter[0].wait(timeout)
+        finally:
+            with self.pending_lock:
+                self.pending.pop(seq, None)
+
+        return _result(seq, waiter[1], started)
+
+    def acknowledge(self, ack):
+        """
+        Hand an acknowledgement read from the port to the command waiting for it.
+        :return:
+        """
+        with self.pending_lock:
+            waiter = self.pending.get(ack['seq'])
+        if waiter is not None:
+            waiter[1] = ack
+            waiter[0].set()
+
+
+def send_direct(port, baud, params, framing='csv', timeout=ACK_TIMEOUT):
+    """
+    Open a serial port, send parameters and wait for the acknowledgement.
+    :return: dict, see CommandChannel.send
+    """
+    decoder = framing_module.make_decoder(framing)
+    # The acknowledgement can be the first line received.
+    decoder.skip_first_line = False
+    seq = 1
+
+    with serial.Serial(port, baud, timeout=READ_TIMEOUT) as spobj:
+        # Stale bytes could hold an old acknowledgement.
+        spobj.reset_input_buffer()
+        started = time.perf_counter()
+        spobj.write(framing_module.encode_command(seq, params, framing))
+
+        ack = None
+        while ack is None and time.perf_counter() - started < timeout:
+            decoder.feed(spobj.read(max(1, spobj.in_waiting)))
+            ack = next((a for a in decoder.pop_acks() if a['seq'] == seq), None)
+
+    return _result(seq, ack, started)
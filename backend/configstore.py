@@ -0,0 +1,134 @@
+"""
+In-memory store for the settings kept in config.toml.
+"""
+import copy
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+import toml
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on windows, writers are then only serialized within the process.
+    fcntl = None
+
+
+class ConfigStore(object):
+    """
+    Keeps the parsed configuration file in memory.
+
+    The cached settings are reloaded when the file's modification time
+    changes. Updates are serialized (across threads, and across processes
+    through a lock file) and written atomically: the new file is written next
+    to the old one and renamed over it.
+    """
+    def __init__(self, path):
+        self.path = Path(path)
+        self.lock = threading.RLock()
+        self._settings = None
+        self._mtime = None
+
+    def _current_mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        """
+        Return the cached settings, reloading them if the file changed.
+        :return: dict
+        """
+        mtime = self._current_mtime()
+        if self._settings is None or mtime != self._mtime:
+            with open(self.path, 'r') as fp:
+                self._settings = toml.load(fp)
+            self._mtime = mtime
+        return self._settings
+
+    def get(self, section=None):
+        """
+        Get a copy of the settings, or of one section of the settings.
+        :return:
+        """
+        with self.lock:
+            settings = self._load()
+            return copy.deepcopy(settings if section is None else settings[section])
+
+    def exists(self):
+        return self.path.is_file()
+
+    def update(self, fn):
+        """
+        Read-modify-write the settings.
+        :param fn: function called with the settings dict, modifying it in place
+        :return: copy of the new settings
+        """
+        with self.lock, self._file_lock():
+            settings = copy.deepcopy(self._load())
+            fn(settings)
+            self._save(settings)
+            return copy.deepcopy(settings)
+
+    def set(self, section, value):
+        """
+        Replace one section of the settings.
+        :return: copy of the new settings
+        """
+        def apply(settings):
+            settings[section] = value
+        return self.update(apply)
+
+    def create(self, settings):
+        """
+        Write a new configuration file, creating its folder if needed.
+        :return:
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock, self._file_lock():
+            self._save(copy.deepcopy(settings))
+
+    def _save(self, settings):
+        # Write the new file next to the old one, then rename it over the old one.
+        fd, tmp = tempfile.mkstemp(dir=str(self.path.parent), prefix=self.path.name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                toml.dump(settings, fp)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(tmp, str(self.path))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+        self._settings = settings
+        self._mtime = self._current_mtime()
+
+    def _file_lock(self):
+        return _FileLock(self.path.with_name(self.path.name + '.lock'))
+
+
+class _FileLock(object):
+    """
+    Exclusive advisory lock on a file, held for the duration of a with block.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.fp = None
+
+    def __enter__(self):
+        if fcntl is not None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.fp = open(self.path, 'a')
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc):
+        if self.fp is not None:
+            fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+            self.fp.close()
+            self.fp = None
@@ -0,0 +1,285 @@
+"""
+Reduce recorded data to a number of points suitable for plotting.
+
+Two modes are available:
+  minmax: the range is cut into buckets and the minimum and maximum of every
+          channel are kept for each bucket, which preserves peaks.
+  lttb: largest triangle three buckets, keeps the samples of a reference
+        channel that best preserve the shape of its curve.
+
+For finished records a multi-resolution pyramid of min/max buckets is built
+once and stored next to the record (<record>.pyr.npz), so that decimated views
+of any range are computed from a handful of buckets instead of the raw data.
+Records still being written are decimated from their raw rows, their
+pyramid would be out of date on every request.
+"""
+import contextlib
+from pathlib import Path
+
+import numpy as np
+
+import records
+
+# Number of samples merged into one bucket from one pyramid level to the next.
+PYRAMID_FACTOR = 16
+
+# Suffix of the pyramid file stored next to a record.
+PYRAMID_SUFFIX = '.pyr.npz'
+
+# Version of the pyramid files, files of other versions are rebuilt.
+PYRAMID_VERSION = 2
+
+
+def minmax(data, points, first_index=0):
+    """
+    Min/max decimation of a block of samples.
+    :param data: 2D array, one row per sample
+    :param points: target number of points (two points are kept per bucket)
+    :param first_index: index of the first row of data
+    :return: (row index of every point, 2D array of points)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[0]
+    buckets = max(1, points // 2)
+
+    if n <= points:
+        return first_index + np.arange(n), data
+
+    # Bucket edges, as even as possible.
+    edges = np.linspace(0, n, buckets + 1).astype(np.int64)
+    lo = np.minimum.reduceat(data, edges[:-1], axis=0)
+    hi = np.maximum.reduceat(data, edges[:-1], axis=0)
+
+    return _interleave(edges, lo, hi, first_index)
+
+
+def _interleave(edges, lo, hi, first_index):
+    """
+    Interleave bucket minima and maxima, the minimum at the start of the bucket
+    and the maximum at its end.
+    :return: (row index of every point, 2D array of points)
+    """
+    index = np.empty(2 * lo.shape[0], dtype=np.int64)
+    index[0::2] = edges[:-1]
+    index[1::2] = edges[1:] - 1
+
+    out = np.empty((2 * lo.shape[0], lo.shape[1]), dtype=lo.dtype)
+    out[0::2] = lo
+    out[1::2] = hi
+
+    return first_index + index, out
+
+
+def lttb(data, points, first_index=0, channel=0):
+    """
+    Largest triangle three buckets decimation driven by one channel.
+    :param data: 2D array, one row per sample
+    :param points: number of points to keep
+    :param first_index: index of the first row of data
+    :param channel: column used to pick the samples
+    :return: (row index of every point, 2D array of points)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n = data.shape[0]
+
+    if n <= points or points < 3:
+        return first_index + np.arange(n), data
+
+    y = data[:, channel]
+    x = np.arange(n, dtype=np.float64)
+    edges = np.linspace(1, n - 1, points - 1).astype(np.int64)
+
+    keep = np.empty(points, dtype=np.int64)
+    keep[0] = 0
+    keep[-1] = n - 1
+    a = 0
+    for i in range(points - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point).
+        nlo, nhi = edges[i + 1], edges[i + 2] if i + 2 < len(edges) else n
+        avg_x = x[nlo:nhi].mean()
+        avg_y = y[nlo:nhi].mean()
+
+        # Pick the point of this bucket forming the largest triangle.
+        area = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+        a = lo + int(np.argmax(area))
+        keep[i + 1] = a
+
+    return first_index + keep, data[keep]
+
+
+def pyramid_path(record_file):
+    """
+    Path of the pyramid file of a record.
+    :return: Path
+    """
+    record_file = Path(record_file)
+    return record_file.with_name(record_file.name + PYRAMID_SUFFIX)
+
+
+def build_pyramid(record_file, factor=PYRAMID_FACTOR):
+    """
+    Build the min/max pyramid of a record and store it next to the record.
+
+    Level 1 holds one bucket per factor samples, level 2 one bucket per
+    factor**2 samples and so on, up to a level with a single bucket.
+    :return: dict with 'rows', 'columns' and the 'min<k>' / 'max<k>' arrays
+    """
+    record_file = Path(record_file)
+    mtime, size = records.record_signature(record_file)
+
+    reader = records.RecordReader(record_file).open()
+
+    # Level 1 is built chunk by chunk, carrying over the rows of an incomplete bucket.
+    lows, highs = [], []
+    carry = None
+    rows = 0
+    for chunk in reader:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        rows += chunk.shape[0]
+        if carry is not None:
+            chunk = np.concatenate([carry, chunk])
+        full = (chunk.shape[0] // factor) * factor
+        if full:
+            blocks = chunk[:full].reshape(full // factor, factor, chunk.shape[1])
+            lows.append(blocks.min(axis=1))
+            highs.append(blocks.max(axis=1))
+        carry = chunk[full:]
+    if carry is not None and carry.shape[0]:
+        lows.append(carry.min(axis=0, keepdims=True))
+        highs.append(carry.max(axis=0, keepdims=True))
+
+    width = len(reader.columns)
+    pyramid = {'version': np.int64(PYRAMID_VERSION),
+               'rows': np.int64(rows),
+               'factor': np.int64(factor),
+               'mtime': np.float64(mtime),
+               'size': np.int64(size),
+               'columns': np.array(reader.columns, dtype=str)}
+
+    level = 1
+    lo = np.concatenate(lows) if lows else np.zeros((0, width))
+    hi = np.concatenate(highs) if highs else np.zeros((0, width))
+    while True:
+        pyramid['min{}'.format(level)] = lo.astype(np.float32)
+        pyramid['max{}'.format(level)] = hi.astype(np.float32)
+        if lo.shape[0] <= 1:
+            break
+
+        # Merge factor buckets of this level into one bucket of the next level.
+        edges = np.arange(0, lo.shape[0], factor)
+        lo = np.minimum.reduceat(lo, edges, axis=0)
+        hi = np.maximum.reduceat(hi, edges, axis=0)
+        level += 1
+
+    pyramid['levels'] = np.int64(level)
+
+    # Write to a temporary file first, so that readers never see half a pyramid.
+    dest = pyramid_path(record_file)
+    tmp = dest.with_name(dest.name + '.part')
+    with open(tmp, 'wb') as fp:
+        np.savez(fp, **pyramid)
+    tmp.replace(dest)
+
+    return pyramid
+
+
+@contextlib.contextmanager
+def open_pyramid(record_file, build=True):
+    """
+    Open the pyramid of a record, (re)building it if it is missing or out of date.
+
+    The arrays of a stored pyramid are only read from the file when they are
+    accessed, so a view reads the one level it needs.
+    :return: context manager giving a mapping of names to arrays, or None
+    """
+    record_file = Path(record_file)
+    path = pyramid_path(record_file)
+    mtime, size = records.record_signature(record_file)
+
+    if path.is_file():
+        with np.load(path) as npz:
+            if ('version' in npz.files and int(npz['version']) == PYRAMID_VERSION and
+                    float(npz['mtime']) == mtime and int(npz['size']) == size):
+                yield npz
+                return
+
+    yield build_pyramid(record_file) if build else None
+
+
+def load_pyramid(record_file, build=True):
+    """
+    Load the whole pyramid of a record, see open_pyramid.
+    :return: dict or None
+    """
+    with open_pyramid(record_file, build) as pyramid:
+        return None if pyramid is None else {k: pyramid[k] for k in pyramid}
+
+
+def pyramid_minmax(record_file, points, start=0, stop=None, channels=None, live=False):
+    """
+    Min/max decimation of rows [start, stop) of a record using its pyramid.
+
+    The coarsest level that still has at least points / 2 buckets in the range
+    is used. The level buckets only partly in the range are replaced by the
+    raw rows in the range. If the range is too short for any level, or the
+    record is live (still being written), the raw rows are read.
+    :return: (column names, row index of every point, 2D array of points)
+    """
+    if live:
+        columns, data = records.read_all(record_file, start, stop, channels)
+        index, out = minmax(data, points, start)
+        return columns, index, out
+
+    with open_pyramid(record_file) as pyramid:
+        rows = int(pyramid['rows'])
+        factor = int(pyramid['factor'])
+        columns = [str(c) for c in pyramid['columns']]
+        idx = records.select_columns(columns, channels)
+
+        stop = rows if stop is None else min(stop, rows)
+        start = max(0, min(start, stop))
+        buckets = max(1, points // 2)
+
+        # Pick the level.
+        level, size = 0, 1
+        while level < int(pyramid['levels']) and (stop - start) // (size * factor) >= buckets:
+            level += 1
+            size *= factor
+
+        if level == 0:
+            columns, data = records.read_all(record_file, start, stop, channels)
+            index, out = minmax(data, points, start)
+            return columns, index, out
+
+        # Level buckets entirely in the range, rows [head, tail).
+        head = -(-start // size) * size
+        tail = stop // size * size
+        lo = pyramid['min{}'.format(level)][head // size:tail // size].astype(np.float64)
+        hi = pyramid['max{}'.format(level)][head // size:tail // size].astype(np.float64)
+
+    if idx is not None:
+        columns = [columns[i] for i in idx]
+        lo, hi = lo[:, idx], hi[:, idx]
+
+    # Rows before the first and after the last full bucket become buckets of their own.
+    lows, highs, bounds = [lo], [hi], list(range(head, tail + 1, size))
+    if start < head:
+        _, data = records.read_all(record_file, start, head, channels)
+        lows.insert(0, data.min(axis=0, keepdims=True))
+        highs.insert(0, data.max(axis=0, keepdims=True))
+        bounds.insert(0, start)
+    if tail < stop:
+        _, data = records.read_all(record_file, tail, stop, channels)
+        lows.append(data.min(axis=0, keepdims=True))
+        highs.append(data.max(axis=0, keepdims=True))
+        bounds.append(stop)
+    lo, hi = np.concatenate(lows), np.concatenate(highs)
+    bounds = np.asarray(bounds, dtype=np.int64)
+
+    # Merge the buckets down to the requested number of buckets.
+    edges = np.linspace(0, lo.shape[0], min(buckets, lo.shape[0]) + 1).astype(np.int64)
+    lo = np.minimum.reduceat(lo, edges[:-1], axis=0)
+    hi = np.maximum.reduceat(hi, edges[:-1], axis=0)
+
+    return (columns,) + _interleave(bounds[edges], lo, hi, 0)
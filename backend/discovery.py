@@ -0,0 +1,204 @@
+"""
+Cached discovery of the serial ports and of the micro-controller programmer.
+
+Listing ports and probing the programmer (which forks st-info) are too slow
+to run on every request of pages that refresh often. Results are cached and
+served from memory:
+  - a result older than its time to live is still served, and refreshed in
+    the background;
+  - a watcher thread checks the modification times of the device folders
+    and refreshes everything as soon as a device appears or disappears.
+"""
+import glob
+import os
+import subprocess
+import threading
+import time
+
+from serial.tools import list_ports
+
+# Time to live of the cached port list (seconds).
+PORTS_TTL = 5.0
+
+# Time to live of the cached programmer probe (seconds).
+PROBE_TTL = 30.0
+
+# Time between two checks for added or removed devices (seconds).
+WATCH_INTERVAL = 0.5
+
+# Folders whose modification time changes when a device is plugged or unplugged.
+WATCHED_DIRS = ('/dev', '/dev/serial/by-id', '/dev/bus/usb/*')
+
+
+def is_serial_port(name):
+    """
+    Whether a device of /dev looks like the serial port of the exoskeleton.
+    :return: bool
+    """
+    dev = name.lower()
+    return 'cu' in dev or 'usb' in dev or 'acm' in dev or 'S0' in name
+
+
+def list_serial_ports():
+    """
+    Serial ports with their USB metadata when they have any.
+    :return: list of dicts, sorted by device
+    """
+    try:
+        devices = {'/dev/' + d for d in os.listdir('/dev') if is_serial_port(d)}
+    except FileNotFoundError:
+        # No /dev on windows, rely on pyserial alone.
+        devices = set()
+
+    ports = {}
+    for info in list_ports.comports(include_links=True):
+        ports[info.device] = {'device': info.device,
+                              'description': info.description,
+                              'hwid': info.hwid,
+                              'vid': info.vid,
+                              'pid': info.pid,
+                              'serial_number': info.serial_number,
+                              'manufacturer': info.manufacturer,
+                              'product': info.product,
+                              'location': info.location}
+
+    for device in devices:
+        if device not in ports:
+            ports[device] = {'device': device, 'description': 'n/a', 'hwid': 'n/a', 'vid': None, 'pid': None,
+                             'serial_number': None, 'manufacturer': None, 'product': None, 'location': None}
+
+    return [ports[d] for d in sorted(ports)]
+
+
+def probe_programmer():
+    """
+    Ask st-info about the programmer and the micro-controller behind it.
+    :return: dict of the reported fields, or None if no programmer is connected
+    """
+    try:
+        output = subprocess.run(['st-info', '--probe'], capture_output=True)
+    except FileNotFoundError:
+        return None
+
+    all_output = (output.stdout + output.stderr).decode('utf-8')
+
+    if all_output.strip() == 'Found 0 stlink programmers':
+        return None
+
+    infodict = {}
+    for l in all_output.split('\n'):
+        if ':' in l:
+            infodict[l[:l.find(':')].strip()] = l[l.find(':')+1:].strip()
+    return infodict
+
+
+class CachedValue(object):
+    """
+    Result of a function, recomputed once older than ttl.
+
+    The first call waits for the result, later calls get the cached result
+    right away and start a refresh in the background if it is stale.
+    """
+    def __init__(self, fn, ttl):
+        self.fn = fn
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.value = None
+        self.updated = None
+        self.refreshing = False
+
+    def refresh(self):
+        """
+        Recompute the value now.
+        :return: the new value
+        """
+        value = self.fn()
+        with self.lock:
+            self.value = value
+            self.updated = time.monotonic()
+            self.refreshing = False
+        return value
+
+    def _refresh_quietly(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            print("Refresh of {} failed: {}".format(self.fn.__name__, e))
+            with self.lock:
+                self.refreshing = False
+
+    def get(self):
+        with self.lock:
+            if self.updated is not None:
+                if not self.refreshing and time.monotonic() - self.updated > self.ttl:
+                    self.refreshing = True
+                    threading.Thread(target=self._refresh_quietly, daemon=True).start()
+                return self.value
+
+        return self.refresh()
+
+
+class HardwareDiscovery(object):
+    """
+    Cached port list and programmer probe, kept up to date by a watcher thread
+    started on first use.
+    """
+    def __init__(self, ports_ttl=PORTS_TTL, probe_ttl=PROBE_TTL, watch_interval=WATCH_INTERVAL):
+        self.ports = CachedValue(list_serial_ports, ports_ttl)
+        self.probe = CachedValue(probe_programmer, probe_ttl)
+        self.watch_interval = watch_interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def serial_ports(self):
+        """
+        :return: list of port dicts, see list_serial_ports()
+        """
+        self._start()
+        return self.ports.get()
+
+    def programmer(self):
+        """
+        :return: dict of the programmer information, or None if none is connected
+        """
+        self._start()
+        return self.probe.get()
+
+    def _start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self._watch, daemon=True)
+                    self.thread.start()
+
+    def _watch(self):
+        signature = device_signature()
+        while not self.stop_event.wait(self.watch_interval):
+            current = device_signature()
+            if current == signature:
+                continue
+            signature = current
+            for cached in (self.ports, self.probe):
+                try:
+                    cached.refresh()
+                except Exception as e:
+                    print("Refresh of {} failed: {}".format(cached.fn.__name__, e))
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def device_signature():
+    """
+    Modification times of the device folders, changes when a device is added or removed.
+    :return: tuple
+    """
+    signature = []
+    for pattern in WATCHED_DIRS:
+        for path in sorted(glob.glob(pattern)):
+            try:
+                signature.append((path, os.stat(path).st_mtime_ns))
+            except FileNotFoundError:
+                pass
+    return tuple(signature)
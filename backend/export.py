@@ -0,0 +1,295 @@
+"""
+Streamed archives of the recorded data, for exporting a subject or a session.
+
+Archives are produced lazily, file by file, so nothing is held in memory nor
+written to disk besides the converted records. Files are stored without
+recompressing them (recordings can already be compressed) and copied in large
+chunks, so exporting raw files is bound by disk and network speed.
+
+Records can be exported as they are ('raw'), as binary records ('bin', CSV
+recordings are converted) or as plain CSV ('csv', binary records are
+converted). Files are recognized as records by their extension, so the
+segments of segmented recordings are converted as well, and their manifest
+is rewritten to list the converted segments. Conversions run in a pool of
+processes, a few files ahead of the one being sent.
+"""
+import collections
+import json
+import multiprocessing
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+import recformat
+import records
+import segments
+
+# Size of the chunks the files are sent in (bytes).
+CHUNK_SIZE = 1024 * 1024
+
+# Conversions submitted ahead of the file being sent, per worker process.
+LOOKAHEAD = 2
+
+FORMATS = ('tar', 'zip')
+CONVERSIONS = ('raw', 'bin', 'csv')
+MIMETYPES = {'tar': 'application/x-tar', 'zip': 'application/zip'}
+
+# Extensions of the records and segments that can be converted.
+RECORD_SUFFIXES = ('.csv.gz', '.csv', recformat.EXTENSION)
+
+
+def collect_files(folder):
+    """
+    Files below a folder, leaving out sidecar files.
+    :param folder: folder to export
+    :return: sorted list of (name in the archive, path)
+    """
+    folder = Path(folder)
+    files = []
+    for dirpath, dirnames, filenames in os.walk(folder):
+        dirnames.sort()
+        for name in sorted(filenames):
+            if records.is_sidecar(name):
+                continue
+            path = Path(dirpath) / name
+            files.append(((folder.name / path.relative_to(folder)).as_posix(), path))
+    return files
+
+
+def _is_manifest(name):
+    path = Path(name)
+    return path.name == segments.MANIFEST and path.parent.name.endswith(segments.EXTENSION)
+
+
+def _needs_conversion(name, conversion):
+    if conversion == 'raw':
+        return False
+    if _is_manifest(name):
+        return True
+    if not name.endswith(RECORD_SUFFIXES):
+        return False
+    is_binary = name.endswith(recformat.EXTENSION)
+    return is_binary if conversion == 'csv' else not is_binary
+
+
+def _converted_name(name, conversion):
+    if _is_manifest(name):
+        return name
+    for suffix in RECORD_SUFFIXES:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+            break
+    return name + (recformat.EXTENSION if conversion == 'bin' else '.csv')
+
+
+def convert_manifest(path, conversion, dest):
+    """
+    Rewrite the manifest of a segmented recording for its converted segments.
+    :return: dest
+    """
+    manifest = segments.read_manifest(Path(path).parent)
+    entries = manifest['segments'] + ([manifest['current']] if manifest.get('current') else [])
+    converted = False
+    for entry in entries:
+        if _needs_conversion(entry['name'], conversion):
+            entry['name'] = _converted_name(entry['name'], conversion)
+            converted = True
+    if converted:
+        # Converted segments are not compressed.
+        manifest['format'] = conversion
+        manifest['compression'] = None
+    with open(dest, 'w') as fp:
+        json.dump(manifest, fp)
+    return dest
+
+
+def convert_file(path, conversion, dest):
+    """
+    Convert one record, runs in a worker process.
+    :param conversion: 'bin' or 'csv'
+    :param dest: output path
+    :return: dest
+    """
+    if _is_manifest(path):
+        convert_manifest(path, conversion, dest)
+    elif conversion == 'bin':
+        recformat.convert_csv(path, dest)
+    else:
+        header, data = recformat.read_record(path)
+        # As many digits as the stored values hold.
+        fmt = '%.{}g'.format(np.finfo(data.dtype).precision + 1)
+        with open(dest, 'w') as fp:
+            # The first line of a CSV record is skipped when it is read back.
+            fp.write(','.join(header['channels']) + '\n')
+            np.savetxt(fp, data, delimiter=',', fmt=fmt)
+    return dest
+
+
+def prepare_files(files, conversion='raw', workers=None):
+    """
+    Convert the files that need it, in a pool of processes.
+    :param files: list of (name in the archive, path)
+    :param workers: number of conversion processes, defaults to the number of CPUs
+    :return: generator of (name in the archive, path to send)
+    """
+    if not any(_needs_conversion(name, conversion) for name, _ in files):
+        yield from files
+        return
+
+    workers = workers or os.cpu_count() or 1
+    # Forking the threaded web server is unsafe, start the workers from a clean process.
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None
+    tmpdir = tempfile.mkdtemp(prefix='export_')
+    pending = collections.deque()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as pool:
+            todo = iter(enumerate(files))
+            while True:
+                # Keep the pool busy with the next conversions.
+                while len(pending) < workers * LOOKAHEAD:
+                    item = next(todo, None)
+                    if item is None:
+                        break
+                    i, (name, path) = item
+                    if _needs_conversion(name, conversion):
+                        name = _converted_name(name, conversion)
+                        dest = os.path.join(tmpdir, '{}{}'.format(i, Path(name).suffix))
+                        pending.append((name, pool.submit(convert_file, str(path), conversion, dest)))
+                    else:
+                        pending.append((name, path))
+
+                if not pending:
+                    break
+
+                name, result = pending.popleft()
+                if isinstance(result, Future):
+                    dest = Path(result.result())
+                    yield name, dest
+                    dest.unlink()
+                else:
+                    yield name, result
+    finally:
+        # The client may have gone away, drop the conversions not started yet.
+        for _, result in pending:
+            if isinstance(result, Future):
+                result.cancel()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def _read_chunks(path, size=None):
+    """
+    Read a file in large chunks, at most size bytes.
+    :return: generator of bytes
+    """
+    with open(path, 'rb') as fp:
+        remaining = size
+        while remaining is None or remaining > 0:
+            chunk = fp.read(CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def stream_tar(files):
+    """
+    Stream a tar archive.
+
+    The size of every file is taken before it is sent and exactly that many
+    bytes are sent, so a record that is still growing stays consistent.
+    :param files: iterable of (name in the archive, path)
+    :return: generator of bytes
+    """
+    for name, path in files:
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        info = tarfile.TarInfo(name)
+        info.size = stat.st_size
+        info.mtime = stat.st_mtime
+        info.mode = 0o644
+        yield info.tobuf(format=tarfile.PAX_FORMAT)
+
+        sent = 0
+        for chunk in _read_chunks(path, info.size):
+            sent += len(chunk)
+            yield chunk
+        if sent < info.size:
+            # The file was truncated while it was sent, keep the archive readable.
+            yield tarfile.NUL * (info.size - sent)
+
+        remainder = info.size % tarfile.BLOCKSIZE
+        if remainder:
+            yield tarfile.NUL * (tarfile.BLOCKSIZE - remainder)
+
+    yield tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+
+
+class _ChunkSink(object):
+    """
+    Unseekable file collecting what the zip writer writes.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.offset = 0
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def stream_zip(files):
+    """
+    Stream a zip archive, files are stored without compression.
+    :param files: iterable of (name in the archive, path)
+    :return: generator of bytes
+    """
+    sink = _ChunkSink()
+    with zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED, allowZip64=True) as zf:
+        for name, path in files:
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+
+            info = zipfile.ZipInfo(name, time.localtime(stat.st_mtime)[:6])
+            info.compress_type = zipfile.ZIP_STORED
+            with zf.open(info, 'w', force_zip64=True) as fp:
+                for chunk in _read_chunks(path):
+                    fp.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+
+    yield from sink.drain()
+
+
+def stream_archive(folder, fmt='tar', conversion='raw', workers=None):
+    """
+    Stream an archive of a folder.
+    :param fmt: 'tar' or 'zip'
+    :param conversion: 'raw', 'bin' or 'csv'
+    :return: generator of bytes
+    """
+    files = prepare_files(collect_files(folder), conversion, workers)
+    return stream_tar(files) if fmt == 'tar' else stream_zip(files)
@@ -0,0 +1,306 @@
+"""
+Background firmware flash jobs.
+
+A flash runs the programmer in a subprocess from a background thread, so the
+HTTP request that starts it returns right away with a job id. The state of
+every job is kept in files next to the firmware:
+  flash/<id>.json: state, progress and exit code of the job
+  flash/<id>.log: output of the programmer, appended as it runs
+so that any web worker can report on a job or stream its log, whichever
+process started it. Only one job runs at a time, guarded by a lock file.
+A job left RUNNING after its programmer is gone (the web worker following it
+was killed) is reported FAILED once its state has not changed for
+STALE_TIMEOUT.
+
+The SHA-256 of the last image flashed successfully is kept in flashed.json.
+Flashing the same image again is skipped unless forced.
+"""
+import hashlib
+import json
+import os
+import re
+import signal
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on windows, jobs are then only serialized within the process.
+    fcntl = None
+
+# Job states.
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+FAILED = 'FAILED'
+CANCELLED = 'CANCELLED'
+SKIPPED = 'SKIPPED'
+FINISHED_STATES = (DONE, FAILED, CANCELLED, SKIPPED)
+
+# Time given to the programmer to exit after a cancellation, before it is killed (seconds).
+CANCEL_TIMEOUT = 5.0
+
+# Time after which a running job whose programmer is gone is considered abandoned (seconds).
+# The process following the job records its end well before that.
+STALE_TIMEOUT = 10.0
+
+# Progress printed by the programmer, e.g. "[=====     ] 50%".
+_PROGRESS = re.compile(rb'(\d{1,3})\s*%')
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    SHA-256 of a file.
+    :return: hex digest
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _write_json(path, value):
+    # Write the new file next to the old one, then rename it over the old one.
+    fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix=path.name, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(value, fp)
+        os.replace(tmp, str(path))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def _process_alive(pid):
+    if os.name != 'posix':
+        # Signal 0 only probes the process on POSIX systems.
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _read_json(path):
+    try:
+        with open(path, 'r') as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class FlashJobs(object):
+    """
+    Starts flash jobs and reports on them.
+    """
+    def __init__(self, folder):
+        self.folder = Path(folder)
+        self.jobs_folder = self.folder / 'flash'
+        self.flashed_path = self.folder / 'flashed.json'
+        self.lock_path = self.folder / 'flash.lock'
+        # Serializes jobs within the process, the lock file across processes.
+        self.lock = threading.Lock()
+
+    def _job_path(self, job_id, suffix):
+        # Job ids come from clients, only accept the ones we generate.
+        if not re.fullmatch(r'[0-9a-f]{32}', job_id or ''):
+            raise KeyError(job_id)
+        return self.jobs_folder / (job_id + suffix)
+
+    def last_flashed(self):
+        """
+        Record of the last image flashed successfully.
+        :return: dict or None
+        """
+        return _read_json(self.flashed_path)
+
+    def submit(self, firmware, command, force=False):
+        """
+        Start flashing an image.
+        :param firmware: path of the image
+        :param command: programmer command line
+        :param force: flash even if the image is the one flashed last
+        :return: state dict of the new job
+        :raises ValueError: if another job is running
+        :raises FileNotFoundError: if there is no image
+        :raises RuntimeError: if the programmer cannot be started
+        """
+        digest = file_digest(firmware)
+        self.jobs_folder.mkdir(parents=True, exist_ok=True)
+
+        job_id = uuid.uuid4().hex
+        state = {'id': job_id,
+                 'status': RUNNING,
+                 'sha256': digest,
+                 'progress': 0.0,
+                 'returncode': None,
+                 'pid': None,
+                 'started': time.time(),
+                 'finished': None}
+
+        last = self.last_flashed()
+        if not force and last is not None and last.get('sha256') == digest:
+            state.update(status=SKIPPED, progress=1.0, finished=state['started'])
+            self._job_path(job_id, '.log').write_text('Image {} is already flashed, skipping.\n'.format(digest))
+            _write_json(self._job_path(job_id, '.json'), state)
+            return state
+
+        lock_fp = self._acquire()
+        if lock_fp is None:
+            raise ValueError('A flash job is already running')
+
+        log_fp = None
+        try:
+            log_fp = open(self._job_path(job_id, '.log'), 'wb')
+            # New session, so that a cancellation also stops the programmer's children.
+            proc = subprocess.Popen([str(c) for c in command], stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                    start_new_session=True)
+        except BaseException as e:
+            if log_fp is not None:
+                log_fp.close()
+            self._release(lock_fp)
+            if isinstance(e, (FileNotFoundError, PermissionError)):
+                # Raised for the programmer, not the image, which was read above.
+                raise RuntimeError('Cannot start the programmer {}: {}'.format(command[0], e))
+            raise
+
+        state['pid'] = proc.pid
+        _write_json(self._job_path(job_id, '.json'), state)
+
+        threading.Thread(target=self._run, args=(state, proc, log_fp, lock_fp), daemon=True).start()
+        return dict(state)
+
+    def _run(self, state, proc, log_fp, lock_fp):
+        """
+        Follow the programmer until it exits, keeping the log and progress up to date.
+        :return:
+        """
+        job_id = state['id']
+        try:
+            with log_fp:
+                while True:
+                    data = os.read(proc.stdout.fileno(), 4096)
+                    if not data:
+                        break
+                    log_fp.write(data)
+                    log_fp.flush()
+
+                    found = _PROGRESS.findall(data)
+                    if found:
+                        progress = min(int(found[-1]), 100) / 100.0
+                        if progress != state['progress']:
+                            state['progress'] = progress
+                            _write_json(self._job_path(job_id, '.json'), state)
+
+            returncode = proc.wait()
+            state['returncode'] = returncode
+            if self._job_path(job_id, '.cancel').exists():
+                state['status'] = CANCELLED
+            elif returncode == 0:
+                state.update(status=DONE, progress=1.0)
+                _write_json(self.flashed_path, {'sha256': state['sha256'], 'job': job_id, 'time': time.time()})
+            else:
+                state['status'] = FAILED
+        except Exception as e:
+            print("Flash job {} failed: {}".format(job_id, e))
+            state['status'] = FAILED
+        finally:
+            state['finished'] = time.time()
+            _write_json(self._job_path(job_id, '.json'), state)
+            self._release(lock_fp)
+
+    def status(self, job_id):
+        """
+        State of a job, abandoned jobs are marked FAILED.
+        :return: dict
+        :raises KeyError: if there is no such job
+        """
+        path = self._job_path(job_id, '.json')
+        state = _read_json(path)
+        if state is None:
+            raise KeyError(job_id)
+
+        if state['status'] == RUNNING and state['pid'] is not None and not _process_alive(state['pid']):
+            try:
+                stale = time.time() - os.stat(path).st_mtime > STALE_TIMEOUT
+            except FileNotFoundError:
+                stale = False
+            if stale:
+                state.update(status=FAILED, finished=time.time(), error='ABANDONED')
+                _write_json(path, state)
+        return state
+
+    def read_log(self, job_id, offset=0):
+        """
+        Output of the programmer from an offset.
+        :return: (bytes, offset of the end of the returned bytes)
+        """
+        try:
+            with open(self._job_path(job_id, '.log'), 'rb') as fp:
+                fp.seek(offset)
+                data = fp.read()
+        except FileNotFoundError:
+            raise KeyError(job_id)
+        return data, offset + len(data)
+
+    def cancel(self, job_id):
+        """
+        Stop a running job.
+        :return: state dict
+        """
+        state = self.status(job_id)
+        if state['status'] != RUNNING or state['pid'] is None:
+            return state
+
+        # The process following the job marks it cancelled when the programmer exits.
+        self._job_path(job_id, '.cancel').touch()
+        try:
+            os.killpg(state['pid'], signal.SIGTERM)
+        except ProcessLookupError:
+            return state
+
+        def kill_later():
+            time.sleep(CANCEL_TIMEOUT)
+            if self.status(job_id)['status'] != RUNNING:
+                return
+            try:
+                os.killpg(state['pid'], signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+        threading.Thread(target=kill_later, daemon=True).start()
+
+        return state
+
+    def _acquire(self):
+        """
+        Take the flash lock without waiting.
+        :return: lock handle, or None if a job is running
+        """
+        if not self.lock.acquire(blocking=False):
+            return None
+        if fcntl is None:
+            return True
+
+        fp = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            fp.close()
+            self.lock.release()
+            return None
+        return fp
+
+    def _release(self, lock_fp):
+        if lock_fp is not True:
+            fcntl.flock(lock_fp.fileno(), fcntl.LOCK_UN)
+            lock_fp.close()
+        self.lock.release()
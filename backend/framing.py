@@ -0,0 +1,341 @@
+"""
+Split the serial byte stream into frames and decode them into sample arrays.
+
+Two framings are supported:
+  csv: one sample per line, values separated by commas.
+  msgpack: every frame is a little-endian uint16 length followed by a msgpack
+           encoded array of numbers.
+
+Decoders are fed the raw bytes as they are read and return a 2D array with
+one row per complete, valid frame. The number of channels is fixed by the
+first valid frame; frames with a different number of values are dropped.
+
+The same link carries commands to the micro-controller, encoded with the
+framing of the stream, and their acknowledgements back, mixed with the
+samples:
+  csv: '#<seq> SET <name>=<value>;<name>=<value>' lines, acknowledged by
+       '#<seq> OK' or '#<seq> ERR <reason>' lines.
+  msgpack: {'seq': <seq>, 'set': {<name>: <value>}} maps, acknowledged by
+           {'ack': <seq>, 'ok': <bool>, 'error': <reason>} maps.
+Decoders set acknowledgements aside, see FrameDecoder.pop_acks, and
+ControlLineFilter removes them from raw CSV recordings.
+"""
+import struct
+
+import msgpack
+import numpy as np
+
+_MSGPACK_LENGTH = struct.Struct('<H')
+
+# First byte of a msgpack array: fixarray, array 16 or array 32.
+_MSGPACK_ARRAY = set(range(0x90, 0xa0)) | {0xdc, 0xdd}
+
+# First byte of a msgpack map (acknowledgements): fixmap, map 16 or map 32.
+_MSGPACK_MAP = set(range(0x80, 0x90)) | {0xde, 0xdf}
+
+# Lines starting with this are commands or acknowledgements in the CSV framing.
+CONTROL_PREFIX = b'#'
+
+# Characters structuring a '#<seq> SET name=value;...' line, not allowed in parameter names and values.
+COMMAND_SEPARATORS = '=;#\n\r'
+
+# Frames longer than this are considered corrupted (bytes).
+MAX_FRAME_LENGTH = 1024
+
+
+class FrameDecoder(object):
+    """
+    Base class of the decoders, keeps the counters.
+    """
+    def __init__(self):
+        # Number of valid frames decoded.
+        self.frames = 0
+        # Number of frames that could not be parsed.
+        self.malformed = 0
+        # Number of frames dropped because they do not have the expected number of values.
+        self.dropped = 0
+        # Number of values per frame, set by the first valid frame.
+        self.width = None
+        # Acknowledgements received since the last call to pop_acks.
+        self.acks = []
+
+    def feed(self, data):
+        """
+        Decode received bytes.
+        :param data: raw bytes read from the serial port
+        :return: 2D float array with one row per decoded frame, or None
+        """
+        raise NotImplementedError
+
+    def pop_acks(self):
+        """
+        Acknowledgements of commands received with the samples.
+        :return: list of dicts with 'seq', 'ok' and 'error'
+        """
+        acks, self.acks = self.acks, []
+        return acks
+
+    def counters(self):
+        return {'frames': self.frames,
+                'malformed': self.malformed,
+                'dropped': self.dropped}
+
+    def _rows_to_block(self, rows):
+        """
+        Keep the rows with the expected width and stack them into an array.
+        :return: 2D float array or None
+        """
+        if not rows:
+            return None
+
+        if self.width is None:
+            self.width = len(rows[0])
+
+        good = [r for r in rows if len(r) == self.width]
+        self.dropped += len(rows) - len(good)
+        if not good:
+            return None
+
+        self.frames += len(good)
+        return np.asarray(good, dtype=np.float64)
+
+
+class CsvFrameDecoder(FrameDecoder):
+    """
+    Newline delimited, comma separated frames.
+
+    Complete lines are parsed in one go: lines with the expected number of
+    separators are joined and converted to floats by numpy. Only if that fails
+    are the lines parsed one by one to isolate the corrupted ones.
+    """
+    def __init__(self, skip_first_line=True):
+        super(CsvFrameDecoder, self).__init__()
+        # Incomplete line carried over between two serial reads.
+        self.partial = b''
+        # The first line received is usually cut in half, so it is dropped.
+        self.skip_first_line = skip_first_line
+
+    def feed(self, data):
+        lines = (self.partial + data).split(b'\n')
+        # The last element is either empty or an incomplete line.
+        self.partial = lines.pop()
+
+        if self.skip_first_line and lines:
+            lines = lines[1:]
+            self.skip_first_line = False
+
+        if any(l.startswith(CONTROL_PREFIX) for l in lines):
+            for line in lines:
+                if line.startswith(CONTROL_PREFIX):
+                    ack = parse_ack_line(line)
+                    if ack is None:
+                        self.malformed += 1
+                    else:
+                        self.acks.append(ack)
+            lines = [l for l in lines if not l.startswith(CONTROL_PREFIX)]
+
+        lines = [l for l in lines if l.strip()]
+        if not lines:
+            return None
+
+        if self.width is None:
+            self.width = self._first_width(lines)
+            if self.width is None:
+                self.malformed += len(lines)
+                return None
+
+        # Keep the lines with the expected number of values.
+        commas = self.width - 1
+        good = [l for l in lines if l.count(b',') == commas]
+        self.dropped += len(lines) - len(good)
+        if not good:
+            return None
+
+        try:
+            block = np.array(b','.join(good).split(b','), dtype=np.bytes_).astype(np.float64)
+            block = block.reshape(len(good), self.width)
+        except ValueError:
+            # At least one corrupted line, parse them one by one.
+            rows = []
+            for line in good:
+                try:
+                    rows.append([float(v) for v in line.split(b',')])
+                except ValueError:
+                    self.malformed += 1
+            if not rows:
+                return None
+            block = np.asarray(rows, dtype=np.float64)
+
+        self.frames += block.shape[0]
+        return block
+
+    def _first_width(self, lines):
+        """
+        Number of values in the first line that parses.
+        :return: int or None
+        """
+        for line in lines:
+            try:
+                return len([float(v) for v in line.split(b',')])
+            except ValueError:
+                continue
+        return None
+
+
+class ControlLineFilter(object):
+    """
+    Removes control lines from the raw CSV stream, keeping every other byte as is.
+
+    Raw recordings are the bytes read from the serial port, which also carry
+    the acknowledgements of commands. Lines can be split across reads, so the
+    filter remembers whether the stream is at the start of a line or in the
+    middle of a control line.
+    """
+    def __init__(self):
+        # Raw recordings start in the middle of a line.
+        self.line_start = False
+        # In a control line, until its newline.
+        self.dropping = False
+
+    def feed(self, data):
+        """
+        :param data: raw bytes read from the serial port
+        :return: bytes without the control lines
+        """
+        if not self.dropping and CONTROL_PREFIX not in data:
+            if data:
+                self.line_start = data.endswith(b'\n')
+            return data
+
+        lines = data.split(b'\n')
+        pieces = [l + b'\n' for l in lines[:-1]] + ([lines[-1]] if lines[-1] else [])
+        kept = []
+        for piece in pieces:
+            ends = piece.endswith(b'\n')
+            if self.dropping or (self.line_start and piece.startswith(CONTROL_PREFIX)):
+                self.dropping = not ends
+            else:
+                kept.append(piece)
+            self.line_start = ends
+        return b''.join(kept)
+
+
+class MsgpackFrameDecoder(FrameDecoder):
+    """
+    Length prefixed msgpack frames.
+
+    When a length is out of range or a frame does not decode, the decoder
+    skips one byte and tries again, so it resynchronizes on the next frame.
+    """
+    def __init__(self, max_frame_length=MAX_FRAME_LENGTH):
+        super(MsgpackFrameDecoder, self).__init__()
+        self.buffer = b''
+        self.max_frame_length = max_frame_length
+
+    def feed(self, data):
+        buf = self.buffer + data
+        pos = 0
+        rows = []
+
+        while len(buf) - pos > _MSGPACK_LENGTH.size:
+            length, = _MSGPACK_LENGTH.unpack_from(buf, pos)
+
+            first = buf[pos + _MSGPACK_LENGTH.size]
+            if length == 0 or length > self.max_frame_length or \
+                    (first not in _MSGPACK_ARRAY and first not in _MSGPACK_MAP):
+                # Lost synchronization, slide by one byte.
+                self.malformed += 1
+                pos += 1
+                continue
+
+            end = pos + _MSGPACK_LENGTH.size + length
+            if end > len(buf):
+                # Wait for the rest of the frame.
+                break
+
+            try:
+                values = msgpack.unpackb(buf[pos + _MSGPACK_LENGTH.size:end])
+                if isinstance(values, dict):
+                    ack = {'seq': int(values['ack']), 'ok': bool(values.get('ok', True)),
+                           'error': values.get('error')}
+                else:
+                    row = [float(v) for v in values]
+            except Exception:
+                self.malformed += 1
+                pos += 1
+                continue
+
+            if isinstance(values, dict):
+                self.acks.append(ack)
+            else:
+                rows.append(row)
+            pos = end
+
+        self.buffer = buf[pos:]
+        return self._rows_to_block(rows)
+
+
+def encode_msgpack_frame(values):
+    """
+    Encode one sample as a length prefixed msgpack frame.
+    :return: bytes
+    """
+    packed = msgpack.packb(list(values))
+    return _MSGPACK_LENGTH.pack(len(packed)) + packed
+
+
+def parse_ack_line(line):
+    """
+    Parse a '#<seq> OK' or '#<seq> ERR <reason>' line.
+    :return: dict with 'seq', 'ok' and 'error', or None if the line is not an acknowledgement
+    """
+    parts = line[len(CONTROL_PREFIX):].strip().split(None, 2)
+    if len(parts) < 2 or not parts[0].isdigit() or parts[1] not in (b'OK', b'ERR'):
+        return None
+    ok = parts[1] == b'OK'
+    error = None if ok else (parts[2].decode(errors='replace') if len(parts) > 2 else 'ERR')
+    return {'seq': int(parts[0]), 'ok': ok, 'error': error}
+
+
+def check_param(name, value):
+    """
+    Check that a parameter can be sent in a command line without changing its meaning.
+    :raises ValueError: if the name or the value holds a separator
+    """
+    if any(c in str(name) for c in COMMAND_SEPARATORS):
+        raise ValueError('Invalid parameter name {!r}'.format(name))
+    if any(c in str(value) for c in COMMAND_SEPARATORS):
+        raise ValueError('Invalid value for {}'.format(name))
+
+
+def encode_command(seq, params, framing='csv'):
+    """
+    Encode a command setting parameters of the micro-controller.
+    :param seq: sequence number, echoed by the acknowledgement
+    :param params: dict of parameter name to value
+    :return: bytes
+    """
+    if framing == 'msgpack':
+        packed = msgpack.packb({'seq': seq, 'set': dict(params)})
+        return _MSGPACK_LENGTH.pack(len(packed)) + packed
+    elif framing == 'csv':
+        for name, value in params.items():
+            check_param(name, value)
+        fields = ';'.join('{}={}'.format(name, value) for name, value in params.items())
+        return '#{} SET {}\n'.format(seq, fields).encode()
+    else:
+        raise ValueError('Unknown framing {}'.format(framing))
+
+
+def make_decoder(framing='csv'):
+    """
+    Get a decoder for a framing.
+    :param framing: 'csv' or 'msgpack'
+    :return: FrameDecoder
+    """
+    if framing == 'csv':
+        return CsvFrameDecoder()
+    elif framing == 'msgpack':
+        return MsgpackFrameDecoder()
+    else:
+        raise ValueError('Unknown framing {}'.format(framing))
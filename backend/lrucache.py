@@ -0,0 +1,80 @@
+"""
+Size-bounded LRU cache, for parsed records and serialized responses.
+
+Every entry is stored with its size in bytes (given by the caller, e.g.
+len() of a response body or nbytes of an array). Once the entries add up to
+more than max_bytes, the least recently used ones are evicted. Entries
+larger than max_item_bytes are not cached, so a single large record cannot
+flush everything else.
+"""
+import collections
+import threading
+
+
+class LRUCache(object):
+    """
+    Thread-safe LRU cache bounded by the total size of its entries.
+    """
+    def __init__(self, max_bytes, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_bytes // 4 if max_item_bytes is None else max_item_bytes
+        # key -> (value, size), least recently used first.
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Get an entry, making it the most recently used one.
+        :return: value or default
+        """
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size):
+        """
+        Add an entry, evicting the least recently used ones to make room.
+        :param size: size of the value in bytes
+        :return: True if the value was cached
+        """
+        if size > self.max_item_bytes:
+            return False
+
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.bytes -= evicted
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """
+        :return: dict with the size, number of entries and counters of the cache
+        """
+        with self.lock:
+            return {'bytes': self.bytes,
+                    'max_bytes': self.max_bytes,
+                    'items': len(self.entries),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
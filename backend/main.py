@@ -1,6 +1,8 @@
+# Imported first to time the rest of the start up.
+import startup
 import time
 
-from flask import Flask, jsonify, request, flash, redirect, url_for
+from flask import Flask, jsonify, request, flash, redirect, url_for, Response, stream_with_context, g
 from flask_cors import CORS, cross_origin
 import json
 import os
@@ -8,12 +10,31 @@ from pathlib import Path
 import sys
 sys.path.append("/home/pi/Documents/exo_gui_flask_v2")
 import utils
-import toml
 from werkzeug.utils import secure_filename
-import subprocess
+import gzip
+import zlib
 import logging
 import string
-import pandas as pd
+import numpy as np
+import recformat
+import records
+import decimate
+import configstore
+import metrics
+import catalog
+import recorderd
+import flashjobs
+import discovery
+import export
+import stats
+import segments
+import cohort
+import pipeline
+import framing as framing_module
+import lrucache
+from datetime import datetime, timezone
+
+startup.mark('imports')
 
 # GLOBAL VARS
 # ------------
@@ -21,23 +42,67 @@ import pandas as pd
 
 logging.getLogger('flask_cors').level = logging.DEBUG
 
-# Data recording thread
-DATARECTHREAD = None
+
+# Number of samples sent back for the live plot.
+PLOT_WINDOW = 980
+
+# Minimum time between two frames of the live stream (seconds).
+STREAM_INTERVAL = 0.05
+
+# Time without data after which a keep-alive is sent on the live stream (seconds).
+STREAM_KEEPALIVE = 5.0
+
+# Responses of endpoints under these paths are gzipped when the client accepts it...
+COMPRESSED_PREFIXES = ('/data/',)
+# ...if they are at least this large (bytes).
+COMPRESSION_MIN_SIZE = 1024
+# gzip level of responses, favours speed over ratio.
+COMPRESSION_LEVEL = 1
+# Responses never compressed: archives hold data that is often compressed already.
+UNCOMPRESSED_MIMETYPES = tuple(export.MIMETYPES.values())
+
+# Memory used by the caches of parsed records and record responses (bytes), can be
+# set in MB with the EXO_CACHE_MB environment variable. Every web worker process
+# (EXO_WEB_WORKERS) has its own cache, they share this budget.
+CACHE_BYTES = int(float(os.environ.get('EXO_CACHE_MB', 32)) * 1024 * 1024) // \
+    max(1, int(os.environ.get('EXO_WEB_WORKERS', 1)))
+
+# Parsed records and serialized record responses, least recently used evicted first.
+CACHE = lrucache.LRUCache(CACHE_BYTES)
 
 # Specify the working directory
 # If we're on macos, use the Home directory
-if sys.platform == 'darwin':
-    WORKINGDIR = Path.home()
-else:
-    WORKINGDIR = Path('/data')
+WORKINGDIR = utils.working_dir()
 
 # Path to configuration file.
 CONFIGPATH = WORKINGDIR / '.exoskeleton' / 'config.toml'
 
+# Cached settings from the configuration file.
+CONFIG = configstore.ConfigStore(CONFIGPATH)
+
+# Index of the recorded data.
+CATALOG = catalog.Catalog(WORKINGDIR / 'EXPDATA', WORKINGDIR / '.exoskeleton' / 'catalog.sqlite')
+
+# Data recording threads, by id. In production mode the recorders run in their
+# own process (see recorderd.py) and are reached through a local socket.
+if os.environ.get('EXO_RECORDER_SOCKET'):
+    RECORDERS = recorderd.RecorderClient(os.environ['EXO_RECORDER_SOCKET'])
+else:
+    RECORDERS = utils.RecorderManager(on_finish=lambda rec: CATALOG.update_path(rec.logfile))
+
 # Path to the location of binary firmware file for programming micro-controller.
 FIRMWAREPATH = WORKINGDIR / '.exoskeleton' / 'firmware.bin'
 ALLOWED_EXTENSIONS = {'bin'}
 
+# Cached serial ports and programmer probe.
+HARDWARE = discovery.HardwareDiscovery()
+
+# Background firmware flash jobs.
+FLASH_JOBS = flashjobs.FlashJobs(FIRMWAREPATH.parent)
+
+# Time between two polls of a flash job's log while streaming it (seconds).
+FLASH_POLL_INTERVAL = 0.2
+
 
 # Set up the app.
 app = Flask(__name__)
@@ -49,6 +114,248 @@ app.config['PYSTLINK'] = Path.home() / 'Documents' / 'pystlink' / 'pystlink.py'
 app.config['DATAPATH'] = WORKINGDIR
 
 
+# Request latency instrumentation
+@app.before_request
+def start_request_timer():
+    g.request_start = time.time()
+
+
+@app.after_request
+def record_request_time(response):
+    start = getattr(g, 'request_start', None)
+    if start is not None:
+        endpoint = request.url_rule.rule if request.url_rule is not None else 'unknown'
+        metrics.HTTP_REQUEST_SECONDS.observe(time.time() - start,
+                                             endpoint=endpoint,
+                                             method=request.method,
+                                             status=response.status_code)
+    return response
+
+
+def gzip_stream(chunks):
+    """
+    Gzip a streamed response chunk by chunk, flushing after every chunk so the
+    client keeps receiving data as it is produced.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Gzip the responses of the data endpoints when the client accepts it.
+    """
+    if not request.path.startswith(COMPRESSED_PREFIXES) or \
+            'gzip' not in request.headers.get('Accept-Encoding', '').lower() or \
+            'Content-Encoding' in response.headers or \
+            response.direct_passthrough or \
+            response.mimetype in UNCOMPRESSED_MIMETYPES or \
+            response.status_code != 200:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if response.is_streamed:
+        response.response = gzip_stream(response.iter_encoded())
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < COMPRESSION_MIN_SIZE:
+            return response
+        response.set_data(gzip.compress(data, COMPRESSION_LEVEL))
+
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@app.after_request
+def conditional_response(response):
+    """
+    Let clients revalidate the data endpoints: add an ETag from the content
+    and answer 304 when the client's copy is current. Runs before
+    compress_response, so ETags are computed on the plain content.
+    """
+    if request.method != 'GET' or not request.path.startswith(COMPRESSED_PREFIXES) or \
+            response.status_code != 200 or response.is_streamed or \
+            response.mimetype in UNCOMPRESSED_MIMETYPES:
+        return response
+
+    # Endpoints setting their own validators (records) answer conditional requests themselves.
+    if 'ETag' in response.headers:
+        return response
+
+    # Weak, the content may be compressed on the way.
+    response.add_etag(weak=True)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def record_etag(signature):
+    """
+    ETag of a record from its modification time and size.
+    :return: str
+    """
+    mtime, size = signature
+    return '{:x}-{:x}'.format(int(mtime * 1e9), size)
+
+
+def add_validators(response, signature):
+    """
+    Add the ETag and Last-Modified headers of a record to a response.
+    :return: response
+    """
+    response.set_etag(record_etag(signature), weak=True)
+    response.last_modified = datetime.fromtimestamp(int(signature[0]), timezone.utc)
+    # Cached copies are revalidated on every use.
+    response.cache_control.no_cache = True
+    return response
+
+
+def record_not_modified(signature):
+    """
+    Check the conditional headers of the request against a record.
+    :return: 304 response if the client's copy is current, None otherwise
+    """
+    if request.if_none_match:
+        fresh = request.if_none_match.contains_weak(record_etag(signature))
+    elif request.if_modified_since:
+        # Last-Modified has a one second resolution, a record still being written may have changed since.
+        fresh = int(signature[0]) <= request.if_modified_since.timestamp() and time.time() - signature[0] > 1.0
+    else:
+        fresh = False
+
+    return add_validators(Response(status=304), signature) if fresh else None
+
+
+def is_recording(record_file):
+    """
+    Check whether a record is still being written by a recorder.
+    :return: bool
+    """
+    return any(status['status'] == 'RECORDING' and Path(status['file']) == Path(record_file)
+               for status in RECORDERS.statuses())
+
+
+def parsed_record(record_file, signature):
+    """
+    Whole parsed record, kept in CACHE.
+
+    Records too large for the cache are not kept, nor are records still being
+    written: their signature changes with every write.
+    :return: (column names, 2D array, sample period) or None if the record is not cached
+    """
+    key = ('parsed', str(record_file), signature)
+    parsed = CACHE.get(key)
+    if parsed is None:
+        if is_recording(record_file):
+            return None
+        info = records.record_info(record_file)
+        if info['samples'] * info['channels'] * 8 > CACHE.max_item_bytes:
+            # Remember it, so that the record is not counted again.
+            CACHE.put(key, (), 64)
+            return None
+        columns, data = records.read_all(record_file)
+        parsed = (columns, data, info['sample_period'])
+        CACHE.put(key, parsed, data.nbytes)
+
+    return parsed or None
+
+
+def read_rows(record_file, signature, start=0, stop=None, channels=None):
+    """
+    Read a range of rows of a record, from the parsed record in CACHE if it can be kept there.
+
+    Other records are read range by range.
+    :return: (column names, 2D array)
+    """
+    parsed = parsed_record(record_file, signature)
+    if parsed is None:
+        return records.read_all(record_file, start, stop, channels)
+
+    columns, data, _ = parsed
+    idx = records.select_columns(columns, channels)
+    data = data[start:stop]
+    if idx is not None:
+        columns = [columns[i] for i in idx]
+        data = data[:, idx]
+    return columns, data
+
+
+@metrics.register_collector
+def recorder_metrics():
+    """
+    State of the recorders, read at scrape time.
+    :return:
+    """
+    samples = {}
+
+    def add(name, kind, help_text, labels, value):
+        samples.setdefault((name, kind, help_text), []).append((labels, value))
+
+    for status in RECORDERS.statuses():
+        labels = {'id': status['id'], 'port': status['port']}
+        counters = status['frames']
+
+        add('exo_recorder_running', 'gauge', 'Whether the recorder is running.',
+            labels, 1 if status['status'] == 'RECORDING' else 0)
+        add('exo_recorder_bytes_total', 'counter', 'Bytes received from the serial port.',
+            labels, status['bytes'])
+        add('exo_recorder_frames_total', 'counter', 'Frames decoded.',
+            labels, counters['frames'])
+        add('exo_recorder_malformed_frames_total', 'counter', 'Frames that could not be parsed.',
+            labels, counters['malformed'])
+        add('exo_recorder_dropped_frames_total', 'counter', 'Frames dropped because of a wrong number of values.',
+            labels, counters['dropped'])
+        add('exo_recorder_ingest_bytes_per_second', 'gauge', 'Bytes received per second.',
+            labels, status['bytes_rate'])
+        add('exo_recorder_ingest_frames_per_second', 'gauge', 'Frames decoded per second.',
+            labels, status['frames_rate'])
+        add('exo_recorder_serial_buffer_bytes', 'gauge', 'Bytes waiting in the serial input buffer after the last read.',
+            labels, status['serial_backlog'])
+        add('exo_recorder_writer_queue_chunks', 'gauge', 'Chunks waiting to be written to disk.',
+            labels, status['writer_queue'])
+        add('exo_recorder_stream_clients', 'gauge', 'Live stream clients.',
+            labels, status['stream_clients'])
+        add('exo_recorder_stage_seconds_total', 'counter', 'Time spent computing derived channels.',
+            labels, status['stage_seconds'])
+        add('exo_recorder_stream_dropped_samples', 'gauge', 'Samples dropped for slow live stream clients.',
+            labels, status['stream_dropped'])
+
+    return [(name, kind, help_text, values) for (name, kind, help_text), values in samples.items()]
+
+
+@metrics.register_collector
+def cache_metrics():
+    stats = CACHE.stats()
+    return [('exo_cache_bytes', 'gauge', 'Memory used by the record cache.', [({}, stats['bytes'])]),
+            ('exo_cache_items', 'gauge', 'Entries in the record cache.', [({}, stats['items'])]),
+            ('exo_cache_hits_total', 'counter', 'Record cache hits.', [({}, stats['hits'])]),
+            ('exo_cache_misses_total', 'counter', 'Record cache misses.', [({}, stats['misses'])]),
+            ('exo_cache_evictions_total', 'counter', 'Entries evicted from the record cache.',
+             [({}, stats['evictions'])])]
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """
+    Metrics in the Prometheus text format.
+
+    In production mode, the record writers run in the recorder process, which
+    renders their metrics. HTTP metrics are those of the worker answering.
+    :return:
+    """
+    if isinstance(RECORDERS, recorderd.RecorderClient):
+        text = metrics.render(exclude=metrics.RECORDER_METRICS) + RECORDERS.metrics()
+    else:
+        text = metrics.render()
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
+
 # Endpoints to handle settings and other parameters
 @app.route('/settings/serial', methods=['GET', 'POST'])
 def settings_serial():
@@ -57,32 +364,26 @@ def settings_serial():
     :return:
     """
     if request.method == 'GET':
-        with open(CONFIGPATH, 'r') as fp:
-            settings_dict = toml.load(fp)
-
         response = {'endpoint': request.path,
-                    'response': settings_dict['serial']}
+                    'response': CONFIG.get('serial')}
 
         return jsonify(response)
     elif request.method == 'POST':
-        with open(CONFIGPATH, 'r') as fp:
-            current_settings = toml.load(fp)
-
         request_data = request.get_json()
 
         port = request_data.get('port')
         baud = request_data.get('baud')
 
         if request_data:
-            if port:
-                current_settings['serial']['port'] = port
-            if baud:
-                current_settings['serial']['baud'] = baud
+            def apply(settings):
+                if port:
+                    settings['serial']['port'] = port
+                if baud:
+                    settings['serial']['baud'] = baud
 
-            with open(CONFIGPATH, 'w') as fp:
-                toml.dump(current_settings, fp)
+            current_settings = CONFIG.update(apply)
         else:
-            pass
+            current_settings = CONFIG.get()
 
         response = {'endpoint': request.path,
                     'response': current_settings['serial']}
@@ -90,66 +391,121 @@ def settings_serial():
         return jsonify(response)
 
 
+def settings_params(settings):
+    """
+    Parameters to send to the micro-controller from control or assistance settings.
+    :param settings: list of {'name', 'value'} dicts or dict of name to value
+    :return: dict of parameter name to value
+    :raises ValueError: if the settings are malformed
+    """
+    if isinstance(settings, dict):
+        items = list(settings.items())
+    elif isinstance(settings, list) and all(isinstance(i, dict) and 'name' in i and 'value' in i
+                                            for i in settings):
+        items = [(i['name'], i['value']) for i in settings]
+    else:
+        raise ValueError('Settings must be a list of {"name": ..., "value": ...} objects')
+
+    for name, value in items:
+        if not isinstance(name, str) or not name:
+            raise ValueError('Invalid parameter name {!r}'.format(name))
+        if value is None or not isinstance(value, (bool, int, float, str)):
+            raise ValueError('Invalid value for {}'.format(name))
+        # Also checked when encoding, but the settings must be rejected before they are saved.
+        framing_module.check_param(name, value)
+    return dict(items)
+
+
+def push_settings(settings, recorder_id=utils.RecorderManager.DEFAULT_ID):
+    """
+    Send settings to the micro-controller, through the running recorder if it holds the port.
+    :param settings: list of {'name', 'value'} dicts or dict of name to value
+    :param recorder_id: recorder whose port is used while it records, it may have been started on another port
+    :return: dict with 'acked', 'ok', 'error' and 'latency'
+    """
+    params = settings_params(settings)
+
+    serial_settings = CONFIG.get('serial')
+    port = serial_settings['port']
+    status = RECORDERS.status(recorder_id)
+    if status is not None and status['status'] == 'RECORDING':
+        port = status['port']
+    try:
+        return RECORDERS.send_settings(port, serial_settings['baud'], params,
+                                       serial_settings.get('framing', 'csv'))
+    except (OSError, ValueError, RuntimeError) as e:
+        # The port cannot be opened, e.g. the exoskeleton is not connected.
+        return {'acked': False, 'ok': False, 'error': str(e), 'latency': None}
+
+
 @app.route('/settings/control', methods=['GET', 'POST'])
 def settings_control():
     """
-    Get control parameter settings
+    Get or set control parameter settings.
+
+    New settings are saved and sent to the micro-controller, the result of
+    sending them is in 'push'. While recorder 'id' (default: 'default')
+    records, they are sent on its port.
     :return:
     """
     if request.method == 'GET':
-        with open(CONFIGPATH, 'r') as fp:
-            settings_dict = toml.load(fp)
         response = {'endpoint': request.path,
-                    'response': settings_dict['control']}
+                    'response': CONFIG.get('control')}
         return jsonify(response)
     elif request.method == 'POST':
-        with open(CONFIGPATH, 'r') as fp:
-            current_settings = toml.load(fp)
-
         request_data = request.get_json()
         if request_data:
-            current_settings['control'] = request_data
-
-            with open(CONFIGPATH, 'w') as fp:
-                toml.dump(current_settings, fp)
-
+            try:
+                settings_params(request_data)
+            except ValueError as e:
+                return jsonify({'endpoint': request.path, 'error': 'INVALID SETTINGS', 'reason': str(e)}), 400
+            current_settings = CONFIG.set('control', request_data)
         else:
-            pass
+            current_settings = CONFIG.get()
 
         response = {'endpoint': request.path,
                     'response': current_settings['control']}
 
+        # Apply the new settings right away, unless ?push=0
+        if request_data and request.args.get('push', '1') != '0':
+            response['push'] = push_settings(current_settings['control'],
+                                             request.args.get('id', utils.RecorderManager.DEFAULT_ID))
+
         return jsonify(response)
 
 @app.route('/settings/assistance', methods=['GET', 'POST'])
 def settings_assistance():
     """
-    Get control parameter settings
+    Get or set assistance parameter settings.
+
+    New settings are saved and sent to the micro-controller, the result of
+    sending them is in 'push'. While recorder 'id' (default: 'default')
+    records, they are sent on its port.
     :return:
     """
     if request.method == 'GET':
-        with open(CONFIGPATH, 'r') as fp:
-            settings_dict = toml.load(fp)
         response = {'endpoint': request.path,
-                    'response': settings_dict['assistance']}
+                    'response': CONFIG.get('assistance')}
         return jsonify(response)
     elif request.method == 'POST':
-        with open(CONFIGPATH, 'r') as fp:
-            current_settings = toml.load(fp)
-
         request_data = request.get_json()
         if request_data:
-            current_settings['assistance'] = request_data
-
-            with open(CONFIGPATH, 'w') as fp:
-                toml.dump(current_settings, fp)
-
+            try:
+                settings_params(request_data)
+            except ValueError as e:
+                return jsonify({'endpoint': request.path, 'error': 'INVALID SETTINGS', 'reason': str(e)}), 400
+            current_settings = CONFIG.set('assistance', request_data)
         else:
-            pass
+            current_settings = CONFIG.get()
 
         response = {'endpoint': request.path,
                     'response': current_settings['assistance']}
 
+        # Apply the new settings right away, unless ?push=0
+        if request_data and request.args.get('push', '1') != '0':
+            response['push'] = push_settings(current_settings['assistance'],
+                                             request.args.get('id', utils.RecorderManager.DEFAULT_ID))
+
         return jsonify(response)
 
 
@@ -193,45 +549,129 @@ def upload_new_firmware():
 def microcontroller_info():
     """
     Get information about the micro-controller on board the exoskeleton.
+
+    The probe is cached, see discovery.HardwareDiscovery.
     :return:
     """
-    output = subprocess.run(['st-info', '--probe'],
-                            capture_output=True)
-
-    all_output = (output.stdout + output.stderr).decode('utf-8')
+    infodict = HARDWARE.programmer()
 
-    if all_output == 'Found 0 stlink programmers':
+    if infodict is None:
         return jsonify({'endpoint': request.path, 'error': 'PROGRAMMER DISCONNECTED'})
     else:
-        oplines = all_output.split('\n')
-
-        MCU = ''
-        infodict = {}
-        for l in oplines:
-            if ':' in l:
-                infodict[l[:l.find(':')].strip()] =  l[l.find(':')+1:].strip()
-
         return jsonify({'endpoint': request.path, 'info': infodict})
 
 
 @app.route('/microcontroller/reflash', methods=['POST'])
 def reflash_firmware():
     """
-    Re-flash firmware of the microcontroller.
+    Start re-flashing the firmware of the microcontroller.
+
+    The flash runs in the background, the response holds the id of the job to
+    follow with the endpoints below. If the uploaded image is the one flashed
+    last, nothing is done unless 'force' is set.
     :return:
     """
+    args = request.get_json(silent=True) or {}
+    force = bool(args.get('force', request.args.get('force', type=int)))
+
     firmware_file = app.config['UPLOAD_FOLDER'] / 'firmware.bin'
-    # output = subprocess.run(['st-flash', '--connect-under-reset', 'write', str(firmware_file), '0x8000000'],
-    #                         capture_output=True)
-    output = subprocess.run(['python3',
-                             app.config['PYSTLINK'],
-                             'flash:erase',
-                             'flash:verify:0x8000000:'+str(firmware_file)],
-                             capture_output=True)
-    all_output = output.stdout + output.stderr
+    # command = ['st-flash', '--connect-under-reset', 'write', str(firmware_file), '0x8000000']
+    command = ['python3',
+               app.config['PYSTLINK'],
+               'flash:erase',
+               'flash:verify:0x8000000:'+str(firmware_file)]
+
+    try:
+        job = FLASH_JOBS.submit(firmware_file, command, force=force)
+    except FileNotFoundError:
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'NO FIRMWARE'})
+    except ValueError:
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'FLASH IN PROGRESS'})
+    except RuntimeError as e:
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'PROGRAMMER NOT FOUND',
+                        'reason': str(e)})
+
+    return jsonify({'endpoint': request.path, 'job': job['id'], 'status': job['status'], 'sha256': job['sha256']})
+
+
+@app.route('/microcontroller/reflash/<job_id>', methods=['GET'])
+def reflash_status(job_id):
+    """
+    State of a flash job, with the programmer output so far.
+    :return:
+    """
+    try:
+        job = FLASH_JOBS.status(job_id)
+        output, _ = FLASH_JOBS.read_log(job_id)
+    except KeyError:
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'UNKNOWN JOB'})
 
     return jsonify({'endpoint': request.path,
-                    'output': all_output.decode('utf-8')})
+                    'job': job_id,
+                    'status': job['status'],
+                    'progress': job['progress'],
+                    'returncode': job['returncode'],
+                    'sha256': job['sha256'],
+                    'output': output.decode('utf-8', errors='replace')})
+
+
+@app.route('/microcontroller/reflash/<job_id>/stream', methods=['GET'])
+def reflash_stream(job_id):
+    """
+    Stream the progress and output of a flash job as server-sent events.
+
+    Events carry the new output and the progress, an 'end' event carries
+    the final state.
+    :return:
+    """
+    try:
+        FLASH_JOBS.status(job_id)
+    except KeyError:
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'UNKNOWN JOB'})
+
+    def generate():
+        offset = 0
+        last_sent = time.time()
+        while True:
+            job = FLASH_JOBS.status(job_id)
+            output, offset = FLASH_JOBS.read_log(job_id, offset)
+
+            if output:
+                frame = {'output': output.decode('utf-8', errors='replace'), 'progress': job['progress']}
+                yield 'data: {}\n\n'.format(json.dumps(frame))
+                last_sent = time.time()
+
+            # The state is read before the log, so the log is complete once the job is over.
+            if job['status'] in flashjobs.FINISHED_STATES:
+                frame = {'status': job['status'], 'progress': job['progress'], 'returncode': job['returncode']}
+                yield 'event: end\ndata: {}\n\n'.format(json.dumps(frame))
+                return
+
+            if time.time() - last_sent > STREAM_KEEPALIVE:
+                # Keep the connection open through proxies.
+                yield ': keep-alive\n\n'
+                last_sent = time.time()
+
+            time.sleep(FLASH_POLL_INTERVAL)
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
+@app.route('/microcontroller/reflash/<job_id>/cancel', methods=['POST'])
+def reflash_cancel(job_id):
+    """
+    Cancel a running flash job.
+    :return:
+    """
+    try:
+        job = FLASH_JOBS.cancel(job_id)
+    except KeyError:
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'UNKNOWN JOB'})
+
+    return jsonify({'endpoint': request.path, 'job': job_id, 'status': job['status']})
 
 ## Experimental Data Recording Endpoints
 # Get a list of appropriate serial ports
@@ -239,20 +679,14 @@ def reflash_firmware():
 def ports():
     """
     Handle a ports request.
+
+    'response' lists the device paths, 'ports' adds their description and
+    USB ids. The list is cached, see discovery.HardwareDiscovery.
     :return:
     """
-    # Use a closure to filter out devices
-    def filter_dev(dev_: str):
-        dev = dev_.lower()
-        if ('cu' in dev.lower()) or ('usb' in dev.lower()) or ('acm' in dev.lower()) or ('S0' in dev):
-            return True
-        else:
-            return False
-
-    devs = os.listdir('/dev')
-    filtered_devs = ['/dev/'+d for d in devs if filter_dev(d)]
+    port_list = HARDWARE.serial_ports()
 
-    response = {'response': devs, 'endpoint': request.path}
+    response = {'response': [p['device'] for p in port_list], 'ports': port_list, 'endpoint': request.path}
     # response.headers.add('Access-Control-Allow-Origin', '*')
 
     return jsonify(response)
@@ -263,102 +697,256 @@ def ports():
 def start_data_record():
     """
     Start a serial data recording thread.
+
+    Several recorders can run at the same time on different ports. Each one
+    is addressed by 'id' (default: 'default'), 'port' and 'baud' override
+    the serial settings.
     :return:
     """
-    global DATARECTHREAD
-
-    with open(CONFIGPATH, 'r') as fp:
-        settings_dict = toml.load(fp)
+    settings_dict = CONFIG.get()
 
     args = request.get_json()
 
+    recorder_id = str(args.get('id', utils.RecorderManager.DEFAULT_ID))
+    port = args.get('port', settings_dict['serial']['port'])
+    baud = args.get('baud', settings_dict['serial']['baud'])
     patient_code = args.get('patient')
     session_code = args.get('session')
     record_code = args.get('record')
+    # Recording format, 'csv' (raw serial data) or 'bin' (binary record)
+    record_format = args.get('format', settings_dict.get('record', {}).get('format', 'csv'))
+    if record_format not in ('csv', 'bin'):
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'UNKNOWN FORMAT'})
+    # Framing of the serial stream, 'csv' or 'msgpack'
+    framing = args.get('framing', settings_dict['serial'].get('framing', 'csv'))
+    if framing not in ('csv', 'msgpack'):
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'UNKNOWN FRAMING'})
+    extension = recformat.EXTENSION if record_format == 'bin' else '.csv'
+    # Compress the recording as it is written
+    compress = bool(args.get('compress', settings_dict.get('record', {}).get('compress', False)))
+    if compress and record_format == 'csv':
+        extension += '.gz'
+    # Write the recording as a folder of segments sealed as they fill up (see segments)
+    segment_bytes = segment_seconds = None
+    if bool(args.get('segment', settings_dict.get('record', {}).get('segment', False))):
+        try:
+            segment_bytes = int(float(args.get('segment_mb', segments.SEGMENT_BYTES / 1e6)) * 1e6)
+            segment_seconds = float(args.get('segment_seconds', segments.SEGMENT_SECONDS))
+        except (TypeError, ValueError):
+            return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'INVALID SEGMENT SIZE'})
+        if segment_bytes <= 0 or segment_seconds <= 0:
+            return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'INVALID SEGMENT SIZE'})
+        extension = segments.EXTENSION
+    # Processing stages adding derived channels to the recording (see pipeline)
+    stages = args.get('stages', settings_dict.get('record', {}).get('stages', []))
+    try:
+        pipeline.Pipeline(stages or [])
+    except (TypeError, ValueError) as e:
+        return jsonify({'endpoint': request.path, 'status': 'ERROR', 'error': 'INVALID STAGES', 'reason': str(e)})
+
+    # Recorders other than the default one get their id in the file name
+    record_name = 'rec_{}'.format(record_code)
+    if recorder_id != utils.RecorderManager.DEFAULT_ID:
+        record_name += '_{}'.format(secure_filename(recorder_id))
 
     HOMEDIR = WORKINGDIR
     logfilename = HOMEDIR / 'EXPDATA' / 'sub_{}'.format(patient_code) / \
-                            'sess_{}'.format(session_code) / 'rec_{}.csv'.format(record_code)
+                            'sess_{}'.format(session_code) / '{}{}'.format(record_name, extension)
 
-    if DATARECTHREAD is None or not DATARECTHREAD.is_alive():
-        DATARECTHREAD = utils.SerialDataRecorder(port=settings_dict['serial']['port'],
-                                                 baud=settings_dict['serial']['baud'],
-                                                 logfile=logfilename,
-                                                 patient=patient_code,
-                                                 session=session_code,
-                                                 record=record_code)
-        DATARECTHREAD.start()
+    if not RECORDERS.is_alive(recorder_id):
+        try:
+            RECORDERS.start(recorder_id,
+                                       port=port,
+                                       baud=baud,
+                                       logfile=logfilename,
+                                       patient=patient_code,
+                                       session=session_code,
+                                       record=record_code,
+                                       fmt=record_format,
+                                       framing=framing,
+                                       compress=compress,
+                                       segment_bytes=segment_bytes,
+                                       segment_seconds=segment_seconds,
+                                       stages=stages)
+        except ValueError:
+            return jsonify({'endpoint': request.path, 'id': recorder_id,
+                            'status': 'ERROR', 'error': 'PORT IN USE'})
 
         # Wait for a bit
         time.sleep(0.5)
-        if DATARECTHREAD.is_alive():
-            return jsonify({'endpoint': request.path, 'status': 'RECORDING'})
+        if RECORDERS.is_alive(recorder_id):
+            return jsonify({'endpoint': request.path, 'id': recorder_id, 'status': 'RECORDING'})
         else:
-            return jsonify({'endpoint': request.path, 'status': 'ERROR'})
+            return jsonify({'endpoint': request.path, 'id': recorder_id, 'status': 'ERROR'})
     else:
-        return jsonify({'endpoint': request.path, 'status': 'RECORDING'})
+        return jsonify({'endpoint': request.path, 'id': recorder_id, 'status': 'RECORDING'})
 
 
 @app.route('/record/status', methods=['GET'])
 def data_record_status():
     """
     Get status of data recording.
+
+    Optional query parameters:
+      id: recorder id (default: 'default')
+      points: reduce the plot window to about that many points with min/max decimation
     :return:
     """
-    global DATARECTHREAD
+    recorder_id = request.args.get('id', utils.RecorderManager.DEFAULT_ID)
+    status = RECORDERS.status(recorder_id)
 
-    def get_plot_data_dict(fname):
-        try:
-            # Read file as csv and format the data
-            df = pd.read_csv(DATARECTHREAD.logfile)
+    points = request.args.get('points', None, type=int)
 
-            # Name columns
-            df.columns = ['V{}'.format(i) for i in range(df.shape[1])]
+    def get_plot_data_dict():
+        # Serve the plot window from the recorder's in-memory buffer
+        first_index, block = RECORDERS.latest(recorder_id, PLOT_WINDOW)
+        if block is None:
+            return None
 
-            # Append time
-            tvals = [float('{:.2f}'.format(i * 0.01)) for i in range(df.shape[0])]
-            df['t'] = tvals
+        if points:
+            index, block = decimate.minmax(block, points, first_index)
+        else:
+            index = first_index + np.arange(block.shape[0])
 
-            # Get last few samples
-            df = df[-1000:-20]
+        # Name columns, derived channels last
+        columns = pipeline.column_names(block.shape[1], status.get('derived_channels', []))
 
-            return df.to_dict(orient='records')
-        except:
-            return None
+        plot = []
+        for i, row in zip(index.tolist(), block.tolist()):
+            sample = dict(zip(columns, row))
+            # Append time
+            sample['t'] = round(i * utils.SAMPLE_PERIOD, 2)
+            plot.append(sample)
 
+        return plot
 
-    if DATARECTHREAD:
-        patdata = {'patient': DATARECTHREAD.patient,
-                   'session': DATARECTHREAD.session,
-                   'record': DATARECTHREAD.record}
+    if status:
+        patdata = {'patient': status['patient'],
+                   'session': status['session'],
+                   'record': status['record'],
+                   'port': status['port'],
+                   'file': status['file']}
 
-        if DATARECTHREAD.is_alive():
-            patdata['plot'] = get_plot_data_dict(DATARECTHREAD.logfile)
-            return jsonify({'endpoint': request.path, 'status': 'RECORDING', 'data': patdata})
-        else:
-            patdata['plot'] = get_plot_data_dict(DATARECTHREAD.logfile)
-            return jsonify({'endpoint': request.path, 'status': 'FINISHED', 'data': patdata})
+        patdata['plot'] = get_plot_data_dict()
+        return jsonify({'endpoint': request.path, 'id': recorder_id, 'status': status['status'], 'data': patdata})
     else:
-        return jsonify({'endpoint': request.path, 'status': 'FINISHED', 'data': None})
+        return jsonify({'endpoint': request.path, 'id': recorder_id, 'status': 'FINISHED', 'data': None})
+
+
+@app.route('/record/list', methods=['GET'])
+def data_record_list():
+    """
+    List the known recorders and their status.
+    :return:
+    """
+    items = []
+    for status in RECORDERS.statuses():
+        items.append({'id': status['id'],
+                      'status': status['status'],
+                      'port': status['port'],
+                      'patient': status['patient'],
+                      'session': status['session'],
+                      'record': status['record'],
+                      'file': status['file'],
+                      'bytes': status['bytes'],
+                      'frames': status['frames']})
+
+    return jsonify({'endpoint': request.path, 'response': items})
+
+
+@app.route('/record/stream', methods=['GET'])
+def data_record_stream():
+    """
+    Stream newly recorded samples to the client as server-sent events.
+
+    Each event carries a batch of samples with the index of its first sample,
+    time can be computed as index * period. If the client falls behind, the
+    oldest batches are dropped and counted in 'dropped'.
+
+    The recorder is selected with the 'id' query parameter (default: 'default').
+    :return:
+    """
+    recorder_id = request.args.get('id', utils.RecorderManager.DEFAULT_ID)
+    sub = RECORDERS.subscribe(recorder_id)
+
+    if sub is None:
+        return jsonify({'endpoint': request.path, 'status': 'FINISHED'})
+    derived = (RECORDERS.status(recorder_id) or {}).get('derived_channels', [])
+
+    def generate():
+        try:
+            last_sent = time.time()
+            while True:
+                first_index, block = sub.get_batch(STREAM_KEEPALIVE)
+
+                if block is not None:
+                    frame = {'start': first_index,
+                             'period': utils.SAMPLE_PERIOD,
+                             'columns': pipeline.column_names(block.shape[1], derived),
+                             'data': block.tolist(),
+                             'dropped': sub.dropped}
+                    yield 'data: {}\n\n'.format(json.dumps(frame))
+                    last_sent = time.time()
+                elif sub.finished:
+                    yield 'event: end\ndata: {}\n\n'
+                    return
+                else:
+                    # Keep the connection open through proxies.
+                    yield ': keep-alive\n\n'
+
+                # Batch samples together rather than sending one event per serial read.
+                wait = STREAM_INTERVAL - (time.time() - last_sent)
+                if wait > 0:
+                    time.sleep(wait)
+        finally:
+            sub.close()
+
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
 
 
 @app.route('/record/stop', methods=['POST'])
 def stop_data_record():
     """
     Stop the running data record thread.
+
+    The recorder is selected with 'id' (default: 'default').
     :return:
     """
-    global DATARECTHREAD
+    args = request.get_json(silent=True) or {}
+    recorder_id = str(args.get('id', request.args.get('id', utils.RecorderManager.DEFAULT_ID)))
+
+    RECORDERS.stop(recorder_id)
+    return jsonify({'endpoint': request.path, 'id': recorder_id, 'status': 'FINISHED'})
+
+def list_data_folder(folder):
+    """
+    List a folder of EXPDATA from the catalog.
+    :param folder: folder relative to EXPDATA
+    :return: list of entries or None if the folder is outside EXPDATA
+    """
+    try:
+        return CATALOG.list(CATALOG.normalize(folder))
+    except ValueError:
+        return None
+
+
+def record_path(subject, session, record):
+    """
+    Path of a record given by a client.
+
+    Sidecars (statistics, pyramids, row indexes) are written next to the
+    record, so it must not be outside EXPDATA.
+    :return: Path or None if the record is outside EXPDATA
+    """
+    try:
+        folder = CATALOG.normalize('/'.join((subject, session, record)))
+    except ValueError:
+        return None
+    return WORKINGDIR / 'EXPDATA' / folder if folder else None
 
-    if DATARECTHREAD == None:
-        return {'endpoint': request.path, 'status': 'FINISHED'}
-    else:
-        if DATARECTHREAD.is_alive():
-            DATARECTHREAD.stop_recording()
-            return jsonify({'endpoint': request.path, 'status': 'FINISHED'})
-        else:
-            DATARECTHREAD = None
-            return jsonify({'endpoint': request.path, 'status': 'FINISHED'})
 
 @app.route('/data/files', methods=['GET'])
 def data_files():
@@ -371,21 +959,31 @@ def data_files():
 
     # If path is None, then use the default path
     if path is None:
+        folder = ''
         path = WORKINGDIR / 'EXPDATA'
     else:
+        folder = path
         path = WORKINGDIR / 'EXPDATA' / path
 
     # Get list of all files and folders in the path
-    lsout = path.glob('*')
+    lsout = list_data_folder(folder)
+    if lsout is None:
+        return jsonify({'endpoint': request.path,
+                        'error': 'INVALID PATH'})
 
     # Loop over the list and create a dictionary of files and folders
     items = []
     for i in lsout:
         fileData = {
-            'name': i.parts[-1],
-            'id': str(i.parts[-1]),
-            'isDir': True if i.is_dir() else False,
-            'isHidden': False if i.parts[-1][0] in string.ascii_letters else True,
+            'name': i['name'],
+            'id': i['name'],
+            'isDir': i['isDir'],
+            'isHidden': False if i['name'][0] in string.ascii_letters else True,
+            'size': i['size'],
+            'mtime': i['mtime'],
+            'samples': i['samples'],
+            'duration': i['duration'],
+            'channels': i['channels'],
         }
 
         items.append(fileData)
@@ -404,16 +1002,12 @@ def data_tree():
 
     :return:
     """
-    # Get list of all files and folders in the path
-    lsout = (WORKINGDIR / 'EXPDATA').glob('*')
+    # Get list of all folders that start with 'sub_'
+    dirs = [i for i in list_data_folder('') if i['isDir'] and i['name'][:4] == 'sub_']
 
-    # Get list of all folders
-    dirs = [str(i.parts[-1]) for i in lsout if i.is_dir()]
-
-    # Remove folders that do not start with 'sub_'
-    dirs = [i for i in dirs if i[:4] == 'sub_']
-
-    return jsonify({'endpoint': request.path, 'response': dirs})
+    return jsonify({'endpoint': request.path,
+                    'response': [i['name'] for i in dirs],
+                    'details': dirs})
 
 
 @app.route('/data/sessions', methods=['GET'])
@@ -430,21 +1024,20 @@ def data_sessions():
         return jsonify({'endpoint': request.path,
                         'error': 'NO SUBJECT SPECIFIED'})
 
-    # Get list of all files and folders in the path
-    lsout = (WORKINGDIR / 'EXPDATA' / subject).glob('*')
-
-    # Get list of all folders
-    dirs = [str(i.parts[-1]) for i in lsout if i.is_dir()]
-
-    # Remove folders that do not start with 'sess_'
-    dirs = [i for i in dirs if i[:5] == 'sess_']
+    # Get list of all folders that start with 'sess_'
+    dirs = [i for i in list_data_folder(subject) or [] if i['isDir'] and i['name'][:5] == 'sess_']
 
-    return jsonify({'endpoint': request.path, 'response': dirs})
+    return jsonify({'endpoint': request.path,
+                    'response': [i['name'] for i in dirs],
+                    'details': dirs})
 
 @app.route('/data/records', methods=['GET'])
 def data_records():
     """
     List of records for a given subject and session.
+
+    'details' holds the size, number of samples, duration and number of
+    channels of each record.
     :return:
     """
     # Read the query string with key subject
@@ -457,22 +1050,168 @@ def data_records():
         return jsonify({'endpoint': request.path,
                         'error': 'NO SUBJECT OR SESSION SPECIFIED'})
 
-    # Get list of all files and folders in the path
-    lsout = (WORKINGDIR / 'EXPDATA' / subject / session).glob('*')
-
-    # Get list of all files
-    files = [str(i.parts[-1]) for i in lsout if i.is_file()]
+    # Get list of all files, leaving out sidecar files
+    files = [i for i in list_data_folder(subject + '/' + session) or []
+             if not i['isDir'] and not records.is_sidecar(i['name'])]
 
     # Remove files that do not start with 'rec_'
     # files = [i for i in files if i[:4] == 'rec_']
 
-    return jsonify({'endpoint': request.path, 'response': files})
+    return jsonify({'endpoint': request.path,
+                    'response': [i['name'] for i in files],
+                    'details': files})
+
+
+@app.route('/data/stats', methods=['GET'])
+def data_stats():
+    """
+    Summary statistics of a record, or of all the records of a session.
+
+    For every channel: mean, RMS, min, max and number of gait cycles, plus
+    the number of samples, duration and sample rate. Without 'record', the
+    statistics of every record of the session are returned along with their
+    combination in 'session'. Statistics are cached next to the records.
+    :return:
+    """
+    subject = request.args.get('subject')
+    session = request.args.get('session')
+    record = request.args.get('record')
+
+    if subject is None or session is None:
+        return jsonify({'endpoint': request.path,
+                        'error': 'NO SUBJECT OR SESSION SPECIFIED'})
+
+    if record is not None:
+        record_file = record_path(subject, session, record)
+        if record_file is None or not records.is_record(record_file):
+            return jsonify({'endpoint': request.path,
+                            'error': 'FILE NOT FOUND'})
+        signature = records.record_signature(record_file)
+        try:
+            result = stats.record_stats(record_file, load=lambda: parsed_record(record_file, signature))
+        except Exception as e:
+            return jsonify({'endpoint': request.path, 'error': 'BAD RECORD', 'reason': str(e)})
+        return jsonify({'endpoint': request.path, 'record': record, 'stats': result})
+
+    names = [i['name'] for i in list_data_folder(subject + '/' + session) or []
+             if not i['isDir'] and i['name'].startswith('rec_') and not records.is_sidecar(i['name'])]
+
+    per_record = {}
+    errors = {}
+    for name in names:
+        record_file = record_path(subject, session, name)
+        try:
+            signature = records.record_signature(record_file)
+            per_record[name] = stats.record_stats(record_file,
+                                                  load=lambda: parsed_record(record_file, signature))
+        except Exception as e:
+            errors[name] = str(e)
+
+    return jsonify({'endpoint': request.path,
+                    'records': per_record,
+                    'errors': errors,
+                    'session': stats.rollup(list(per_record.values()))})
+
+
+@app.route('/data/query', methods=['POST'])
+def data_query():
+    """
+    Aggregate channels across many records, e.g. all the sessions of a subject or a cohort.
+
+    JSON body:
+      subjects, sessions, records: lists of names or patterns ('sub_0*'), all if left out
+      channels: list of channel names or indices, all if left out
+      aggregate: 'summary' (default, statistics of every record and combined),
+                 'mean' (mean and standard deviation curves across records) or
+                 'percentiles' (percentile curves across records)
+      points: number of points of the curves, over the normalized record time
+      percentiles: percentiles of the curves, defaults to 10, 25, 50, 75 and 90
+    Records are read and reduced in parallel by a pool of processes.
+    :return:
+    """
+    args = request.get_json(silent=True) or {}
+
+    def names(key):
+        value = args.get(key)
+        return [value] if isinstance(value, str) else value
+
+    try:
+        result = cohort.run_query(WORKINGDIR / 'EXPDATA',
+                                  subjects=names('subjects'),
+                                  sessions=names('sessions'),
+                                  names=names('records'),
+                                  channels=names('channels'),
+                                  aggregation=args.get('aggregate', 'summary'),
+                                  points=int(args.get('points', cohort.CURVE_POINTS)),
+                                  percentiles=args.get('percentiles', cohort.DEFAULT_PERCENTILES))
+    except (TypeError, ValueError) as e:
+        return jsonify({'endpoint': request.path, 'error': 'INVALID QUERY', 'reason': str(e)})
+    except RuntimeError as e:
+        # A worker process died, the pool is restarted on the next query.
+        return jsonify({'endpoint': request.path, 'error': 'QUERY FAILED', 'reason': str(e)})
+
+    return jsonify(dict(result, endpoint=request.path))
+
+
+@app.route('/data/export', methods=['GET'])
+def data_export():
+    """
+    Download a subject, or one session of a subject, as an archive.
+
+    Query parameters:
+      subject, session: folders to export (session is optional)
+      format: 'tar' (default) or 'zip'
+      convert: 'raw' (default) sends the files as recorded, 'bin' converts
+               CSV records to binary records, 'csv' binary records to CSV
+      workers: number of conversion processes
+    The archive is streamed as it is built.
+    :return:
+    """
+    subject = request.args.get('subject')
+    session = request.args.get('session')
+    fmt = request.args.get('format', 'tar')
+    conversion = request.args.get('convert', 'raw')
+    workers = request.args.get('workers', type=int)
+
+    if subject is None:
+        return jsonify({'endpoint': request.path, 'error': 'NO SUBJECT SPECIFIED'})
+    if fmt not in export.FORMATS:
+        return jsonify({'endpoint': request.path, 'error': 'UNKNOWN FORMAT'})
+    if conversion not in export.CONVERSIONS:
+        return jsonify({'endpoint': request.path, 'error': 'UNKNOWN CONVERSION'})
+
+    try:
+        folder = CATALOG.normalize(subject if session is None else subject + '/' + session)
+    except ValueError:
+        folder = ''
+    folder_path = WORKINGDIR / 'EXPDATA' / folder
+    if not folder or not folder_path.is_dir():
+        return jsonify({'endpoint': request.path, 'error': 'INVALID PATH'})
+
+    filename = secure_filename('_'.join(folder.split('/'))) + '.' + fmt
+
+    return Response(stream_with_context(export.stream_archive(folder_path, fmt, conversion, workers)),
+                    mimetype=export.MIMETYPES[fmt],
+                    headers={'Content-Disposition': 'attachment; filename="{}"'.format(filename),
+                             'X-Accel-Buffering': 'no'})
 
 
 @app.route('/data/record', methods=['GET'])
 def data_record():
     """
     Get data from a given record.
+
+    Optional query parameters:
+      start, stop: row range
+      t0, t1: time range in seconds
+      channels: comma separated list of channel names or indices
+      limit: maximum number of rows to send (page size)
+      cursor: first row of the page, as returned in 'next' by the previous page
+      points: decimate the range to about this many points, the row index of
+              every point is returned in 'index'
+      mode: decimation mode, 'minmax' (default) or 'lttb'
+
+    The response is streamed chunk by chunk.
     :return:
     """
     # Get the query string with key 'subject'
@@ -487,53 +1226,178 @@ def data_record():
         return jsonify({'endpoint': request.path,
                         'error': 'NO SUBJECT, SESSION OR RECORD SPECIFIED'})
 
-    # Get the path to the record file
-    record_file = WORKINGDIR / 'EXPDATA' / subject / session / record
+    # Get the path to the record file, None if outside EXPDATA
+    record_file = record_path(subject, session, record)
 
     # If the file does not exist, return an error message
-    if not record_file.is_file():
+    if record_file is None or not records.is_record(record_file):
         return jsonify({'endpoint': request.path,
                         'error': 'FILE NOT FOUND'})
 
-    # Read the file as a csv
+    # Repeated requests get a 304 or the response from the cache
+    signature = records.record_signature(record_file)
+    not_modified = record_not_modified(signature)
+    if not_modified is not None:
+        return not_modified
+
+    # Responses of records still being written are not cached, they would be out of date at the next write.
+    cache_key = None
+    if not is_recording(record_file):
+        cache_key = ('response', request.path, tuple(sorted(request.args.items(multi=True))), signature)
+        body = CACHE.get(cache_key)
+        if body is not None:
+            return add_validators(Response(body, mimetype='application/json'), signature)
+
+    # Read the range, channel and page parameters
     try:
-        df = pd.read_csv(record_file)
+        start = request.args.get('start', 0, type=int)
+        start = request.args.get('cursor', start, type=int)
+        stop = request.args.get('stop', None, type=int)
+        t0 = request.args.get('t0', None, type=float)
+        t1 = request.args.get('t1', None, type=float)
+        limit = request.args.get('limit', None, type=int)
+        channels = request.args.get('channels')
+        channels = [c.strip() for c in channels.split(',') if c.strip()] if channels else None
+    except ValueError:
+        return jsonify({'endpoint': request.path,
+                        'error': 'BAD QUERY'})
+
+    points = request.args.get('points', None, type=int)
+    if points:
+        return data_record_decimated(record_file, signature, cache_key, points, request.args.get('mode', 'minmax'),
+                                     start, stop, channels, t0, t1)
+
+    # Rows come from the parsed record if it can be cached, otherwise from the record,
+    # which is opened right away (this also reads the first chunk) to report errors.
+    try:
+        parsed = parsed_record(record_file, signature)
+        if parsed is not None:
+            columns, data, period = parsed
+            first, last = records.resolve_range(start, stop, t0, t1, limit, period)
+            idx = records.select_columns(columns, channels)
+            if idx is not None:
+                columns = [columns[i] for i in idx]
+            data = data[first:last] if idx is None else data[first:last, idx]
+            chunks = (data[i:i + records.CHUNK_ROWS] for i in range(0, data.shape[0], records.CHUNK_ROWS))
+        else:
+            chunks = records.RecordReader(record_file, start, stop, channels, t0, t1, limit).open()
+            columns, first = chunks.columns, chunks.start
+    except KeyError:
+        return jsonify({'endpoint': request.path,
+                        'error': 'UNKNOWN CHANNEL'})
     except:
         return jsonify({'endpoint': request.path,
                         'error': 'FILE READ ERROR'})
 
-    # Convert the dataframe to a python list of lists
-    data = df.values.tolist()
+    endpoint = request.path
 
-    # Get the column names
-    columns = df.columns.tolist()
+    def generate():
+        yield '{{"endpoint": {}, "response": {{"columns": {}, "start": {}, "data": ['.format(
+            json.dumps(endpoint), json.dumps(columns), first)
+
+        sent = 0
+        for chunk in chunks:
+            if chunk.shape[0] == 0:
+                continue
+            yield (', ' if sent else '') + json.dumps(chunk.tolist())[1:-1]
+            sent += chunk.shape[0]
+
+        # Cursor of the next page, if there may be one.
+        next_cursor = first + sent if limit and sent >= limit else None
+
+        yield '], "rows": {}, "next": {}}}}}'.format(sent, json.dumps(next_cursor))
+
+    def generate_and_cache():
+        # Keep the body for the next request, unless it grows too large for the cache.
+        parts = [] if cache_key is not None else None
+        size = 0
+        for part in generate():
+            if parts is not None:
+                parts.append(part)
+                size += len(part)
+                if size > CACHE.max_item_bytes:
+                    parts = None
+            yield part
+        if parts is not None:
+            body = ''.join(parts).encode()
+            CACHE.put(cache_key, body, len(body))
+
+    return add_validators(Response(generate_and_cache(), mimetype='application/json'), signature)
+
+
+def data_record_decimated(record_file, signature, cache_key, points, mode, start, stop, channels, t0, t1):
+    """
+    Decimated view of a record, see data_record().
+    :return:
+    """
+    if mode not in ('minmax', 'lttb'):
+        return jsonify({'endpoint': request.path,
+                        'error': 'UNKNOWN MODE'})
+
+    try:
+        # Convert the time range to rows
+        reader = records.RecordReader(record_file, start, stop, channels, t0, t1).open()
+        start, stop = reader.start, reader.stop
+
+        if mode == 'minmax':
+            columns, index, data = decimate.pyramid_minmax(record_file, points, start, stop, channels,
+                                                           live=is_recording(record_file))
+        else:
+            columns, data = read_rows(record_file, signature, start, stop, channels)
+            index, data = decimate.lttb(data, points, start)
+    except KeyError:
+        return jsonify({'endpoint': request.path,
+                        'error': 'UNKNOWN CHANNEL'})
+    except:
+        return jsonify({'endpoint': request.path,
+                        'error': 'FILE READ ERROR'})
 
-    # Create a response dictionary
     response = {'endpoint': request.path,
                 'response': {
-                    'data': data,
-                    'columns': columns
+                    'data': data.tolist(),
+                    'index': index.tolist(),
+                    'columns': columns,
+                    'start': start
                 }}
 
-    return jsonify(response)
+    response = jsonify(response)
+    if cache_key is not None:
+        body = response.get_data()
+        CACHE.put(cache_key, body, len(body))
+    return add_validators(response, signature)
 
-if __name__ == '__main__':
 
-    # Handle app configuration
+startup.mark('app')
+
 
+def setup(start_catalog=True):
+    """
+    Prepare the configuration and background services before serving requests.
+    :param start_catalog: keep the data catalog in sync from this process
+    :return:
+    """
     # First check if there is a config file already.
-    if CONFIGPATH.is_file():
+    if CONFIG.exists():
         # Load configuration from file.
         print("Loading cofiguration from {}...".format(CONFIGPATH))
-        APPCONFIG = toml.load(CONFIGPATH)
     else:
         print("Config file not found. Creating new default config file at {}...".format(CONFIGPATH))
-        # Load the default configuration
-        APPCONFIG = utils.DEFAULT_CONFIG
         # Create the config file and folder if it does not exist.
-        CONFIGPATH.parent.mkdir(parents=True, exist_ok=True)
-        with open(CONFIGPATH, 'w') as fp:
-            toml.dump(APPCONFIG, fp)
+        CONFIG.create(utils.DEFAULT_CONFIG)
+    startup.mark('config')
+
+    # Keep the data catalog in sync with the filesystem
+    if start_catalog:
+        CATALOG.start()
+        startup.mark('catalog')
+
+    startup.report()
+
+
+if __name__ == '__main__':
+
+    # Handle app configuration
+    setup()
 
     app.debug = True
     app.run(host='0.0.0.0', port=5050)
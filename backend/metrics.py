@@ -0,0 +1,162 @@
+"""
+Minimal metrics in the Prometheus text exposition format.
+
+Counters, gauges and histograms are created at module level and updated from
+the hot paths. Values that are cheaper to read at scrape time (recorder
+state...) are provided by collector functions registered with
+register_collector().
+"""
+import bisect
+import threading
+
+# Default histogram buckets (seconds).
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_METRICS = []
+_COLLECTORS = []
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    items = ['{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+             for k, v in labels]
+    return '{' + ','.join(items) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.lock = threading.Lock()
+        self.values = {}
+        _METRICS.append(self)
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted(labels.items()))
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append('{}{} {}'.format(self.name, _format_labels(key), _format_value(value)))
+        return lines
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # One count per bucket, then sum and count.
+                counts = self.values[key] = [0] * (len(self.buckets) + 2)
+            i = bisect.bisect_left(self.buckets, value)
+            if i < len(self.buckets):
+                counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.help),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                cumulative = 0
+                for bound, n in zip(self.buckets, counts):
+                    cumulative += n
+                    lines.append('{}_bucket{} {}'.format(
+                        self.name, _format_labels(key + (('le', _format_value(bound)),)), cumulative))
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, _format_labels(key + (('le', '+Inf'),)), counts[-1]))
+                lines.append('{}_sum{} {}'.format(self.name, _format_labels(key), _format_value(counts[-2])))
+                lines.append('{}_count{} {}'.format(self.name, _format_labels(key), counts[-1]))
+        return lines
+
+
+def register_collector(fn):
+    """
+    Register a function called at scrape time.
+
+    The function returns a list of (name, type, help, [(labels dict, value), ...]).
+    :return: fn
+    """
+    _COLLECTORS.append(fn)
+    return fn
+
+
+def render(exclude=()):
+    """
+    Render every metric in the Prometheus text format.
+    :param exclude: metrics left out, e.g. RECORDER_METRICS when they are rendered by the recorder process
+    :return: str
+    """
+    lines = []
+    for metric in _METRICS:
+        if metric not in exclude:
+            lines.extend(metric.render())
+
+    for collector in _COLLECTORS:
+        for name, kind, help_text, samples in collector():
+            lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            for labels, value in samples:
+                lines.append('{}{} {}'.format(name, _format_labels(sorted(labels.items())), _format_value(value)))
+
+    return '\n'.join(lines) + '\n'
+
+
+def render_recorder():
+    """
+    Render the metrics updated by the recorders (RECORDER_METRICS), for the recorder process (see recorderd).
+    :return: str
+    """
+    lines = []
+    for metric in RECORDER_METRICS:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# Metrics updated from the recorder and the web server.
+WRITER_FLUSH_SECONDS = Histogram('exo_writer_flush_seconds',
+                                 'Time spent flushing recorded data to disk.')
+WRITER_WRITE_BYTES = Counter('exo_writer_bytes_total',
+                             'Bytes handed to the record writers.')
+HTTP_REQUEST_SECONDS = Histogram('exo_http_request_seconds',
+                                 'Time to handle an HTTP request, up to the first byte of streamed responses.')
+
+# Metrics updated by the record writers, in the process running the recorders.
+RECORDER_METRICS = (WRITER_FLUSH_SECONDS, WRITER_WRITE_BYTES)
@@ -0,0 +1,262 @@
+"""
+Processing stages run by the recorder on every block of decoded samples.
+
+Each stage computes one derived channel from one or more channels, block by
+block, keeping whatever state it needs between blocks (filter history,
+previous sample), so the result is the same as processing the whole
+recording at once. Derived channels are appended to the samples after the
+decoded ones, in the order of the stages, so they are written to the
+recording and seen by the live views like any other channel.
+
+Stages are described by dicts, e.g. in the 'record.stages' setting:
+
+    {"type": "lowpass", "name": "force_lp", "channel": "V3", "cutoff": 10}
+    {"type": "velocity", "name": "knee_vel", "channel": "V1"}
+    {"type": "product", "name": "power", "channels": ["force_lp", "knee_vel"]}
+
+Channels are decoded channels ('V0', 'V1'... or their index) or derived
+channels of earlier stages. Every stage is vectorized over the block and
+costs a fixed number of operations per sample, see Stage.cost. New stages
+are added with register_stage.
+"""
+import time
+
+import numpy as np
+
+import recformat
+
+# Stage classes, by type.
+STAGES = {}
+
+# Upper bound of the cost of all the stages of a recorder, in operations per sample.
+MAX_COST = 1024
+
+# Upper bound of the number of taps of a FIR filter.
+MAX_TAPS = 255
+
+
+def register_stage(kind):
+    """
+    Decorator making a Stage subclass available under a type name.
+    :return: decorator
+    """
+    def decorator(cls):
+        cls.kind = kind
+        STAGES[kind] = cls
+        return cls
+    return decorator
+
+
+def _channel_name(channel):
+    # Indices are given as numbers or strings of digits.
+    return 'V{}'.format(channel) if str(channel).isdigit() else str(channel)
+
+
+def column_names(width, derived=()):
+    """
+    Names of the columns of blocks of decoded samples followed by derived channels.
+    :return: list
+    """
+    return ['V{}'.format(i) for i in range(width - len(derived))] + list(derived)
+
+
+class Stage(object):
+    """
+    Computes one derived channel from a list of input channels.
+    """
+    kind = None
+
+    def __init__(self, name, inputs, sample_period):
+        self.name = str(name)
+        self.inputs = [_channel_name(c) for c in inputs]
+        self.sample_period = sample_period
+
+    @property
+    def cost(self):
+        """
+        Operations per sample, used to bound the work done by the recorder.
+        :return: int
+        """
+        return 1
+
+    def process(self, columns):
+        """
+        Process a block.
+        :param columns: list of 1D arrays, one per input channel, all the same length
+        :return: 1D array, the derived channel over the block
+        """
+        raise NotImplementedError
+
+
+@register_stage('lowpass')
+class LowPass(Stage):
+    """
+    Linear phase FIR low-pass filter (Hamming windowed sinc), delays the signal by (taps - 1) / 2 samples.
+    """
+    def __init__(self, name, channel, cutoff, taps=31, sample_period=recformat.SAMPLE_PERIOD):
+        super(LowPass, self).__init__(name, [channel], sample_period)
+        taps = int(taps)
+        nyquist = 0.5 / sample_period
+        if not 0 < float(cutoff) < nyquist:
+            raise ValueError('Cutoff of {} must be between 0 and {} Hz'.format(name, nyquist))
+        if not 1 <= taps <= MAX_TAPS or taps % 2 == 0:
+            raise ValueError('Taps of {} must be odd and at most {}'.format(name, MAX_TAPS))
+
+        n = np.arange(taps) - (taps - 1) / 2.0
+        fc = float(cutoff) * sample_period
+        h = 2 * fc * np.sinc(2 * fc * n) * np.hamming(taps)
+        # Unit gain at DC.
+        self.taps = h / h.sum()
+        self.history = None
+
+    @property
+    def cost(self):
+        return len(self.taps)
+
+    def process(self, columns):
+        x = columns[0]
+        if self.history is None:
+            # Start as if the first value had always been there, rather than from zero.
+            self.history = np.full(len(self.taps) - 1, x[0])
+        extended = np.concatenate([self.history, x])
+        self.history = extended[len(extended) - (len(self.taps) - 1):]
+        return np.convolve(extended, self.taps, mode='valid')
+
+
+@register_stage('velocity')
+class Velocity(Stage):
+    """
+    Rate of change of a channel per second (backward difference).
+    """
+    def __init__(self, name, channel, scale=1.0, sample_period=recformat.SAMPLE_PERIOD):
+        super(Velocity, self).__init__(name, [channel], sample_period)
+        self.scale = float(scale)
+        self.previous = None
+
+    def process(self, columns):
+        x = columns[0]
+        previous = x[:1] if self.previous is None else self.previous
+        self.previous = x[-1:]
+        return np.diff(x, prepend=previous) * (self.scale / self.sample_period)
+
+
+@register_stage('product')
+class Product(Stage):
+    """
+    Product of channels, e.g. power from torque and angular velocity.
+    """
+    def __init__(self, name, channels, scale=1.0, sample_period=recformat.SAMPLE_PERIOD):
+        if len(channels) < 2:
+            raise ValueError('{} needs at least two channels'.format(name))
+        super(Product, self).__init__(name, channels, sample_period)
+        self.scale = float(scale)
+
+    @property
+    def cost(self):
+        return len(self.inputs)
+
+    def process(self, columns):
+        return np.prod(columns, axis=0) * self.scale
+
+
+@register_stage('linear')
+class Linear(Stage):
+    """
+    gain * channel + offset, e.g. to convert raw values to physical units.
+    """
+    def __init__(self, name, channel, gain=1.0, offset=0.0, sample_period=recformat.SAMPLE_PERIOD):
+        super(Linear, self).__init__(name, [channel], sample_period)
+        self.gain = float(gain)
+        self.offset = float(offset)
+
+    def process(self, columns):
+        return columns[0] * self.gain + self.offset
+
+
+def make_stage(spec, sample_period=recformat.SAMPLE_PERIOD):
+    """
+    Build a stage from its description.
+    :param spec: dict with 'type', 'name' and the arguments of the stage
+    :return: Stage
+    """
+    try:
+        spec = dict(spec)
+    except (TypeError, ValueError):
+        raise ValueError('Stage description must be a dict')
+    if spec.get('type') not in STAGES:
+        raise ValueError('Unknown stage type {}'.format(spec.get('type')))
+    if 'name' not in spec:
+        raise ValueError('Stage {} has no name'.format(spec['type']))
+    cls = STAGES[spec.pop('type')]
+    name = spec.pop('name')
+
+    try:
+        return cls(name, sample_period=sample_period, **spec)
+    except TypeError as e:
+        raise ValueError('Bad arguments for stage {}: {}'.format(name, e))
+
+
+class Pipeline(object):
+    """
+    Runs a list of stages on blocks of decoded samples.
+    """
+    def __init__(self, specs, sample_period=recformat.SAMPLE_PERIOD):
+        self.stages = [make_stage(spec, sample_period) for spec in specs]
+
+        # Check that every stage only uses decoded channels and earlier stages.
+        derived = []
+        for stage in self.stages:
+            for name in stage.inputs:
+                if name not in derived and not (name[:1] == 'V' and name[1:].isdigit()):
+                    raise ValueError('Unknown channel {} in stage {}'.format(name, stage.name))
+            if stage.name in derived or (stage.name[:1] == 'V' and stage.name[1:].isdigit()):
+                raise ValueError('Duplicate channel name {}'.format(stage.name))
+            derived.append(stage.name)
+
+        if sum(s.cost for s in self.stages) > MAX_COST:
+            raise ValueError('Stages cost more than {} operations per sample'.format(MAX_COST))
+
+        # Names of all the columns, known once the first block is seen.
+        self.columns = None
+        # Column indices of the inputs of every stage.
+        self._inputs = None
+        # Time spent processing and number of samples processed.
+        self.seconds = 0.0
+        self.samples = 0
+
+    @property
+    def derived(self):
+        return [s.name for s in self.stages]
+
+    def _resolve(self, width):
+        self.columns = column_names(width + len(self.stages), self.derived)
+        # Decoded channels beyond the width of the frames give an empty (NaN) channel.
+        self._inputs = [[self.columns.index(c) if c in self.columns[:width + k] else None for c in stage.inputs]
+                        for k, stage in enumerate(self.stages)]
+
+    def process(self, block):
+        """
+        Append the derived channels to a block of decoded samples.
+        :param block: 2D array, one row per sample
+        :return: 2D array with the derived channels as last columns
+        """
+        if not self.stages:
+            return block
+
+        t = time.perf_counter()
+        block = np.asarray(block, dtype=np.float64)
+        width = block.shape[1]
+        if self.columns is None or len(self.columns) != width + len(self.stages):
+            self._resolve(width)
+
+        out = np.empty((block.shape[0], width + len(self.stages)))
+        out[:, :width] = block
+        for k, (stage, idx) in enumerate(zip(self.stages, self._inputs)):
+            if None in idx:
+                out[:, width + k] = np.nan
+            else:
+                out[:, width + k] = stage.process([out[:, i] for i in idx])
+
+        self.seconds += time.perf_counter() - t
+        self.samples += block.shape[0]
+        return out
@@ -0,0 +1,349 @@
+"""
+Binary columnar recording format.
+
+A record file starts with a magic string and a msgpack encoded header
+describing the channels, followed by blocks of samples:
+
+    MAGIC
+    <uint32 header length> <msgpack header>
+    <uint32 rows> <uint32 payload length> <payload>
+    <uint32 rows> <uint32 payload length> <payload>
+    ...
+
+Each payload holds the block column by column (all samples of the first
+channel, then all samples of the second one...) as fixed width values of the
+dtype given in the header. Blocks can be skipped without decoding them, so
+slicing a record only touches the blocks that cover the requested rows.
+
+If the header's 'compression' is 'zlib', every payload is compressed on its
+own, so compressed records can still be sliced block by block.
+"""
+import os
+import struct
+import sys
+import time
+import zlib
+from pathlib import Path
+
+import msgpack
+import numpy as np
+
+MAGIC = b'EXOREC1\n'
+EXTENSION = '.rec'
+
+# Default number of samples per block.
+BLOCK_ROWS = 1024
+
+# Default period between two samples (seconds).
+SAMPLE_PERIOD = 0.01
+
+# zlib level used for compressed records, favours speed over ratio.
+COMPRESSION_LEVEL = 1
+
+_LENGTH = struct.Struct('<I')
+_BLOCK = struct.Struct('<II')
+
+
+def make_header(width, channels=None, dtype='float32', sample_period=SAMPLE_PERIOD, compression=None):
+    """
+    Build a record header.
+    :param width: number of channels
+    :param channels: channel names, defaults to V0, V1, ...
+    :param dtype: numpy dtype used to store samples
+    :param sample_period: time between two samples (seconds)
+    :param compression: None or 'zlib'
+    :return: dict
+    """
+    if channels is None:
+        channels = ['V{}'.format(i) for i in range(width)]
+
+    return {'version': 1,
+            'channels': list(channels),
+            'dtype': np.dtype(dtype).str,
+            'sample_period': sample_period,
+            'compression': compression,
+            'created': time.time()}
+
+
+def write_header(fp, header):
+    """
+    Write the magic string and header at the current position of fp.
+    :return: number of bytes written
+    """
+    packed = msgpack.packb(header)
+    fp.write(MAGIC)
+    fp.write(_LENGTH.pack(len(packed)))
+    fp.write(packed)
+    return len(MAGIC) + _LENGTH.size + len(packed)
+
+
+def encode_block(block, dtype, compression=None):
+    """
+    Encode a 2D block of samples (one row per sample) as a column-major block.
+    :return: bytes
+    """
+    block = np.asarray(block)
+    payload = np.ascontiguousarray(block.T, dtype=dtype).tobytes()
+    if compression == 'zlib':
+        payload = zlib.compress(payload, COMPRESSION_LEVEL)
+    return _BLOCK.pack(block.shape[0], len(payload)) + payload
+
+
+def read_header(fp):
+    """
+    Read the magic string and header from the start of fp.
+    :return: header dict
+    """
+    if fp.read(len(MAGIC)) != MAGIC:
+        raise ValueError('Not a binary record file')
+
+    length, = _LENGTH.unpack(fp.read(_LENGTH.size))
+    return msgpack.unpackb(fp.read(length))
+
+
+def iter_blocks(fp, header, start=0, stop=None):
+    """
+    Iterate over the blocks covering rows [start, stop) of an open record.
+    :param fp: file positioned right after the header
+    :param header: record header
+    :return: yields (index of the first row of the block, 2D array)
+    """
+    dtype = np.dtype(header['dtype'])
+    width = len(header['channels'])
+    compressed = header.get('compression') == 'zlib'
+    row = 0
+
+    while stop is None or row < stop:
+        raw = fp.read(_BLOCK.size)
+        if len(raw) < _BLOCK.size:
+            break
+        rows, length = _BLOCK.unpack(raw)
+
+        # Skip blocks before the requested range without reading them.
+        if row + rows <= start:
+            fp.seek(length, 1)
+            row += rows
+            continue
+
+        payload = fp.read(length)
+        if len(payload) < length:
+            # Truncated block at the end of an unfinished record.
+            break
+
+        if compressed:
+            payload = zlib.decompress(payload)
+
+        block = np.frombuffer(payload, dtype=dtype).reshape(width, rows).T
+        yield row, block
+        row += rows
+
+
+def read_record(path, start=0, stop=None):
+    """
+    Load rows [start, stop) of a binary record.
+    :return: (header, 2D array with one row per sample)
+    """
+    with open(path, 'rb') as fp:
+        header = read_header(fp)
+        blocks = []
+        for first, block in iter_blocks(fp, header, start, stop):
+            lo = max(start - first, 0)
+            hi = block.shape[0] if stop is None else min(stop - first, block.shape[0])
+            blocks.append(block[lo:hi])
+
+    if blocks:
+        data = np.concatenate(blocks)
+    else:
+        data = np.zeros((0, len(header['channels'])), dtype=header['dtype'])
+
+    return header, data
+
+
+def count_rows(fp):
+    """
+    Count the samples of an open record by walking the block headers.
+    :param fp: file positioned right after the header
+    :return: number of samples in complete blocks
+    """
+    size = os.fstat(fp.fileno()).st_size
+    rows = 0
+    while True:
+        raw = fp.read(_BLOCK.size)
+        if len(raw) < _BLOCK.size:
+            break
+        n, length = _BLOCK.unpack(raw)
+        if fp.tell() + length > size:
+            # Truncated block at the end of an unfinished record.
+            break
+        fp.seek(length, 1)
+        rows += n
+    return rows
+
+
+def is_binary_record(path):
+    """
+    Check whether path points to a binary record.
+    :return: bool
+    """
+    return Path(path).suffix == EXTENSION
+
+
+class BinaryRecordFile(object):
+    """
+    Incrementally write samples to a binary record.
+
+    Samples are accumulated until a full block is available. The header is
+    written with the first samples, once the number of channels is known.
+    """
+    def __init__(self, path, channels=None, dtype='float32',
+                 sample_period=SAMPLE_PERIOD, block_rows=BLOCK_ROWS, compression=None):
+        self.path = Path(path)
+        self.compression = compression
+        self.channels = channels
+        self.dtype = dtype
+        self.sample_period = sample_period
+        self.block_rows = block_rows
+        self.fp = open(self.path, 'wb')
+        self.header = None
+        self.pending = []
+        self.pending_rows = 0
+
+    def write(self, block):
+        """
+        Queue samples, writing out every full block.
+        :param block: 2D array, one row per sample
+        :return: number of bytes written to the file
+        """
+        block = np.asarray(block)
+        if block.ndim != 2 or block.shape[0] == 0:
+            return 0
+
+        written = 0
+        if self.header is None:
+            self.header = make_header(block.shape[1], self.channels, self.dtype, self.sample_period,
+                                      self.compression)
+            written += write_header(self.fp, self.header)
+
+        self.pending.append(block)
+        self.pending_rows += block.shape[0]
+
+        if self.pending_rows >= self.block_rows:
+            data = np.concatenate(self.pending)
+            full = (data.shape[0] // self.block_rows) * self.block_rows
+            for i in range(0, full, self.block_rows):
+                written += self._write_block(data[i:i + self.block_rows])
+            self.pending = [data[full:]] if full < data.shape[0] else []
+            self.pending_rows = data.shape[0] - full
+
+        return written
+
+    def flush(self):
+        """
+        Write out pending samples as a (possibly short) block and flush the file.
+        :return: number of bytes written to the file
+        """
+        written = 0
+        if self.pending_rows:
+            written += self._write_block(np.concatenate(self.pending))
+            self.pending = []
+            self.pending_rows = 0
+        self.fp.flush()
+        return written
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_block(self, block):
+        encoded = encode_block(block, self.header['dtype'], self.header.get('compression'))
+        self.fp.write(encoded)
+        return len(encoded)
+
+
+def load_csv_record(path):
+    """
+    Parse a raw CSV recording into a numeric array.
+
+    The first line is dropped, like the recorder does, because recording
+    usually starts in the middle of a line. Incomplete rows are dropped too.
+    :return: 2D float array
+    """
+    import pandas as pd
+
+    df = pd.read_csv(path, header=None, skiprows=1, on_bad_lines='skip')
+    df = df.apply(pd.to_numeric, errors='coerce').dropna()
+    return df.values.astype(np.float64)
+
+
+def convert_csv(path, dest=None, dtype='float32', sample_period=SAMPLE_PERIOD,
+                block_rows=BLOCK_ROWS, compression=None):
+    """
+    Convert a CSV recording to a binary record.
+    :param path: CSV recording
+    :param dest: output path, defaults to the same name with the .rec extension
+    :return: path of the binary record
+    """
+    path = Path(path)
+    dest = path.with_suffix(EXTENSION) if dest is None else Path(dest)
+
+    data = load_csv_record(path)
+
+    # Write to a temporary file so that an interrupted conversion leaves nothing behind.
+    tmp = dest.with_name(dest.name + '.part')
+    out = BinaryRecordFile(tmp, dtype=dtype, sample_period=sample_period, block_rows=block_rows,
+                           compression=compression)
+    if data.shape[0]:
+        out.write(data)
+    else:
+        out.header = make_header(data.shape[1], dtype=dtype, sample_period=sample_period,
+                                 compression=compression)
+        write_header(out.fp, out.header)
+    out.close()
+    tmp.replace(dest)
+
+    return dest
+
+
+def convert_tree(root, force=False, compression=None):
+    """
+    Convert every CSV recording below root that has no up to date binary record.
+    :param root: folder to scan, e.g. EXPDATA
+    :param force: convert even if the binary record is newer than the CSV file
+    :param compression: None or 'zlib'
+    :return: list of converted paths
+    """
+    converted = []
+    for path in sorted(Path(root).rglob('rec_*.csv')):
+        dest = path.with_suffix(EXTENSION)
+        if not force and dest.is_file() and dest.stat().st_mtime >= path.stat().st_mtime:
+            continue
+        try:
+            convert_csv(path, dest, compression=compression)
+        except Exception as e:
+            print("Could not convert {}: {}".format(path, e))
+            continue
+        print("Converted {} -> {}".format(path, dest))
+        converted.append(dest)
+
+    return converted
+
+
+if __name__ == '__main__':
+    # Bulk convert the CSV archive:
+    #   python recformat.py /data/EXPDATA [--force] [--compress]
+    if len(sys.argv) < 2:
+        print("Usage: python recformat.py <folder or file> [--force] [--compress]")
+        sys.exit(1)
+
+    target = Path(sys.argv[1])
+    compression = 'zlib' if '--compress' in sys.argv[2:] else None
+    if target.is_file():
+        print("Converted {} -> {}".format(target, convert_csv(target, compression=compression)))
+    else:
+        convert_tree(target, force='--force' in sys.argv[2:], compression=compression)
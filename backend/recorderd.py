@@ -0,0 +1,267 @@
+"""
+Recorder process for the production serving mode.
+
+The serial recorders run in this long-lived process, so that the web server
+can run several worker processes without each one owning its own recorders.
+Workers talk to it through a local unix socket with RecorderClient, which
+provides the same methods as utils.RecorderManager.
+
+Every request is a (method, args) tuple answered with ('ok', result) or
+('error', exception name, message). A 'subscribe' request turns the
+connection into a live stream: the process then sends (first index, block,
+dropped) tuples, (None, None, dropped) keep-alives, and ('end', None, dropped)
+once the recording stops.
+
+Start it with:
+    python recorderd.py [socket path]
+"""
+import os
+import secrets
+import sys
+import tempfile
+import threading
+from multiprocessing.connection import Client, Listener
+
+import metrics
+
+# Default path of the socket.
+DEFAULT_SOCKET = '/tmp/exo-recorder.sock'
+
+# File of the key used to authenticate the web workers, in the .exoskeleton folder (see load_authkey).
+AUTHKEY_FILE = 'recorder.key'
+
+# Time between two keep-alives on an idle subscription (seconds).
+SUBSCRIPTION_KEEPALIVE = 1.0
+
+# Requests the workers are allowed to make.
+METHODS = ('start', 'stop', 'status', 'statuses', 'is_alive', 'latest', 'send_settings')
+
+
+def load_authkey():
+    """
+    Key used to authenticate the web workers.
+
+    Taken from EXO_RECORDER_AUTHKEY if set, otherwise a random key is
+    generated on first use and kept, readable by its owner only, in the
+    .exoskeleton folder shared by the recorder process and the workers.
+    :return: bytes
+    """
+    if os.environ.get('EXO_RECORDER_AUTHKEY'):
+        return os.environ['EXO_RECORDER_AUTHKEY'].encode()
+
+    import utils
+    path = utils.working_dir() / '.exoskeleton' / AUTHKEY_FILE
+    if not path.is_file():
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # Written aside then linked into place, so no process ever reads a partial key.
+        fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix='.' + AUTHKEY_FILE)
+        try:
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(secrets.token_hex(32))
+            try:
+                os.link(tmp, str(path))
+            except FileExistsError:
+                # Another process created it first, use its key.
+                pass
+        finally:
+            os.unlink(tmp)
+
+    key = path.read_text().strip()
+    if not key:
+        raise RuntimeError('Empty recorder key in {}'.format(path))
+    return key.encode()
+
+
+class RecorderServer(object):
+    """
+    Serves a RecorderManager on a unix socket, one thread per connection.
+    """
+    def __init__(self, manager, address=DEFAULT_SOCKET, authkey=None):
+        self.manager = manager
+        self.address = address
+        self.authkey = load_authkey() if authkey is None else authkey
+
+    def serve_forever(self):
+        # A socket left by a previous run would prevent binding.
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+
+        with Listener(self.address, family='AF_UNIX', authkey=self.authkey) as listener:
+            print("Recorder process listening on {}".format(self.address))
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    print("Rejected recorder connection: {}".format(e))
+                    continue
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        """
+        Answer requests on one connection until the client closes it.
+        :return:
+        """
+        try:
+            while True:
+                try:
+                    method, args = conn.recv()
+                except EOFError:
+                    return
+
+                if method == 'subscribe':
+                    self.stream(conn, *args)
+                    return
+
+                if method == 'metrics':
+                    # The record writers only update the metrics of this process.
+                    conn.send(('ok', metrics.render_recorder()))
+                    continue
+
+                if method not in METHODS:
+                    conn.send(('error', 'ValueError', 'Unknown method {}'.format(method)))
+                    continue
+
+                try:
+                    result = getattr(self.manager, method)(*args.get('args', ()), **args.get('kwargs', {}))
+                except Exception as e:
+                    conn.send(('error', type(e).__name__, str(e)))
+                else:
+                    conn.send(('ok', result))
+        except (BrokenPipeError, ConnectionResetError, EOFError):
+            pass
+        finally:
+            conn.close()
+
+    def stream(self, conn, recorder_id):
+        """
+        Forward the samples of a recorder to a subscribed client.
+
+        The local subscriber drops the oldest blocks if the client is too slow,
+        so a stalled client never holds up the recorder.
+        :return:
+        """
+        sub = self.manager.subscribe(recorder_id)
+        if sub is None:
+            conn.send(('end', None, 0))
+            return
+
+        try:
+            while True:
+                first_index, block = sub.get_batch(SUBSCRIPTION_KEEPALIVE)
+                if block is not None:
+                    conn.send((first_index, block, sub.dropped))
+                elif sub.finished:
+                    conn.send(('end', None, sub.dropped))
+                    return
+                else:
+                    conn.send((None, None, sub.dropped))
+        finally:
+            sub.close()
+
+
+class RemoteSubscriber(object):
+    """
+    Live samples of a recorder running in the recorder process, see utils.SampleSubscriber.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.dropped = 0
+        self.finished = False
+
+    def get_batch(self, timeout):
+        """
+        Wait for new samples.
+        :return: (index of the first sample, array) or (None, None) on timeout
+        """
+        if self.finished or not self.conn.poll(timeout):
+            return None, None
+
+        try:
+            first_index, block, self.dropped = self.conn.recv()
+        except (EOFError, OSError):
+            self.finished = True
+            return None, None
+
+        if first_index == 'end':
+            self.finished = True
+            return None, None
+
+        return first_index, block
+
+    def close(self):
+        self.conn.close()
+
+
+class RecorderClient(object):
+    """
+    Talks to the recorder process, with the same methods as utils.RecorderManager.
+    """
+    def __init__(self, address=DEFAULT_SOCKET, authkey=None):
+        self.address = address
+        self.authkey = load_authkey() if authkey is None else authkey
+
+    def _call(self, method, *args, **kwargs):
+        with Client(self.address, family='AF_UNIX', authkey=self.authkey) as conn:
+            conn.send((method, {'args': args, 'kwargs': kwargs}))
+            reply = conn.recv()
+
+        if reply[0] == 'ok':
+            return reply[1]
+
+        # Re-raise errors the callers expect, e.g. a port already in use.
+        _, name, message = reply
+        if name in ('ValueError', 'KeyError'):
+            raise {'ValueError': ValueError, 'KeyError': KeyError}[name](message)
+        raise RuntimeError('{}: {}'.format(name, message))
+
+    def start(self, recorder_id, **kwargs):
+        return self._call('start', recorder_id, **kwargs)
+
+    def stop(self, recorder_id):
+        return self._call('stop', recorder_id)
+
+    def status(self, recorder_id):
+        return self._call('status', recorder_id)
+
+    def statuses(self):
+        return self._call('statuses')
+
+    def is_alive(self, recorder_id):
+        return self._call('is_alive', recorder_id)
+
+    def latest(self, recorder_id, n):
+        return self._call('latest', recorder_id, n)
+
+    def send_settings(self, port, baud, params, framing='csv', **kwargs):
+        return self._call('send_settings', port, baud, params, framing, **kwargs)
+
+    def metrics(self):
+        """
+        Metrics of the recorder process, see metrics.render_recorder.
+        :return: str
+        """
+        return self._call('metrics')
+
+    def subscribe(self, recorder_id):
+        if not self.is_alive(recorder_id):
+            return None
+        conn = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+        conn.send(('subscribe', (recorder_id,)))
+        return RemoteSubscriber(conn)
+
+
+if __name__ == '__main__':
+    import utils
+    import catalog
+
+    address = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('EXO_RECORDER_SOCKET', DEFAULT_SOCKET)
+
+    # Same data folder as the web server.
+    workingdir = utils.working_dir()
+    data_catalog = catalog.Catalog(workingdir / 'EXPDATA', workingdir / '.exoskeleton' / 'catalog.sqlite')
+
+    # The recorder process keeps the catalog in sync, the web workers only read it.
+    data_catalog.start()
+    manager = utils.RecorderManager(on_finish=lambda rec: data_catalog.update_path(rec.logfile))
+
+    RecorderServer(manager, address).serve_forever()
@@ -0,0 +1,325 @@
+"""
+Chunked access to recorded data, for both CSV recordings and binary records.
+"""
+import gzip
+import os
+
+import numpy as np
+
+import recformat
+import rowindex
+import segments
+
+# Number of rows read at once when streaming a record.
+CHUNK_ROWS = 4096
+
+# Files stored next to records that are not records themselves.
+SIDECAR_SUFFIXES = ('.pyr.npz', '.stats.json', '.idx.npz', '.part')
+
+
+def is_sidecar(name):
+    """
+    Check whether a file name is a sidecar (pyramid, statistics, index, temporary file...) of a record.
+    :return: bool
+    """
+    return str(name).endswith(SIDECAR_SUFFIXES)
+
+
+def is_record(path):
+    """
+    Check whether a path is a record: a file or a segmented recording.
+    :return: bool
+    """
+    return os.path.isfile(path) or segments.is_segmented(path)
+
+
+def record_signature(path):
+    """
+    Modification time and size of a record, they change whenever data is added.
+    :return: (mtime, size)
+    """
+    if not segments.is_segmented(path):
+        stat = os.stat(path)
+        return stat.st_mtime, stat.st_size
+
+    mtime, size = 0.0, 0
+    for entry in os.scandir(path):
+        # Sidecars of the segments are written by readers, they do not count.
+        if entry.is_file() and not is_sidecar(entry.name):
+            stat = entry.stat()
+            mtime = max(mtime, stat.st_mtime)
+            size += stat.st_size
+    return mtime, size
+
+
+def record_info(path):
+    """
+    Get the number of samples and channels of a record without parsing its data.
+    :return: dict with 'samples', 'channels', 'duration' and 'sample_period' (seconds)
+    """
+    if segments.is_segmented(path):
+        # Sealed segments are listed with their length, only the last one is counted.
+        samples = channels = 0
+        for first, rows, seg in segments.segment_files(path):
+            if rows is None or not channels:
+                info = record_info(seg)
+                channels = channels or info['channels']
+                rows = info['samples'] if rows is None else rows
+            samples = first + rows
+        period = segments.read_manifest(path).get('sample_period', recformat.SAMPLE_PERIOD)
+    elif recformat.is_binary_record(path):
+        with open(path, 'rb') as fp:
+            header = recformat.read_header(fp)
+            samples = recformat.count_rows(fp)
+        channels = len(header['channels'])
+        period = header.get('sample_period', recformat.SAMPLE_PERIOD)
+    else:
+        # The first line is the header (or a partial line), the last one may be incomplete.
+        samples = 0
+        second_line = None
+        # Members of gzip compressed recordings tell their number of lines.
+        members = None if rowindex.can_index(path) else rowindex.gzip_members(path)
+        with open_csv(path) as fp:
+            fp.readline()
+            second_line = fp.readline()
+            if members:
+                samples = max(sum(count for _, count in members) - 1, 0)
+            else:
+                if second_line.endswith(b'\n'):
+                    samples = 1
+                while True:
+                    chunk = fp.read(1 << 20)
+                    if not chunk:
+                        break
+                    samples += chunk.count(b'\n')
+        channels = second_line.count(b',') + 1 if second_line.strip() else 0
+        period = recformat.SAMPLE_PERIOD
+
+    return {'samples': samples,
+            'channels': channels,
+            'duration': round(samples * period, 6),
+            'sample_period': period}
+
+
+def open_csv(path):
+    """
+    Open a CSV recording for reading, gzip compressed recordings are decompressed on the fly.
+    :return: binary file object
+    """
+    if str(path).endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def resolve_range(start=0, stop=None, t0=None, t1=None, limit=None, sample_period=recformat.SAMPLE_PERIOD):
+    """
+    Convert a time range and a limit to rows, see RecordReader.
+    :return: (start, stop), stop is None for the end of the record
+    """
+    start = max(0, start)
+    if t0 is not None:
+        start = max(start, int(round(t0 / sample_period)))
+    if t1 is not None:
+        stop = int(round(t1 / sample_period)) if stop is None else min(stop, int(round(t1 / sample_period)))
+    if limit:
+        stop = start + limit if stop is None else min(stop, start + limit)
+    return start, stop
+
+
+def select_columns(names, channels):
+    """
+    Resolve requested channels (names or indices) to column indices.
+    :param names: column names of the record
+    :param channels: list of channel names or indices, or None for all
+    :return: list of column indices or None for all columns
+    """
+    if not channels:
+        return None
+
+    idx = []
+    for ch in channels:
+        if ch in names:
+            idx.append(names.index(ch))
+        elif str(ch).isdigit() and int(ch) < len(names):
+            idx.append(int(ch))
+        else:
+            raise KeyError('Unknown channel {}'.format(ch))
+
+    return idx
+
+
+class RecordReader(object):
+    """
+    Read a range of rows and a subset of channels of a record, chunk by chunk.
+
+    The range is given in rows (start, stop) or in seconds (t0, t1), times are
+    converted to rows with the sample period of the record. At most limit rows
+    are read.
+
+    The first chunk is read when the reader is opened so that errors and the
+    column names are known before anything is sent to the client.
+    """
+    def __init__(self, path, start=0, stop=None, channels=None, t0=None, t1=None,
+                 limit=None, chunk_rows=CHUNK_ROWS):
+        self.path = path
+        self.start = max(0, start)
+        self.stop = stop
+        self.t0 = t0
+        self.t1 = t1
+        self.limit = limit
+        self.channels = channels
+        self.chunk_rows = chunk_rows
+        self.columns = None
+        self.sample_period = recformat.SAMPLE_PERIOD
+        self._first = None
+        self._chunks = None
+
+    def open(self):
+        """
+        Open the record and read the first chunk.
+        :return: self
+        """
+        if segments.is_segmented(self.path):
+            self._chunks = self._segmented_chunks()
+        elif recformat.is_binary_record(self.path):
+            self._chunks = self._binary_chunks()
+        else:
+            self._chunks = self._csv_chunks()
+
+        self._first = next(self._chunks, None)
+        if self.columns is None:
+            self.columns = []
+
+        return self
+
+    def __iter__(self):
+        """
+        Iterate over the requested rows.
+        :return: yields 2D arrays, one row per sample
+        """
+        if self._first is not None:
+            first, self._first = self._first, None
+            yield first
+        for chunk in self._chunks:
+            yield chunk
+
+    def _resolve_range(self):
+        """
+        Convert the requested time range and limit to rows once the sample period is known.
+        :return:
+        """
+        self.start, self.stop = resolve_range(self.start, self.stop, self.t0, self.t1, self.limit,
+                                              self.sample_period)
+
+    def _select(self, names):
+        return select_columns(names, self.channels)
+
+    def _segmented_chunks(self):
+        """
+        Read the rows from the segments covering them, the others are not opened.
+        """
+        self.sample_period = segments.read_manifest(self.path).get('sample_period', self.sample_period)
+        self._resolve_range()
+
+        for first, rows, path in segments.segment_files(self.path):
+            if rows is not None and first + rows <= self.start:
+                continue
+            if self.stop is not None and first >= self.stop:
+                break
+
+            stop = None if self.stop is None else self.stop - first
+            reader = RecordReader(path, max(self.start - first, 0), stop, self.channels,
+                                  chunk_rows=self.chunk_rows).open()
+            if self.columns is None:
+                self.columns = reader.columns
+            for chunk in reader:
+                yield chunk
+
+    def _binary_chunks(self):
+        with open(self.path, 'rb') as fp:
+            header = recformat.read_header(fp)
+            self.sample_period = header.get('sample_period', self.sample_period)
+            self._resolve_range()
+            idx = self._select(header['channels'])
+            self.columns = header['channels'] if idx is None else [header['channels'][i] for i in idx]
+
+            for first, block in recformat.iter_blocks(fp, header, self.start, self.stop):
+                lo = max(self.start - first, 0)
+                hi = block.shape[0] if self.stop is None else min(self.stop - first, block.shape[0])
+                block = block[lo:hi]
+                if idx is not None:
+                    block = block[:, idx]
+                yield block
+
+    def _csv_chunks(self):
+        if rowindex.can_index(self.path):
+            yield from self._indexed_csv_chunks()
+        else:
+            yield from self._sequential_csv_chunks()
+
+    def _indexed_csv_chunks(self):
+        """
+        Parse only the requested rows, located with the row index.
+        """
+        self._resolve_range()
+
+        with rowindex.MappedCsv(self.path) as mapped:
+            names = mapped.header_names()
+            idx = self._select(names)
+            self.columns = names if idx is None else [names[i] for i in idx]
+
+            stop = mapped.rows if self.stop is None else min(self.stop, mapped.rows)
+            for row in range(self.start, stop, self.chunk_rows):
+                block = mapped.read_rows(names, row, min(row + self.chunk_rows, stop)).values
+                if idx is not None:
+                    block = block[:, idx]
+                yield block
+
+    def _sequential_csv_chunks(self):
+        import pandas as pd
+
+        self._resolve_range()
+
+        with open_csv(self.path) as fp:
+            names = rowindex.column_names(fp.readline(), fp.readline())
+        idx = self._select(names)
+        self.columns = names if idx is None else [names[i] for i in idx]
+        if not names:
+            return
+
+        # Start decompressing from the member holding the first row, see rowindex.gzip_members.
+        offset, skip, row = rowindex.gzip_seek(self.path, self.start) if self.start else (0, 1, 0)
+        with open(self.path, 'rb') as raw:
+            raw.seek(offset)
+            with gzip.GzipFile(fileobj=raw) as fp:
+                for _ in range(skip):
+                    fp.readline()
+
+                for df in pd.read_csv(fp, chunksize=self.chunk_rows, header=None, names=names):
+                    n = df.shape[0]
+                    if row + n > self.start:
+                        lo = max(self.start - row, 0)
+                        hi = n if self.stop is None else min(self.stop - row, n)
+                        block = df.values[lo:hi]
+                        if idx is not None:
+                            block = block[:, idx]
+                        yield block
+
+                    row += n
+                    if self.stop is not None and row >= self.stop:
+                        break
+
+
+def read_all(path, start=0, stop=None, channels=None, t0=None, t1=None):
+    """
+    Read a range of rows of a record into a single array.
+    :return: (column names, 2D array)
+    """
+    reader = RecordReader(path, start, stop, channels, t0, t1).open()
+    chunks = list(reader)
+    if chunks:
+        data = np.concatenate(chunks)
+    else:
+        data = np.zeros((0, len(reader.columns)))
+
+    return reader.columns, data
@@ -0,0 +1,348 @@
+"""
+Row offset index of CSV recordings, for random access without parsing them.
+
+The index holds the byte offset of every INDEX_STRIDE-th row and is stored
+next to the recording in a '.idx.npz' file. It is built on first access by
+scanning the memory-mapped file for newlines with numpy, and extended
+rather than rebuilt when the recording has grown since. An index is only
+extended if the file is the one it was built from, i.e. same inode and same
+bytes at its beginning and before the last indexed row (see fingerprint);
+otherwise the recording was replaced and it is rebuilt.
+
+To find a row, the reader jumps to the closest indexed row before it and
+counts the newlines in between, so reading any range of rows only touches
+the lines of that range.
+
+Rows are numbered like the CSV reader does: the first line is the header,
+row 0 is the second line. Only complete lines (ending with a newline) count.
+
+Gzip compressed recordings cannot be mapped. They are written as a series of
+independent gzip members (see gzip_member) whose headers carry, in an extra
+field ignored by other gzip readers, the compressed size of the member and
+the number of newlines in it. Walking from header to header finds the member
+holding a row without decompressing anything before it.
+"""
+import io
+import mmap
+import os
+import struct
+import zlib
+from pathlib import Path
+
+import numpy as np
+
+INDEX_SUFFIX = '.idx.npz'
+
+# Rows between two indexed offsets.
+INDEX_STRIDE = 1024
+
+# Bytes scanned for newlines at once while building the index.
+SCAN_BYTES = 16 * 1024 * 1024
+
+# Bytes checked at the beginning of a recording and before the last indexed row, see fingerprint.
+FINGERPRINT_BYTES = 4096
+
+_NEWLINE = ord('\n')
+
+# Gzip member header with an extra field: magic, deflate, FEXTRA flag, mtime, XFL, OS and XLEN.
+_GZIP_HEADER = struct.Struct('<4sIBBH')
+# Extra subfield of the members: id, length, compressed size of the member and newlines in it.
+_GZIP_EXTRA = struct.Struct('<2sHII')
+GZIP_SUBFIELD = b'RC'
+
+
+def index_path(record_file):
+    """
+    Path of the index file of a recording.
+    :return: Path
+    """
+    record_file = Path(record_file)
+    return record_file.with_name(record_file.name + INDEX_SUFFIX)
+
+
+def _is_number(field):
+    try:
+        float(field)
+    except ValueError:
+        return False
+    return True
+
+
+def column_names(header_line, first_row):
+    """
+    Column names of a CSV recording from its first two lines.
+
+    Recordings of decoded samples start with a header line. Raw recordings
+    start with a partial line of samples instead, their columns are named
+    V0, V1, ... like in the live views.
+    :param header_line, first_row: bytes
+    :return: list
+    """
+    fields = [f.strip() for f in header_line.decode(errors='replace').strip().split(',')]
+    width = first_row.count(b',') + 1 if first_row.strip() else len(fields)
+    if len(fields) == width and all(f and not _is_number(f) for f in fields):
+        return fields
+    return ['V{}'.format(i) for i in range(width)]
+
+
+def can_index(record_file):
+    """
+    Only uncompressed CSV recordings can be mapped and indexed.
+    :return: bool
+    """
+    return not str(record_file).endswith('.gz')
+
+
+def _scan(mm, begin, end, newlines, stride, starts):
+    """
+    Add the offsets of the indexed rows starting in mm[begin:end].
+    :param newlines: number of newlines before begin
+    :param starts: list of offsets, extended in place
+    :return: (number of newlines before end, offset after the last newline or None)
+    """
+    last = None
+    pos = begin
+    while pos < end:
+        size = min(SCAN_BYTES, end - pos)
+        found = np.flatnonzero(np.frombuffer(mm, dtype=np.uint8, count=size, offset=pos) == _NEWLINE)
+        if found.size:
+            # Newline number c ends the line before row c, which starts right after it.
+            counts = newlines + np.arange(found.size)
+            starts.extend((found[counts % stride == 0] + pos + 1).tolist())
+            newlines += found.size
+            last = int(found[-1]) + pos + 1
+        pos += size
+    return newlines, last
+
+
+def fingerprint(mm, indexed_size):
+    """
+    Checksum of the first bytes of a mapped recording and of the bytes before indexed_size.
+    :return: int
+    """
+    head = zlib.crc32(mm[:min(FINGERPRINT_BYTES, indexed_size)])
+    tail = zlib.crc32(mm[max(0, indexed_size - FINGERPRINT_BYTES):indexed_size])
+    return head << 32 | tail
+
+
+class RowIndex(object):
+    """
+    Offsets of the rows of a CSV recording.
+    """
+    def __init__(self, starts, rows, header_end, indexed_size, mtime, inode=0, checksum=0, stride=INDEX_STRIDE):
+        # starts[k] is the offset of row k * stride.
+        self.starts = np.asarray(starts, dtype=np.int64)
+        # Number of complete rows.
+        self.rows = rows
+        # Offset of row 0, i.e. the end of the header line.
+        self.header_end = header_end
+        # Offset after the last complete row.
+        self.indexed_size = indexed_size
+        self.mtime = mtime
+        # Identify the indexed file, see fingerprint.
+        self.inode = inode
+        self.checksum = checksum
+        self.stride = stride
+
+    @classmethod
+    def build(cls, mm, mtime, inode=0, previous=None, stride=INDEX_STRIDE):
+        """
+        Index a mapped recording, continuing from a previous index of its beginning.
+        :return: RowIndex
+        """
+        if previous is not None and previous.stride == stride and previous.header_end is not None:
+            starts = previous.starts.tolist()
+            # Every complete row has a newline, plus the header line.
+            newlines, begin = previous.rows + 1, previous.indexed_size
+            header_end = previous.header_end
+        else:
+            starts, newlines, begin, header_end = [], 0, 0, None
+
+        newlines, last = _scan(mm, begin, len(mm), newlines, stride, starts)
+        if header_end is None and starts:
+            header_end = starts[0]
+
+        indexed_size = last if last is not None else begin
+        rows = max(newlines - 1, 0)
+        return cls(starts, rows, header_end, indexed_size, mtime, inode, fingerprint(mm, indexed_size), stride)
+
+    def save(self, path):
+        # Write to a temporary file first, so that readers never see half an index.
+        tmp = path.with_name(path.name + '.part')
+        with open(tmp, 'wb') as fp:
+            np.savez(fp, starts=self.starts, rows=np.int64(self.rows),
+                     header_end=np.int64(-1 if self.header_end is None else self.header_end),
+                     indexed_size=np.int64(self.indexed_size), mtime=np.float64(self.mtime),
+                     inode=np.uint64(self.inode), checksum=np.uint64(self.checksum), stride=np.int64(self.stride))
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as npz:
+            header_end = int(npz['header_end'])
+            return cls(npz['starts'], int(npz['rows']), None if header_end < 0 else header_end,
+                       int(npz['indexed_size']), float(npz['mtime']), int(npz['inode']), int(npz['checksum']),
+                       int(npz['stride']))
+
+    def row_offset(self, mm, row):
+        """
+        Offset of the start of a row, row == self.rows gives the end of the last row.
+        :return: int
+        """
+        if row >= self.rows:
+            return self.indexed_size
+
+        k, skip = divmod(row, self.stride)
+        base = int(self.starts[k])
+        if skip == 0:
+            return base
+
+        end = int(self.starts[k + 1]) if k + 1 < len(self.starts) else self.indexed_size
+        found = np.flatnonzero(np.frombuffer(mm, dtype=np.uint8, count=end - base, offset=base) == _NEWLINE)
+        return base + int(found[skip - 1]) + 1
+
+
+def load_index(record_file, mm):
+    """
+    Load the index of a mapped recording, building or extending it if it is out of date.
+    :return: RowIndex
+    """
+    record_file = Path(record_file)
+    path = index_path(record_file)
+    st = os.stat(record_file)
+
+    previous = None
+    if path.is_file():
+        try:
+            previous = RowIndex.load(path)
+        except (OSError, ValueError, KeyError):
+            previous = None
+
+    if previous is not None:
+        if (previous.inode != st.st_ino or previous.indexed_size > len(mm) or
+                previous.checksum != fingerprint(mm, previous.indexed_size)):
+            # The recording was replaced, the old offsets are meaningless.
+            previous = None
+        elif previous.mtime == st.st_mtime:
+            return previous
+
+    index = RowIndex.build(mm, st.st_mtime, st.st_ino, previous)
+    index.save(path)
+    return index
+
+
+class MappedCsv(object):
+    """
+    Memory-mapped CSV recording with its row index.
+    """
+    def __init__(self, record_file):
+        self.record_file = Path(record_file)
+        self.fp = None
+        self.mm = None
+        self.index = None
+
+    def open(self):
+        self.fp = open(self.record_file, 'rb')
+        size = os.fstat(self.fp.fileno()).st_size
+        # Empty files cannot be mapped.
+        self.mm = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.index = load_index(self.record_file, self.mm)
+        return self
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+        if self.fp is not None:
+            self.fp.close()
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def rows(self):
+        return self.index.rows
+
+    def header_names(self):
+        """
+        Column names, see column_names.
+        :return: list
+        """
+        if self.index.header_end is None:
+            return []
+        first_row = self.mm[self.index.header_end:self.index.row_offset(self.mm, 1)] if self.rows else b''
+        return column_names(self.mm[:self.index.header_end], first_row)
+
+    def read_rows(self, names, start, stop):
+        """
+        Parse rows [start, stop).
+        :return: pandas DataFrame
+        """
+        import pandas as pd
+
+        stop = min(stop, self.rows)
+        if start >= stop:
+            return pd.DataFrame(columns=names)
+
+        a = self.index.row_offset(self.mm, start)
+        b = self.index.row_offset(self.mm, stop)
+        return pd.read_csv(io.BytesIO(self.mm[a:b]), header=None, names=names)
+
+
+def gzip_member(data, compresslevel=1):
+    """
+    Compress data as one gzip member carrying its size and number of newlines.
+    :return: bytes
+    """
+    deflate = zlib.compressobj(compresslevel, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = deflate.compress(data) + deflate.flush()
+    size = _GZIP_HEADER.size + _GZIP_EXTRA.size + len(body) + 8
+    # XFL 0, OS 255 (unknown).
+    return (_GZIP_HEADER.pack(b'\x1f\x8b\x08\x04', 0, 0, 255, _GZIP_EXTRA.size) +
+            _GZIP_EXTRA.pack(GZIP_SUBFIELD, _GZIP_EXTRA.size - 4, size, data.count(b'\n')) +
+            body + struct.pack('<II', zlib.crc32(data), len(data) & 0xffffffff))
+
+
+def gzip_members(record_file):
+    """
+    Offsets and newline counts of the members of a gzip compressed recording, read from their headers.
+
+    A member cut short (being written) ends the list.
+    :return: list of (offset, newlines), or None if the members do not carry them
+    """
+    members = []
+    with open(record_file, 'rb') as fp:
+        end = os.fstat(fp.fileno()).st_size
+        offset = 0
+        while offset < end:
+            fp.seek(offset)
+            head = fp.read(_GZIP_HEADER.size + _GZIP_EXTRA.size)
+            if len(head) < _GZIP_HEADER.size + _GZIP_EXTRA.size:
+                break
+            magic, _, _, _, xlen = _GZIP_HEADER.unpack_from(head)
+            subfield, length, size, newlines = _GZIP_EXTRA.unpack_from(head, _GZIP_HEADER.size)
+            if magic != b'\x1f\x8b\x08\x04' or xlen != _GZIP_EXTRA.size or subfield != GZIP_SUBFIELD:
+                return None
+            if offset + size > end:
+                break
+            members.append((offset, newlines))
+            offset += size
+    return members
+
+
+def gzip_seek(record_file, row):
+    """
+    Find where to start decompressing a gzip compressed recording to read from a row.
+    :return: (offset of the member, number of lines to skip from there, row after them)
+    """
+    members = gzip_members(record_file)
+    # Row r starts after newline r + 1.
+    newlines = 0
+    for offset, count in members or ():
+        if newlines + count >= row + 1:
+            return offset, row + 1 - newlines, row
+        newlines += count
+    # Unknown members, or a row past the indexed ones: decompress from the start.
+    return 0, 1, 0
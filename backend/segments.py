@@ -0,0 +1,275 @@
+"""
+Segmented recordings.
+
+A segmented recording is a folder named after the record with the '.seg'
+extension, holding a series of segment files and a manifest:
+
+    rec_1.seg/
+        manifest.json
+        seg_00000.csv         sealed segment
+        seg_00001.csv         sealed segment
+        seg_00002.part.csv    segment being written
+
+The recorder rolls to a new segment once the current one holds
+SEGMENT_BYTES or covers SEGMENT_SECONDS. A segment is sealed by flushing it
+to disk and renaming it to its final name, then the manifest, listing the
+first row and number of rows of every sealed segment, is replaced
+atomically. After a power cut, sealed segments are complete and only the
+'.part' segment can end with an incomplete row. The '.part' marker goes
+before the extension, so the segment being written can be read like any
+other. Row indexes built by readers of the '.part' segment (see rowindex)
+follow it when it is renamed.
+
+Segments are either CSV files of decoded samples, each starting with a
+'V0,V1,...' header line, or binary records (see recformat). Readers use the
+manifest to open only the segments covering the rows they need.
+"""
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+import recformat
+import rowindex
+
+EXTENSION = '.seg'
+MANIFEST = 'manifest.json'
+
+# Size of a segment before rolling to the next one (bytes, before compression).
+SEGMENT_BYTES = 16 * 1024 * 1024
+
+# Time covered by a segment before rolling to the next one (seconds).
+SEGMENT_SECONDS = 300.0
+
+
+def is_segmented(path):
+    """
+    Check whether a path is a segmented recording.
+    :return: bool
+    """
+    path = Path(path)
+    return path.name.endswith(EXTENSION) and (path / MANIFEST).is_file()
+
+
+def _fsync_dir(path):
+    # Make renames in a folder durable, not available on every platform.
+    try:
+        fd = os.open(str(path), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_manifest(folder, manifest):
+    """
+    Atomically replace the manifest of a segmented recording.
+    :return:
+    """
+    folder = Path(folder)
+    fd, tmp = tempfile.mkstemp(dir=str(folder), prefix=MANIFEST, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as fp:
+            json.dump(manifest, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, str(folder / MANIFEST))
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    _fsync_dir(folder)
+
+
+def read_manifest(folder):
+    with open(Path(folder) / MANIFEST, 'r') as fp:
+        return json.load(fp)
+
+
+def segment_files(folder):
+    """
+    Segments of a recording, in order.
+    :return: list of (first row, number of rows or None if unknown, path)
+    """
+    folder = Path(folder)
+    manifest = read_manifest(folder)
+    segments = [(s['first_row'], s['rows'], folder / s['name']) for s in manifest['segments']]
+
+    current = manifest.get('current')
+    if current is not None:
+        # The segment may have been sealed right before a crash, before the manifest was updated.
+        path = folder / current['name']
+        if not path.is_file():
+            path = folder / part_name(current['name'])
+        if path.is_file():
+            segments.append((current['first_row'], None, path))
+
+    return segments
+
+
+def _remove_orphan_indexes(folder):
+    """
+    Remove the row indexes of '.part' segments that are gone, e.g. written by a reader during sealing.
+    :return:
+    """
+    for entry in os.scandir(str(folder)):
+        name = entry.name
+        if '.part.' in name and name.endswith(rowindex.INDEX_SUFFIX) and \
+                not os.path.exists(os.path.join(str(folder), name[:-len(rowindex.INDEX_SUFFIX)])):
+            try:
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+
+
+def part_name(name):
+    """
+    Name of a segment while it is being written, e.g. seg_00002.part.csv.gz.
+    :return: str
+    """
+    stem, _, suffix = name.partition('.')
+    return '{}.part.{}'.format(stem, suffix)
+
+
+class SegmentedRecordFile(object):
+    """
+    Write samples to a segmented recording, rolling to a new segment on a size or time budget.
+    """
+    def __init__(self, path, fmt='csv', compress=False, sample_period=recformat.SAMPLE_PERIOD,
+                 segment_bytes=SEGMENT_BYTES, segment_seconds=SEGMENT_SECONDS):
+        self.folder = Path(path)
+        self.fmt = fmt
+        self.compress = compress
+        self.sample_period = sample_period
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        # Column names, defaults to V0, V1, ...
+        self.channels = None
+
+        if fmt == 'bin':
+            self.suffix = recformat.EXTENSION
+        else:
+            self.suffix = '.csv.gz' if compress else '.csv'
+
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.manifest = {'version': 1,
+                         'format': fmt,
+                         'compression': ('zlib' if fmt == 'bin' else 'gzip') if compress else None,
+                         'sample_period': sample_period,
+                         'created': time.time(),
+                         'finished': False,
+                         'segments': [],
+                         'current': None}
+        write_manifest(self.folder, self.manifest)
+
+        # Current segment.
+        self.out = None
+        self.rows = 0
+        self.bytes = 0
+        self.started = None
+        # Rows in all the segments so far.
+        self.total_rows = 0
+
+    def _open(self, width):
+        name = 'seg_{:05d}{}'.format(len(self.manifest['segments']), self.suffix)
+        path = self.folder / part_name(name)
+
+        if self.fmt == 'bin':
+            self.out = recformat.BinaryRecordFile(path, channels=self.channels, sample_period=self.sample_period,
+                                                  compression='zlib' if self.compress else None)
+        else:
+            # utils imports this module, import it when it is needed.
+            import utils
+            self.out = utils.GzipMemberFile(path) if self.compress else open(path, 'wb')
+            names = self.channels or ['V{}'.format(i) for i in range(width)]
+            self.out.write(','.join(names).encode() + b'\n')
+
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.time()
+        self.manifest['current'] = {'name': name, 'first_row': self.total_rows, 'started': self.started}
+        write_manifest(self.folder, self.manifest)
+
+    def write(self, block):
+        """
+        Write a block of samples, a block is never split across segments.
+        :param block: 2D array, one row per sample
+        :return:
+        """
+        block = np.asarray(block)
+        if block.ndim != 2 or block.shape[0] == 0:
+            return 0
+
+        if self.out is None:
+            self._open(block.shape[1])
+
+        if self.fmt == 'bin':
+            self.out.write(block)
+            size = block.nbytes
+        else:
+            import utils
+            data = utils.encode_csv(block)
+            self.out.write(data)
+            size = len(data)
+
+        self.rows += block.shape[0]
+        self.total_rows += block.shape[0]
+        self.bytes += size
+
+        if self.bytes >= self.segment_bytes or time.time() - self.started >= self.segment_seconds:
+            self.seal()
+        return size
+
+    def seal(self):
+        """
+        Close the current segment, rename it to its final name and list it in the manifest.
+        :return:
+        """
+        if self.out is None:
+            return
+
+        self.out.flush()
+        fp = getattr(self.out, 'fp', self.out)
+        os.fsync(fp.fileno())
+        self.out.close()
+        self.out = None
+
+        current = self.manifest['current']
+        part = self.folder / part_name(current['name'])
+        os.replace(str(part), str(self.folder / current['name']))
+        # The index describes the same bytes under the new name.
+        try:
+            os.replace(str(rowindex.index_path(part)), str(rowindex.index_path(self.folder / current['name'])))
+        except FileNotFoundError:
+            pass
+
+        self.manifest['segments'].append({'name': current['name'],
+                                          'first_row': current['first_row'],
+                                          'rows': self.rows,
+                                          'started': current['started'],
+                                          'sealed': time.time()})
+        self.manifest['current'] = None
+        write_manifest(self.folder, self.manifest)
+
+    def flush(self):
+        if self.out is not None:
+            self.out.flush()
+
+    def close(self):
+        self.seal()
+        self.manifest['finished'] = True
+        write_manifest(self.folder, self.manifest)
+        _remove_orphan_indexes(self.folder)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -1,4 +1,4 @@
-#!/bin/sh
+#!/bin/bash
 
 set -ex
 
@@ -33,4 +33,20 @@ DBUS_SYSTEM_BUS_ADDRESS=unix:path=/host/run/dbus/system_bus_socket \
 nginx
 
 # Start the backend
-python -u main.py
\ No newline at end of file
+if [ "$EXO_SERVER_MODE" = "production" ]; then
+  # Recorders run in their own process, the web workers talk to it through a socket.
+  export EXO_RECORDER_SOCKET="${EXO_RECORDER_SOCKET:-/tmp/exo-recorder.sock}"
+  python -u recorderd.py &
+  # The workers split the record cache (EXO_CACHE_MB) between them. Every worker has its own HTTP
+  # metrics, /metrics shows those of the worker answering the scrape.
+  export EXO_WEB_WORKERS="${EXO_WEB_WORKERS:-3}"
+  gunicorn -w "$EXO_WEB_WORKERS" --threads 4 -k gthread -b 0.0.0.0:5050 wsgi:app &
+  # If either process exits, stop the other and fail so that the container is restarted.
+  set +e
+  wait -n
+  status=$?
+  kill $(jobs -p) 2>/dev/null
+  exit $(( status ? status : 1 ))
+else
+  python -u main.py
+fi
@@ -0,0 +1,76 @@
+"""
+Timing of the service start up.
+
+Imported first by main, so that the time spent importing the other modules
+can be told apart from the time the interpreter itself took to start. Phases
+are marked as start up goes, then reported on the console and exported on
+/metrics. For a per module breakdown of the imports, run:
+    python -X importtime main.py
+"""
+import os
+import sys
+import time
+
+import metrics
+
+_T0 = time.perf_counter()
+_last = _T0
+
+# (phase, seconds), in order.
+PHASES = []
+
+# Modules worth knowing whether start up loaded them.
+HEAVY_MODULES = ('pandas', 'numpy', 'serial', 'msgpack', 'sqlite3')
+
+
+def interpreter_seconds():
+    """
+    Time between the start of the process and the import of this module.
+    :return: seconds, or None if unknown
+    """
+    try:
+        with open('/proc/self/stat', 'r') as fp:
+            # The command name may contain spaces, the fields after it do not.
+            fields = fp.read().rsplit(')', 1)[1].split()
+        with open('/proc/uptime', 'r') as fp:
+            uptime = float(fp.read().split()[0])
+        started = int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+    # Clock ticks only give a 10 ms resolution.
+    return max(0.0, uptime - started - (time.perf_counter() - _T0))
+
+
+_interpreter = interpreter_seconds()
+if _interpreter is not None:
+    PHASES.append(('interpreter', _interpreter))
+
+
+def mark(phase):
+    """
+    End a phase of the start up.
+    :return:
+    """
+    global _last
+    now = time.perf_counter()
+    PHASES.append((phase, now - _last))
+    _last = now
+
+
+def report():
+    """
+    Print where the start up time went.
+    :return:
+    """
+    total = sum(seconds for _, seconds in PHASES)
+    print("Start up took {:.2f} s:".format(total))
+    for phase, seconds in PHASES:
+        print("  {:<12} {:6.2f} s".format(phase, seconds))
+    loaded = [m for m in HEAVY_MODULES if m in sys.modules]
+    print("  loaded: {}".format(', '.join(loaded) or 'none'))
+
+
+@metrics.register_collector
+def startup_metrics():
+    return [('exo_startup_seconds', 'gauge', 'Time spent in each phase of the start up.',
+             [({'phase': phase}, seconds) for phase, seconds in PHASES])]
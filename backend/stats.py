@@ -0,0 +1,284 @@
+"""
+Summary statistics of records, cached next to the records.
+
+The statistics of a record are computed in two passes over its chunks, in
+constant memory. The first pass accumulates per channel count, sum, sum of
+squares, min and max with numpy, giving the mean, RMS, min and max. The
+second pass counts gait cycles on the signal averaged over GAIT_SMOOTHING
+samples.
+
+Gait cycles are counted per channel as the number of times the smoothed
+signal rises from below mean - h to above mean + h, with h a fraction of the
+standard deviation, so noise around the mean is not counted.
+
+The effective sample rate tells how fast samples were really recorded.
+Binary records store when recording started, CSV records need a time column
+(see TIME_COLUMNS).
+
+Results are stored in a '.stats.json' file next to the record and reused as
+long as the record's modification time and size and STATS_VERSION do not
+change.
+"""
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+import recformat
+import records
+
+STATS_SUFFIX = '.stats.json'
+
+# Version of the statistics files, files of other versions are recomputed.
+STATS_VERSION = 3
+
+# Samples averaged together before counting gait cycles.
+GAIT_SMOOTHING = 5
+
+# Hysteresis of the gait cycle detection, in standard deviations.
+GAIT_HYSTERESIS = 0.25
+
+# Time columns of CSV records, by name, with their unit (seconds).
+TIME_COLUMNS = {'t': 1.0, 'time': 1.0, 'time_ms': 0.001}
+
+# Unit of the first channel of headerless CSV records, when it is a timestamp (seconds).
+# It is only taken as time if it keeps increasing at about the nominal sample rate.
+TIME_UNIT = 0.001
+
+
+def stats_path(record_file):
+    """
+    Path of the statistics file of a record.
+    :return: Path
+    """
+    record_file = Path(record_file)
+    return record_file.with_name(record_file.name + STATS_SUFFIX)
+
+
+class CycleCounter(object):
+    """
+    Counts the rising crossings of the mean of every column, with hysteresis, block by block.
+    """
+    def __init__(self, mean, std, hysteresis=GAIT_HYSTERESIS):
+        band = hysteresis * std
+        self.low = mean - band
+        self.high = mean + band
+        # Last state of every column outside the band, 0 until there is one.
+        self.state = np.zeros(len(mean), dtype=np.int8)
+        self.counts = np.zeros(len(mean), dtype=np.int64)
+
+    def feed(self, signal):
+        """
+        :param signal: 2D array, one row per sample
+        :return:
+        """
+        # +1 above the band, -1 below it, 0 inside it (keeps the previous state).
+        state = np.where(signal > self.high, 1, np.where(signal < self.low, -1, 0)).astype(np.int8)
+
+        for j, col in enumerate(state.T):
+            col = col[col != 0]
+            if col.size == 0:
+                continue
+            if self.state[j]:
+                col = np.concatenate([self.state[j:j + 1], col])
+            self.counts[j] += np.count_nonzero((col[1:] == 1) & (col[:-1] == -1))
+            self.state[j] = col[-1]
+
+
+def count_cycles(signal, mean, std, hysteresis=GAIT_HYSTERESIS):
+    """
+    Count the rising crossings of the mean of every column, with hysteresis.
+    :param signal: 2D array, one row per sample
+    :return: int array, one count per column
+    """
+    counter = CycleCounter(mean, std, hysteresis)
+    counter.feed(signal)
+    return counter.counts
+
+
+def _time_column(columns):
+    """
+    Time column of a record and its unit, see TIME_COLUMNS and TIME_UNIT.
+    :return: (index, unit in seconds, True if the rate must be checked) or None
+    """
+    for i, name in enumerate(columns):
+        if str(name).lower() in TIME_COLUMNS:
+            return i, TIME_COLUMNS[str(name).lower()], False
+    if columns and columns[0] == 'V0':
+        return 0, TIME_UNIT, True
+    return None
+
+
+def count_gait_cycles(chunks, mean, std):
+    """
+    Count the gait cycles of every channel of a record, second pass of compute_stats.
+    :param chunks: iterable of 2D arrays, the rows of the record
+    :return: int array, one count per channel
+    """
+    counter = CycleCounter(mean, std)
+    carry = None
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        # Average groups of samples, carrying over an incomplete group.
+        if carry is not None:
+            chunk = np.concatenate([carry, chunk])
+        full = (chunk.shape[0] // GAIT_SMOOTHING) * GAIT_SMOOTHING
+        counter.feed(chunk[:full].reshape(-1, GAIT_SMOOTHING, chunk.shape[1]).mean(axis=1))
+        carry = chunk[full:]
+    return counter.counts
+
+
+def compute_stats(record_file, load=None):
+    """
+    Compute the statistics of a record in two passes.
+    :param load: function returning the whole record as (column names, 2D array, sample period),
+                 e.g. from a cache, or None to read it chunk by chunk
+    :return: dict
+    """
+    record_file = Path(record_file)
+    mtime, size = records.record_signature(record_file)
+
+    parsed = load() if load is not None else None
+    if parsed is not None:
+        columns, data, period = parsed
+        chunks = [data]
+    else:
+        # Opening reads the first chunk, the columns and sample period are known from then on.
+        chunks = records.RecordReader(record_file).open()
+        columns, period = list(chunks.columns), chunks.sample_period
+
+    n = 0
+    total = total_sq = low = high = None
+    # Time column: index, unit, check, first and last value, and whether it kept increasing.
+    time_column = first_time = last_time = None
+    increasing = True
+    for chunk in chunks:
+        chunk = np.asarray(chunk, dtype=np.float64)
+        if chunk.shape[0] == 0:
+            continue
+        if total is None:
+            width = chunk.shape[1]
+            total, total_sq = np.zeros(width), np.zeros(width)
+            low, high = np.full(width, np.inf), np.full(width, -np.inf)
+            if not recformat.is_binary_record(record_file):
+                time_column = _time_column(columns)
+
+        n += chunk.shape[0]
+        total += chunk.sum(axis=0)
+        total_sq += np.square(chunk).sum(axis=0)
+        np.minimum(low, chunk.min(axis=0), out=low)
+        np.maximum(high, chunk.max(axis=0), out=high)
+
+        if time_column is not None and increasing:
+            t = chunk[:, time_column[0]]
+            if first_time is None:
+                first_time = t[0]
+            increasing = bool(np.all(np.diff(t) > 0)) and (last_time is None or t[0] > last_time)
+            last_time = t[-1]
+
+    result = {'version': STATS_VERSION,
+              'mtime': mtime,
+              'size': size,
+              'samples': n,
+              'duration': round(n * period, 6),
+              'sample_rate': 1.0 / period,
+              'effective_sample_rate': None,
+              'channels': {}}
+
+    # The header of binary records tells when recording started, the last write when it stopped.
+    # Records converted after the fact were written much faster than real time and get none.
+    if recformat.is_binary_record(record_file):
+        with open(record_file, 'rb') as fp:
+            created = recformat.read_header(fp).get('created')
+        elapsed = mtime - created if created else 0.0
+        if n and elapsed >= 0.5 * n * period:
+            result['effective_sample_rate'] = n / elapsed
+    elif time_column is not None and increasing and n > 1:
+        # Time from the first to the last sample, covering n - 1 periods.
+        _, unit, check = time_column
+        rate = (n - 1) / ((last_time - first_time) * unit)
+        if not check or 0.5 <= rate * period <= 2.0:
+            result['effective_sample_rate'] = rate
+
+    if n == 0:
+        return result
+
+    mean = total / n
+    rms = np.sqrt(total_sq / n)
+    std = np.sqrt(np.maximum(total_sq / n - mean ** 2, 0.0))
+    cycles = count_gait_cycles([data] if parsed is not None else records.RecordReader(record_file).open(),
+                               mean, std)
+
+    for i, name in enumerate(columns):
+        result['channels'][str(name)] = {'mean': float(mean[i]),
+                                         'rms': float(rms[i]),
+                                         'min': float(low[i]),
+                                         'max': float(high[i]),
+                                         'sum': float(total[i]),
+                                         'sum_sq': float(total_sq[i]),
+                                         'cycles': int(cycles[i])}
+    return result
+
+
+def record_stats(record_file, load=None):
+    """
+    Statistics of a record, from its statistics file if it is up to date.
+    :param load: see compute_stats
+    :return: dict
+    """
+    record_file = Path(record_file)
+    path = stats_path(record_file)
+    mtime, size = records.record_signature(record_file)
+
+    try:
+        with open(path, 'r') as fp:
+            cached = json.load(fp)
+        if cached.get('version') == STATS_VERSION and cached['mtime'] == mtime and cached['size'] == size:
+            return cached
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+
+    result = compute_stats(record_file, load)
+
+    # Write to a temporary file first, so that readers never see half a file.
+    tmp = path.with_name(path.name + '.part')
+    with open(tmp, 'w') as fp:
+        json.dump(result, fp)
+    os.replace(tmp, path)
+
+    return result
+
+
+def rollup(stats_list):
+    """
+    Combine the statistics of several records, channels are matched by name.
+    :param stats_list: list of record statistics
+    :return: dict
+    """
+    samples = sum(s['samples'] for s in stats_list)
+    combined = {}
+    for s in stats_list:
+        for name, ch in s['channels'].items():
+            c = combined.setdefault(name, {'samples': 0, 'sum': 0.0, 'sum_sq': 0.0,
+                                           'min': np.inf, 'max': -np.inf, 'cycles': 0})
+            c['samples'] += s['samples']
+            c['sum'] += ch['sum']
+            c['sum_sq'] += ch['sum_sq']
+            c['min'] = min(c['min'], ch['min'])
+            c['max'] = max(c['max'], ch['max'])
+            c['cycles'] += ch['cycles']
+
+    channels = {}
+    for name, c in combined.items():
+        channels[name] = {'mean': c['sum'] / c['samples'],
+                          'rms': float(np.sqrt(c['sum_sq'] / c['samples'])),
+                          'min': c['min'],
+                          'max': c['max'],
+                          'samples': c['samples'],
+                          'cycles': c['cycles']}
+
+    return {'records': len(stats_list),
+            'samples': samples,
+            'duration': round(sum(s['duration'] for s in stats_list), 6),
+            'channels': channels}
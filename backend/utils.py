@@ -2,9 +2,19 @@ import threading
 import serial
 import queue
 import time
+import collections
+import os
 from pathlib import Path
 import sys
 import msgpack
+import numpy as np
+import recformat
+import rowindex
+import segments
+import pipeline as pipeline_module
+import framing as framing_module
+import commands
+import metrics
 
 # DEFAULT_CONFIG = {"serial":
 #                       {"port": '/dev/cu.usbmodem14401',
@@ -65,31 +75,409 @@ DEFAULT_CONFIG = {"serial": DEFAULT_SERIAL_SETTINGS,
                   "assistance": DEFAULT_ASSIST_SETTINGS
                   }
 
+def working_dir():
+    """
+    Folder holding the configuration and the recorded data.
+
+    Can be overridden with the EXO_DATA_DIR environment variable.
+    :return: Path
+    """
+    if os.environ.get('EXO_DATA_DIR'):
+        return Path(os.environ['EXO_DATA_DIR'])
+    # If we're on macos, use the Home directory
+    elif sys.platform == 'darwin':
+        return Path.home()
+    else:
+        return Path('/data')
+
+
+# Period between two samples sent by the micro-controller (seconds).
+SAMPLE_PERIOD = 0.01
+
+# Number of most recent samples kept in memory by the recorder.
+RINGBUFFER_SIZE = 4096
+
+# Maximum time a serial read blocks waiting for data (seconds).
+READ_TIMEOUT = 0.05
+
+# The record writer flushes to disk once this many bytes are pending...
+FLUSH_BYTES = 64 * 1024
+# ...or once this much time has passed since the last flush (seconds).
+FLUSH_INTERVAL = 1.0
+
+# Interval over which the ingest rates of the recorder are computed (seconds).
+RATE_INTERVAL = 1.0
+
+
+class RingBuffer(object):
+    """
+    Fixed-size, array-backed ring buffer holding the most recent samples.
+
+    The number of columns is taken from the first block written to the buffer.
+    """
+    def __init__(self, capacity=RINGBUFFER_SIZE):
+        self.capacity = capacity
+        # Sample storage. Allocated on first write once the width is known.
+        self.data = None
+        # Total number of samples ever written to the buffer.
+        self.count = 0
+        self.lock = threading.Lock()
+
+    @property
+    def width(self):
+        return None if self.data is None else self.data.shape[1]
+
+    def extend(self, block):
+        """
+        Append a 2D block of samples (one row per sample) to the buffer.
+        :param block: array of shape (n, width)
+        :return: index of the first sample of the block
+        """
+        block = np.asarray(block, dtype=np.float64)
+        if block.ndim != 2 or block.shape[0] == 0:
+            return self.count
+
+        with self.lock:
+            if self.data is None:
+                self.data = np.zeros((self.capacity, block.shape[1]))
+            elif block.shape[1] != self.data.shape[1]:
+                raise ValueError('Block width {} does not match buffer width {}'.format(
+                    block.shape[1], self.data.shape[1]))
+
+            # Only the tail of an oversized block can survive.
+            if block.shape[0] > self.capacity:
+                self.count += block.shape[0] - self.capacity
+                block = block[-self.capacity:]
+
+            first_index = self.count
+            n = block.shape[0]
+            start = self.count % self.capacity
+            first = min(n, self.capacity - start)
+            self.data[start:start + first] = block[:first]
+            self.data[:n - first] = block[first:]
+            self.count += n
+
+            return first_index
+
+    def latest(self, n):
+        """
+        Get a copy of the last n samples in the buffer.
+        :param n: number of samples wanted
+        :return: (index of the first returned sample, array of shape (m, width)) with m <= n
+        """
+        with self.lock:
+            if self.data is None:
+                return self.count, None
+
+            n = min(n, self.count, self.capacity)
+            first_index = self.count - n
+            start = first_index % self.capacity
+            idx = (start + np.arange(n)) % self.capacity
+
+            return first_index, self.data[idx]
+
+
+class SampleSubscriber(object):
+    """
+    Bounded queue of sample blocks handed out to one live stream client.
+
+    When a client cannot keep up the oldest blocks are dropped so that the
+    recorder never waits on a slow consumer.
+    """
+    def __init__(self, recorder=None, maxblocks=64):
+        # Recorder feeding this subscriber.
+        self.recorder = recorder
+        self.blocks = collections.deque()
+        self.maxblocks = maxblocks
+        # Number of samples dropped because the client was too slow.
+        self.dropped = 0
+        self.cond = threading.Condition()
+
+    def put(self, first_index, block):
+        """
+        Queue a block of samples, dropping the oldest block if the queue is full.
+        :return:
+        """
+        with self.cond:
+            if len(self.blocks) >= self.maxblocks:
+                _, old = self.blocks.popleft()
+                self.dropped += old.shape[0]
+            self.blocks.append((first_index, block))
+            self.cond.notify()
+
+    def get_batch(self, timeout):
+        """
+        Wait for new samples and return everything queued so far as a single block.
+        :param timeout: maximum time to wait for new samples (seconds)
+        :return: (index of the first sample, array) or (None, None) on timeout
+        """
+        with self.cond:
+            if not self.blocks:
+                self.cond.wait(timeout)
+            if not self.blocks:
+                return None, None
+
+            blocks = list(self.blocks)
+            self.blocks.clear()
+
+        # Blocks separated by dropped samples are not contiguous, only keep the newest run.
+        first_index, run = blocks[0][0], [blocks[0][1]]
+        for idx, block in blocks[1:]:
+            if idx != first_index + sum(b.shape[0] for b in run):
+                first_index, run = idx, []
+            run.append(block)
+
+        return first_index, np.concatenate(run)
+
+    @property
+    def finished(self):
+        """
+        True once the recorder stopped and every queued block was handed out.
+        """
+        with self.cond:
+            return not self.blocks and (self.recorder is None or not self.recorder.is_alive())
+
+    def close(self):
+        """
+        Stop receiving samples.
+        :return:
+        """
+        if self.recorder is not None:
+            self.recorder.unsubscribe(self)
+
+
+class GzipMemberFile(object):
+    """
+    Gzip file written as a series of independent members, one per flush.
+
+    Any gzip reader decompresses the whole file. The headers of the members
+    tell their size and number of lines, so readers can seek to the member
+    holding a row (see rowindex.gzip_members).
+    """
+    def __init__(self, path, compresslevel=1):
+        self.fp = open(path, 'wb')
+        self.compresslevel = compresslevel
+        self.pending = []
+
+    def write(self, data):
+        self.pending.append(data)
+        return len(data)
+
+    def flush(self):
+        if self.pending:
+            self.fp.write(rowindex.gzip_member(b''.join(self.pending), self.compresslevel))
+            self.pending = []
+        self.fp.flush()
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class RecordWriter(threading.Thread):
+    """
+    Writes recorded data to disk on its own thread.
+
+    Chunks handed over by the serial reader are batched together and flushed
+    when FLUSH_BYTES are pending or FLUSH_INTERVAL has elapsed, so the reader
+    never waits on the SD card.
+
+    With fmt='csv' the chunks are raw serial bytes. With fmt='bin' they are
+    decoded sample blocks written to a binary record (see recformat).
+
+    With compress=True, CSV data is written as gzip members and binary
+    records get zlib compressed blocks. Compression runs on this thread, so
+    it does not slow down the serial reader.
+
+    With segment_bytes or segment_seconds set, path is the folder of a
+    segmented recording (see segments) and the chunks are always decoded
+    sample blocks.
+
+    derived_channels names the last columns of the blocks, computed by the
+    recorder's processing stages (see pipeline).
+    """
+    def __init__(self, path, fmt='csv', compress=False, flush_bytes=FLUSH_BYTES, flush_interval=FLUSH_INTERVAL,
+                 segment_bytes=None, segment_seconds=None, derived_channels=()):
+        super(RecordWriter, self).__init__()
+        self.path = path
+        self.fmt = fmt
+        self.compress = compress
+        self.segmented = bool(segment_bytes or segment_seconds)
+        self.segment_bytes = segment_bytes or segments.SEGMENT_BYTES
+        self.segment_seconds = segment_seconds or segments.SEGMENT_SECONDS
+        self.derived_channels = list(derived_channels)
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.chunks = queue.Queue()
+        self.daemon = True
+
+    def write(self, data):
+        """
+        Queue bytes (csv) or a block of samples (bin or segmented) to be written.
+        :return:
+        """
+        self.chunks.put(data)
+
+    def close(self):
+        """
+        Write everything still queued, flush and close the file.
+        :return:
+        """
+        self.chunks.put(None)
+
+    def run(self):
+        """
+        Main thread function
+        :return:
+        """
+        pending = 0
+        last_flush = time.time()
+        done = False
+
+        if self.segmented:
+            out = segments.SegmentedRecordFile(self.path, fmt=self.fmt, compress=self.compress,
+                                               sample_period=SAMPLE_PERIOD, segment_bytes=self.segment_bytes,
+                                               segment_seconds=self.segment_seconds)
+        elif self.fmt == 'bin':
+            out = recformat.BinaryRecordFile(self.path, sample_period=SAMPLE_PERIOD,
+                                             compression='zlib' if self.compress else None)
+        elif self.compress:
+            out = GzipMemberFile(self.path)
+        else:
+            out = open(self.path, 'wb', buffering=self.flush_bytes)
+
+        with out:
+            while not done:
+                timeout = max(0.0, self.flush_interval - (time.time() - last_flush))
+                try:
+                    batch = [self.chunks.get(timeout=timeout)]
+                except queue.Empty:
+                    batch = []
+
+                # Grab everything else already queued.
+                while True:
+                    try:
+                        batch.append(self.chunks.get_nowait())
+                    except queue.Empty:
+                        break
+
+                # None marks the end of the recording.
+                for i, item in enumerate(batch):
+                    if item is None:
+                        batch = batch[:i]
+                        done = True
+                        break
+
+                if batch:
+                    if self.fmt == 'bin' or self.segmented:
+                        data = np.concatenate(batch)
+                        size = data.nbytes
+                        if out.channels is None:
+                            # Only known once the width of the frames is.
+                            out.channels = pipeline_module.column_names(data.shape[1], self.derived_channels)
+                    else:
+                        data = b''.join(batch)
+                        size = len(data)
+                    out.write(data)
+                    pending += size
+                    metrics.WRITER_WRITE_BYTES.inc(size)
+
+                if done or pending >= self.flush_bytes or \
+                        (pending and time.time() - last_flush >= self.flush_interval):
+                    t = time.time()
+                    out.flush()
+                    metrics.WRITER_FLUSH_SECONDS.observe(time.time() - t)
+                    pending = 0
+                    last_flush = time.time()
+
+
+def encode_csv(block):
+    """
+    Format a block of samples as CSV lines.
+    :return: bytes
+    """
+    return ''.join(','.join(repr(v) for v in row) + '\n' for row in block.tolist()).encode()
+
+
+def normalize_port(port):
+    """
+    Get the full path of a serial port.
+    :return:
+    """
+    # If we are not on windows
+    if sys.platform != 'win32':
+        # If the port name does not start with /dev, then add it.
+        if not port.startswith('/dev'):
+            port = '/dev/' + port
+
+    return port
+
 
 class SerialDataRecorder(threading.Thread):
     def __init__(self, port, baud,
                  logfile=Path('log.txt'),
                  patient=1,
                  session=1,
-                 record=1):
+                 record=1,
+                 fmt='csv',
+                 framing='csv',
+                 compress=False,
+                 segment_bytes=None,
+                 segment_seconds=None,
+                 stages=None,
+                 on_finish=None):
         super(SerialDataRecorder, self).__init__()
-        self.port = port
-
-        # If we are not on windows
-        if sys.platform != 'win32':
-            # If the port name does not start with /dev, then add it.
-            if not self.port.startswith('/dev'):
-                self.port = '/dev/' + self.port
+        self.port = normalize_port(port)
 
         self.baud = baud
         self.logfile = logfile
         self.patient = patient
         self.session = session
         self.record = record
+        # Recording format, 'csv' for raw serial bytes or 'bin' for a binary record.
+        self.fmt = fmt
+        # Framing of the serial stream, 'csv' or 'msgpack'.
+        self.framing = framing
+        # Compress the recording as it is written.
+        self.compress = compress
+        # Roll to a new segment after this many bytes or seconds, None for a single file.
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.segmented = bool(segment_bytes or segment_seconds)
+        # Derived channels computed from the decoded samples as they arrive (see pipeline).
+        self.pipeline = pipeline_module.Pipeline(stages, SAMPLE_PERIOD) if stages else None
+        # Called with the recorder once the recording is closed.
+        self.on_finish = on_finish
         # Serial port object
         self.spobj = None
-        # Message queue
-        self.msgq = queue.Queue()
+        # Set when the recording should stop.
+        self.stop_event = threading.Event()
+        # Total number of bytes received.
+        self.bytes_logged = 0
+        # Ingest rates over the last RATE_INTERVAL.
+        self.bytes_rate = 0.0
+        self.frames_rate = 0.0
+        # Bytes waiting in the serial port's input buffer after the last read.
+        self.serial_backlog = 0
+        # Record writer thread, while recording.
+        self.writer = None
+        # Most recent decoded samples, used for live plots.
+        self.ringbuf = RingBuffer()
+        # Splits the serial stream into frames and decodes them.
+        self.decoder = framing_module.make_decoder(framing)
+        # Keeps the acknowledgements of commands out of raw CSV recordings.
+        self.control_filter = framing_module.ControlLineFilter()
+        # Live stream clients.
+        self.subscribers = []
+        self.subscribers_lock = threading.Lock()
+        # Commands to the micro-controller, written to the port while reads go on.
+        self.commands = commands.CommandChannel(self.write_serial, framing)
         # Set up as a daemon thread so that it exits when the main program exits.
         self.daemon = True
 
@@ -98,44 +486,326 @@ class SerialDataRecorder(threading.Thread):
         Main thread function
         :return:
         """
-        # Initialize the serial port
-        self.spobj = serial.Serial(self.port, self.baud)
+        # Initialize the serial port. Reads block until data arrives or the timeout expires.
+        self.spobj = serial.Serial(self.port, self.baud, timeout=READ_TIMEOUT)
         # Create file if it does not exist.
         self.logfile.parent.mkdir(parents=True, exist_ok=True)
 
-        # Start an infinite loop
-        MSG = None
-        BYTES = 0
-        with open(self.logfile, 'wb') as fp:
-            while True:
-                time.sleep(0.1)
-
-                if self.spobj.inWaiting() > 0:
-                    serial_data = self.spobj.read(self.spobj.inWaiting())
-                    #serial_str = serial_data.decode('utf-8')
-                    fp.write(serial_data)
-                    fp.flush()
-                    BYTES += len(serial_data)
-                try:
-                    MSG = self.msgq.get(False)
+        # Disk writes happen on their own thread.
+        writer = RecordWriter(self.logfile, fmt=self.fmt, compress=self.compress,
+                              segment_bytes=self.segment_bytes, segment_seconds=self.segment_seconds,
+                              derived_channels=self.pipeline.derived if self.pipeline is not None else ())
+        writer.start()
+        self.writer = writer
+        header_written = False
 
-                    if MSG == 'STOP':
-                        break
-                except queue.Empty:
-                    pass
+        # Start of the current rate interval, with the counters at that time.
+        rate_start = (time.time(), 0, 0)
+
+        try:
+            while not self.stop_event.is_set():
+                # Returns as soon as at least one byte is available.
+                serial_data = self.spobj.read(max(1, self.spobj.in_waiting))
+                self.serial_backlog = self.spobj.in_waiting
+
+                now = time.time()
+                if now - rate_start[0] >= RATE_INTERVAL:
+                    self.bytes_rate = (self.bytes_logged - rate_start[1]) / (now - rate_start[0])
+                    self.frames_rate = (self.decoder.frames - rate_start[2]) / (now - rate_start[0])
+                    rate_start = (now, self.bytes_logged, self.decoder.frames)
+
+                if serial_data:
+                    self.bytes_logged += len(serial_data)
+                    block = self.decode(serial_data)
+
+                    if self.fmt == 'bin' or self.segmented:
+                        if block is not None:
+                            writer.write(block)
+                    elif self.framing == 'csv' and self.pipeline is None:
+                        data = self.control_filter.feed(serial_data)
+                        if data:
+                            writer.write(data)
+                    elif block is not None:
+                        # Binary frames and derived channels are stored as CSV text, with a header
+                        # line taking the place of the partial first line of raw recordings.
+                        if not header_written:
+                            writer.write(','.join(self.columns(block.shape[1])).encode() + b'\n')
+                            header_written = True
+                        writer.write(encode_csv(block))
+        finally:
+            writer.close()
+            writer.join()
+            self.spobj.close()
+            self.bytes_rate = self.frames_rate = 0.0
 
         # Thread is winding down.
         print("Serial thread is exiting...")
-        print("{} bytes logged".format(BYTES))
-        self.spobj.close()
-        return BYTES
+        print("{} bytes logged".format(self.bytes_logged))
+
+        if self.on_finish is not None:
+            try:
+                self.on_finish(self)
+            except Exception as e:
+                print("Recording finish hook failed: {}".format(e))
+
+        return self.bytes_logged
+
+    def decode(self, serial_data):
+        """
+        Decode received bytes and push the samples into the ring buffer and to the live stream clients.
+        :param serial_data: raw bytes read from the serial port
+        :return: 2D array of decoded samples or None
+        """
+        block = self.decoder.feed(serial_data)
+
+        for ack in self.decoder.pop_acks():
+            self.commands.acknowledge(ack)
+
+        if block is not None:
+            if self.pipeline is not None:
+                block = self.pipeline.process(block)
+            first_index = self.ringbuf.extend(block)
+            self.publish(first_index, block)
+
+        return block
+
+    def write_serial(self, data):
+        """
+        Write bytes to the serial port while recording, reads go on meanwhile.
+        :return:
+        """
+        spobj = self.spobj
+        if spobj is None or not spobj.is_open or not self.is_alive():
+            raise serial.SerialException('Port {} is not open'.format(self.port))
+        spobj.write(data)
+
+    def columns(self, width):
+        """
+        Names of the columns of the decoded samples, derived channels last.
+        :return: list
+        """
+        return pipeline_module.column_names(width, self.pipeline.derived if self.pipeline is not None else ())
+
+    def subscribe(self, maxblocks=64):
+        """
+        Register a new live stream client.
+        :param maxblocks: number of blocks queued before the oldest ones are dropped
+        :return: SampleSubscriber
+        """
+        sub = SampleSubscriber(self, maxblocks)
+        with self.subscribers_lock:
+            self.subscribers.append(sub)
+        return sub
+
+    def unsubscribe(self, sub):
+        """
+        Remove a live stream client.
+        :return:
+        """
+        with self.subscribers_lock:
+            if sub in self.subscribers:
+                self.subscribers.remove(sub)
+
+    def publish(self, first_index, block):
+        """
+        Hand a block of freshly decoded samples to every live stream client.
+        :return:
+        """
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+        for sub in subscribers:
+            sub.put(first_index, block)
+
+    def status(self):
+        """
+        Snapshot of the recorder state.
+        :return: dict
+        """
+        writer = self.writer
+        with self.subscribers_lock:
+            subscribers = list(self.subscribers)
+
+        return {'status': 'RECORDING' if self.is_alive() else 'FINISHED',
+                'port': self.port,
+                'patient': self.patient,
+                'session': self.session,
+                'record': self.record,
+                'file': str(self.logfile),
+                'bytes': self.bytes_logged,
+                'frames': self.decoder.counters(),
+                'bytes_rate': self.bytes_rate,
+                'frames_rate': self.frames_rate,
+                'serial_backlog': self.serial_backlog,
+                'writer_queue': writer.chunks.qsize() if writer is not None and writer.is_alive() else 0,
+                'stream_clients': len(subscribers),
+                'stream_dropped': sum(sub.dropped for sub in subscribers),
+                'derived_channels': self.pipeline.derived if self.pipeline is not None else [],
+                'stage_seconds': self.pipeline.seconds if self.pipeline is not None else 0.0}
 
     def stop_recording(self):
         """
         Tell the serial thread to stop.
         :return:
         """
-        self.msgq.put('STOP')
+        self.stop_event.set()
+
+        # Wake the thread up if it is blocked in a read.
+        if self.spobj is not None:
+            try:
+                self.spobj.cancel_read()
+            except (AttributeError, serial.SerialException):
+                pass
+
+
+class RecorderManager(object):
+    """
+    Keeps track of the recorders running side by side, one per serial port.
+
+    Each recorder is addressed by an id chosen by the client. The web
+    endpoints only go through the methods below, which recorderd.RecorderClient
+    provides as well when the recorders run in their own process.
+    """
+    DEFAULT_ID = 'default'
+
+    def __init__(self, on_finish=None):
+        self.recorders = {}
+        self.lock = threading.Lock()
+        # Ports opened by send_settings for a command, no recorder can start on them meanwhile.
+        self.commanding = set()
+        # Called with every recorder once its recording is closed.
+        self.on_finish = on_finish
+
+    def get(self, recorder_id=DEFAULT_ID):
+        """
+        Get a recorder by id.
+        :return: SerialDataRecorder or None
+        """
+        with self.lock:
+            return self.recorders.get(recorder_id)
+
+    def items(self):
+        """
+        :return: list of (id, recorder)
+        """
+        with self.lock:
+            return list(self.recorders.items())
+
+    def start(self, recorder_id, **kwargs):
+        """
+        Start a new recorder unless one with the same id is already running.
+        :param recorder_id: id of the recorder
+        :param kwargs: arguments of SerialDataRecorder
+        :return: status of the running recorder
+        """
+        with self.lock:
+            recorder = self.recorders.get(recorder_id)
+            if recorder is not None and recorder.is_alive():
+                return self._status(recorder_id, recorder)
+
+            # Two recorders cannot share a port.
+            if normalize_port(kwargs['port']) in self.commanding:
+                raise ValueError('Port {} is busy sending a command'.format(kwargs['port']))
+            for other_id, other in self.recorders.items():
+                if other.is_alive() and other.port == normalize_port(kwargs['port']):
+                    raise ValueError('Port {} is used by recorder {}'.format(other.port, other_id))
+
+            kwargs.setdefault('on_finish', self.on_finish)
+            recorder = SerialDataRecorder(**kwargs)
+            self.recorders[recorder_id] = recorder
+            recorder.start()
+            return self._status(recorder_id, recorder)
+
+    def send_settings(self, port, baud, params, framing='csv', timeout=commands.ACK_TIMEOUT):
+        """
+        Send parameters to the micro-controller, through the recorder using the port if there is one.
+        :param params: dict of parameter name to value
+        :return: dict, see commands.CommandChannel.send
+        """
+        port = normalize_port(port)
+        with self.lock:
+            for recorder in self.recorders.values():
+                if recorder.is_alive() and recorder.port == port:
+                    channel = recorder.commands
+                    break
+            else:
+                if port in self.commanding:
+                    raise ValueError('Port {} is busy sending a command'.format(port))
+                # No recorder can take the port while it is open for the command.
+                self.commanding.add(port)
+                channel = None
+
+        if channel is not None:
+            return channel.send(params, timeout)
+        try:
+            return commands.send_direct(port, baud, params, framing, timeout)
+        finally:
+            with self.lock:
+                self.commanding.discard(port)
+
+    def stop(self, recorder_id=DEFAULT_ID):
+        """
+        Stop a recorder. A recorder that already finished is forgotten.
+        :return: True if a recorder was running
+        """
+        with self.lock:
+            recorder = self.recorders.get(recorder_id)
+            if recorder is None:
+                return False
+            if recorder.is_alive():
+                recorder.stop_recording()
+                return True
+
+            del self.recorders[recorder_id]
+            return False
+
+    def stop_all(self):
+        for recorder_id, _ in self.items():
+            self.stop(recorder_id)
+
+    def is_alive(self, recorder_id=DEFAULT_ID):
+        recorder = self.get(recorder_id)
+        return recorder is not None and recorder.is_alive()
+
+    @staticmethod
+    def _status(recorder_id, recorder):
+        status = recorder.status()
+        status['id'] = recorder_id
+        return status
+
+    def status(self, recorder_id=DEFAULT_ID):
+        """
+        Status of a recorder.
+        :return: dict or None if there is no such recorder
+        """
+        recorder = self.get(recorder_id)
+        return None if recorder is None else self._status(recorder_id, recorder)
+
+    def statuses(self):
+        """
+        Status of every recorder.
+        :return: list of dicts
+        """
+        return [self._status(recorder_id, recorder) for recorder_id, recorder in self.items()]
+
+    def latest(self, recorder_id, n):
+        """
+        Last n samples of a recorder.
+        :return: (index of the first sample, 2D array) or (None, None)
+        """
+        recorder = self.get(recorder_id)
+        if recorder is None:
+            return None, None
+        return recorder.ringbuf.latest(n)
+
+    def subscribe(self, recorder_id=DEFAULT_ID):
+        """
+        Subscribe to the samples of a running recorder.
+        :return: SampleSubscriber or None if the recorder is not running
+        """
+        recorder = self.get(recorder_id)
+        if recorder is None or not recorder.is_alive():
+            return None
+        return recorder.subscribe()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,11 @@
+"""
+Entry point of the production web server, e.g.:
+    gunicorn -w 3 --threads 4 -b 0.0.0.0:5050 wsgi:app
+
+Set EXO_RECORDER_SOCKET so that the workers use the recorder process
+(recorderd.py) instead of owning recorders themselves.
+"""
+from main import app, setup
+
+# The recorder process keeps the data catalog in sync.
+setup(start_catalog=False)